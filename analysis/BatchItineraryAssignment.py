@@ -1,38 +1,64 @@
 import logging
+import multiprocessing
+import sys
 import time
 
 import yaml
 
+from model import itinerary_tracker
 from utils import postgres as pg_utils
 
-with open('../config.yml', 'r') as yaml_config_file:
-    config = yaml.load(yaml_config_file)
-
 # log_formatter = logging.Formatter("%(levelname)s: %(asctime)s - %(name)s - %(process)s - %(message)s")
 FORMAT = '%(asctime)-15s %(levelname)s: %(message)s'
 logging.basicConfig(level=logging.INFO, format=FORMAT)
 logger = logging.getLogger(__name__)
 
-db_hostname = config['database']['hostname']
-db_port = config['database']['port']
-db_name = config['database']['dbname']
-db_user = config['database']['user']
-db_pwd = config['database']['pwd']
+# Name of this job's row in the watermarks table
+ITINERARY_JOB_NAME = 'itinerary_assignment'
+
+# The settings below are read from config.yml by apply_config, in the main process and in every worker
+ITINERARY_MAX_TIME_DIFF_SECONDS = itinerary_tracker.default_max_gap_sec
+
+# Number of itineraries assigned per transaction by the set-based assignment
+ITINERARY_BATCH_SIZE = 50000
+
+# Number of worker processes (each with its own DB connection), and aircraft handed to a worker at a time
+ITINERARY_WORKERS = 1
+ITINERARY_SHARD_SIZE = 500
 
-ITINERARY_MAX_TIME_DIFF_SECONDS = int(config['itinerarymaxtimediffseconds'])
+# Connection parameters of the DB in config.yml
+db_params = None
 
-dbconn = pg_utils.database_connection(dbname=db_name,
-                                      dbhost=db_hostname,
-                                      dbport=db_port,
-                                      dbuser=db_user,
-                                      dbpasswd=db_pwd)
+# DB connection of this process, opened by main or taken from the worker's pool
+dbconn = None
+# One-connection pool of this process, when running as an itinerary worker
+itinerary_worker_db_pool = None
 
 
-def get_all_unique_mode_s_without_itin_assigned():
+def apply_config(config):
+    """
+    Set the job's settings and DB connection parameters from config.yml
+
+    :param config: dict of the parsed config.yml
+    """
+    global ITINERARY_MAX_TIME_DIFF_SECONDS, ITINERARY_BATCH_SIZE, ITINERARY_WORKERS, ITINERARY_SHARD_SIZE, db_params
+    ITINERARY_MAX_TIME_DIFF_SECONDS = int(config['itinerarymaxtimediffseconds'])
+    ITINERARY_BATCH_SIZE = int(config.get('itinerarybatchsize', 50000))
+    ITINERARY_WORKERS = int(config.get('itineraryworkers', 1))
+    ITINERARY_SHARD_SIZE = int(config.get('itineraryshardsize', 500))
+    db_params = {'dbname': config['database']['dbname'],
+                 'dbhost': config['database']['hostname'],
+                 'dbport': config['database']['port'],
+                 'dbuser': config['database']['user'],
+                 'dbpasswd': config['database']['pwd']}
+
+
+def get_all_unique_mode_s_without_itin_assigned(start_epoch=None):
     """
     Queries the database to find all of the unqiue mode_s_hex codes that have at least 1 record without an itinerary ID
     assigned (null)
 
+    :param start_epoch: optional epoch timestamp, only records at or after it are considered
     :return: list of Mode S Hex IDs (strings) that have at least 1 record without an itinerary ID assigned
     """
     logger.info('Fetching a list of all Mode-s hex codes that are missing at least 1 itinerary ID.')
@@ -41,8 +67,9 @@ def get_all_unique_mode_s_without_itin_assigned():
     sql = '''SELECT 
               DISTINCT aircraftreports.mode_s_hex 
                 FROM aircraftreports 
-                  WHERE aircraftreports.itinerary_id IS NULL'''
-    uniq_mode_s_cursor.execute(sql)
+                  WHERE aircraftreports.itinerary_id IS NULL
+                        AND aircraftreports.report_epoch >= %s'''
+    uniq_mode_s_cursor.execute(sql, (0 if start_epoch is None else start_epoch,))
 
     return [record[0] for record in uniq_mode_s_cursor.fetchall()]
 
@@ -76,14 +103,14 @@ def assign_itinerary_id_for_mode_s(mode_s_hex_for_update, itinerary_id, min_time
 
     itinerary_cursor = dbconn.cursor()
 
-    sql = "UPDATE aircraftreports SET itinerary_id = '{0}' WHERE aircraftreports.mode_s_hex = '{1}' " \
-          "AND aircraftreports.report_epoch BETWEEN {2} AND {3} ".format(itinerary_id,
-                                                                         mode_s_hex_for_update,
-                                                                         min_time,
-                                                                         max_time)
-    logger.debug('Assigning Itinerary ID with sql: {}'.format(sql))
+    sql = '''UPDATE aircraftreports SET itinerary_id = %s
+               WHERE aircraftreports.mode_s_hex = %s
+                     AND aircraftreports.report_epoch BETWEEN %s AND %s'''
+    params = (itinerary_id, mode_s_hex_for_update, min_time, max_time)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Assigning Itinerary ID with sql: {}'.format(itinerary_cursor.mogrify(sql, params)))
 
-    itinerary_cursor.execute(sql)
+    itinerary_cursor.execute(sql, params)
 
     # commit the query for each of the itinerary assignments as we loop through them
     dbconn.commit()
@@ -112,10 +139,10 @@ def calc_time_diffs_for_mode_s(mode_s_hex):
                 OVER (ORDER BY aircraftreports.report_epoch) 
                   AS time_delta_sec
              FROM aircraftreports 
-              WHERE aircraftreports.itinerary_id IS NULL AND aircraftreports.mode_s_hex = '{}'
-                    ORDER BY aircraftreports.report_epoch'''.format(mode_s_hex)
+              WHERE aircraftreports.itinerary_id IS NULL AND aircraftreports.mode_s_hex = %s
+                    ORDER BY aircraftreports.report_epoch'''
 
-    uniq_mode_s_cursor.execute(sql)
+    uniq_mode_s_cursor.execute(sql, (mode_s_hex,))
 
     count = 0
     for time_diff_tuple in uniq_mode_s_cursor.fetchall():
@@ -149,7 +176,7 @@ def calc_time_diffs_for_mode_s(mode_s_hex):
 def generate_itinerary_id(mode_s, epoch_timestamp):
     """
     Using the mode-s hex code and the minimum epoch timestamp, create a new string that will be used as the
-    unique itinerary ID
+    unique itinerary ID. Shared with the ingest-time ItineraryTracker, so both make IDs the same way.
 
     :param mode_s: mode-s hex code
     :type mode_s: str
@@ -159,21 +186,415 @@ def generate_itinerary_id(mode_s, epoch_timestamp):
 
     """
 
-    timestamp = time.strftime('%Y_%m_%d_%H_%M_%S', time.localtime(epoch_timestamp))
-    itinerary_id_generated = timestamp + '_{}'.format(mode_s)
+    return itinerary_tracker.generate_itinerary_id(mode_s, epoch_timestamp)
+
+
+def attach_unassigned_reports_to_itineraries(start_epoch, end_epoch, mode_s_list=None):
+    """
+    Give reports without an itinerary ID the ID of the stamped reports next to them. The gap scan is run over every
+    report of the aircraft that have unassigned reports, stamped or not, from ITINERARY_MAX_TIME_DIFF_SECONDS before
+    start_epoch (so an itinerary that started before it is seen) to end_epoch. Unassigned reports in an itinerary
+    that has stamped reports (e.g. ones the ingest-time ItineraryTracker left NULL, because they arrived out of
+    order or after a restart) take the ID of its earliest stamped report. Only itineraries without any stamped
+    reports are left for get_itinerary_bounds_cursor.
+
+    :param start_epoch: epoch timestamp, only reports at or after it are attached
+    :param end_epoch: epoch timestamp, only reports at or before it are attached
+    :param mode_s_list: optional list of Mode S Hex IDs to limit the scan to
+    :return: number of reports updated
+    """
+    attach_cursor = dbconn.cursor()
+
+    sql = '''WITH numbered AS (
+                 SELECT gaps.mode_s_hex, gaps.report_epoch, gaps.itinerary_id,
+                        SUM(gaps.is_start) OVER (PARTITION BY gaps.mode_s_hex ORDER BY gaps.report_epoch)
+                          AS itinerary_num
+                 FROM (SELECT aircraftreports.mode_s_hex, aircraftreports.report_epoch, aircraftreports.itinerary_id,
+                              CASE WHEN aircraftreports.report_epoch - lag(aircraftreports.report_epoch)
+                                     OVER (PARTITION BY aircraftreports.mode_s_hex
+                                           ORDER BY aircraftreports.report_epoch) <= %(max_gap_sec)s
+                                THEN 0 ELSE 1 END AS is_start
+                       FROM aircraftreports
+                       WHERE aircraftreports.report_epoch >= %(context_epoch)s
+                             AND aircraftreports.report_epoch <= %(end_epoch)s
+                             AND aircraftreports.mode_s_hex IN (
+                               SELECT DISTINCT unassigned.mode_s_hex
+                                 FROM aircraftreports AS unassigned
+                                 WHERE unassigned.itinerary_id IS NULL
+                                       AND unassigned.report_epoch >= %(start_epoch)s
+                                       AND unassigned.report_epoch <= %(end_epoch)s
+                                       {})) AS gaps),
+               stamped AS (
+                 SELECT numbered.mode_s_hex, MIN(numbered.report_epoch) AS start_epoch,
+                        MAX(numbered.report_epoch) AS end_epoch,
+                        (array_agg(numbered.itinerary_id ORDER BY numbered.report_epoch)
+                           FILTER (WHERE numbered.itinerary_id IS NOT NULL))[1] AS itinerary_id
+                 FROM numbered
+                 GROUP BY numbered.mode_s_hex, numbered.itinerary_num
+                 HAVING bool_or(numbered.itinerary_id IS NULL) AND bool_or(numbered.itinerary_id IS NOT NULL))
+             UPDATE aircraftreports
+               SET itinerary_id = stamped.itinerary_id
+             FROM stamped
+             WHERE aircraftreports.mode_s_hex = stamped.mode_s_hex
+                   AND aircraftreports.report_epoch BETWEEN stamped.start_epoch AND stamped.end_epoch
+                   AND aircraftreports.itinerary_id IS NULL
+                   AND aircraftreports.report_epoch >= %(start_epoch)s
+                   AND aircraftreports.report_epoch <= %(end_epoch)s'''.format(
+        '' if mode_s_list is None else 'AND unassigned.mode_s_hex = ANY(%(mode_s_list)s)')
+
+    attach_cursor.execute(sql, {'start_epoch': start_epoch,
+                                'end_epoch': end_epoch,
+                                'context_epoch': start_epoch - ITINERARY_MAX_TIME_DIFF_SECONDS,
+                                'max_gap_sec': ITINERARY_MAX_TIME_DIFF_SECONDS,
+                                'mode_s_list': mode_s_list})
+    num_updated = attach_cursor.rowcount
+
+    dbconn.commit()
+    attach_cursor.close()
+
+    if num_updated:
+        logger.info('Attached {} unassigned reports to the stamped itineraries next to them'.format(num_updated))
+    return num_updated
+
+
+def get_itinerary_bounds_cursor(start_epoch, end_epoch, mode_s_list=None):
+    """
+    Run one windowed gap scan over every report without an itinerary ID between start_epoch and end_epoch, for all
+    aircraft at once. A report more than ITINERARY_MAX_TIME_DIFF_SECONDS after the previous report of the same
+    aircraft starts a new itinerary, and each itinerary is numbered by the running count of starts.
+
+    An itinerary is complete if the same aircraft has a later itinerary, or if its last report is more than
+    ITINERARY_MAX_TIME_DIFF_SECONDS before end_epoch. The last itinerary of an aircraft that is still being
+    reported could be in progress, so it's left for a later run.
+
+    :param start_epoch: epoch timestamp, only reports at or after it are scanned
+    :param end_epoch: epoch timestamp, only reports at or before it are scanned
+    :param mode_s_list: optional list of Mode S Hex IDs to limit the scan to
+    :return: server side cursor over (mode_s_hex, min epoch, max epoch, is complete) of every itinerary, kept open
+             across commits
+    """
+    # WITH HOLD, so the itineraries can be assigned in several transactions while reading through the results
+    bounds_cursor = dbconn.cursor(name='itinerary_bounds', withhold=True)
+    bounds_cursor.itersize = ITINERARY_BATCH_SIZE
+
+    sql = '''SELECT numbered.mode_s_hex, MIN(numbered.report_epoch), MAX(numbered.report_epoch),
+                    numbered.itinerary_num < MAX(numbered.itinerary_num) OVER (PARTITION BY numbered.mode_s_hex)
+                      OR MAX(numbered.report_epoch) < %(quiet_epoch)s
+               FROM (SELECT gaps.mode_s_hex, gaps.report_epoch,
+                            SUM(gaps.is_start) OVER (PARTITION BY gaps.mode_s_hex ORDER BY gaps.report_epoch)
+                              AS itinerary_num
+                     FROM (SELECT aircraftreports.mode_s_hex, aircraftreports.report_epoch,
+                                  CASE WHEN aircraftreports.report_epoch - lag(aircraftreports.report_epoch)
+                                         OVER (PARTITION BY aircraftreports.mode_s_hex
+                                               ORDER BY aircraftreports.report_epoch) <= %(max_gap_sec)s
+                                    THEN 0 ELSE 1 END AS is_start
+                           FROM aircraftreports
+                           WHERE aircraftreports.itinerary_id IS NULL
+                                 AND aircraftreports.report_epoch >= %(start_epoch)s
+                                 AND aircraftreports.report_epoch <= %(end_epoch)s
+                                 {}) AS gaps) AS numbered
+               GROUP BY numbered.mode_s_hex, numbered.itinerary_num'''.format(
+        '' if mode_s_list is None else 'AND aircraftreports.mode_s_hex = ANY(%(mode_s_list)s)')
+
+    bounds_cursor.execute(sql, {'start_epoch': start_epoch,
+                                'end_epoch': end_epoch,
+                                'max_gap_sec': ITINERARY_MAX_TIME_DIFF_SECONDS,
+                                'quiet_epoch': end_epoch - ITINERARY_MAX_TIME_DIFF_SECONDS,
+                                'mode_s_list': mode_s_list})
+    return bounds_cursor
+
+
+def apply_itinerary_assignments(itinerary_rows):
+    """
+    Assign a batch of itineraries in one transaction: COPY them into a staging table, then stamp the IDs onto
+    aircraftreports with a single join UPDATE. Rows that already have an itinerary ID are left alone, so a batch
+    that's applied twice (e.g. after a failed run) doesn't change anything.
+
+    :param itinerary_rows: list of (mode_s_hex, min epoch, max epoch, itinerary ID)
+    :return: number of reports updated
+    """
+    assign_cursor = dbconn.cursor()
+
+    # Emptied by every commit, so each batch starts with a clean staging table
+    assign_cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS itinerary_assignments (
+                                mode_s_hex   TEXT,
+                                start_epoch  INTEGER,
+                                end_epoch    INTEGER,
+                                itinerary_id TEXT) ON COMMIT DELETE ROWS''')
+    pg_utils.copy_rows_into_table(assign_cursor, 'itinerary_assignments',
+                                  ['mode_s_hex', 'start_epoch', 'end_epoch', 'itinerary_id'], itinerary_rows)
+    assign_cursor.execute('ANALYZE itinerary_assignments')
+
+    # The overall epoch bounds let the planner skip the partitions the batch doesn't touch
+    sql = '''UPDATE aircraftreports
+               SET itinerary_id = itinerary_assignments.itinerary_id
+             FROM itinerary_assignments
+             WHERE aircraftreports.mode_s_hex = itinerary_assignments.mode_s_hex
+                   AND aircraftreports.report_epoch BETWEEN itinerary_assignments.start_epoch
+                                                        AND itinerary_assignments.end_epoch
+                   AND aircraftreports.itinerary_id IS NULL
+                   AND aircraftreports.report_epoch BETWEEN %s AND %s'''
+    assign_cursor.execute(sql, (min([itinerary_row[1] for itinerary_row in itinerary_rows]),
+                                max([itinerary_row[2] for itinerary_row in itinerary_rows])))
+    num_updated = assign_cursor.rowcount
+
+    dbconn.commit()
+    assign_cursor.close()
+
+    return num_updated
+
+
+def assign_complete_itineraries(start_epoch, end_epoch, mode_s_list=None):
+    """
+    Attach unassigned reports to the stamped itineraries next to them, then gap scan the rest of the reports
+    between start_epoch and end_epoch and assign every complete itinerary, one join UPDATE per
+    ITINERARY_BATCH_SIZE itineraries
+
+    :param start_epoch: epoch timestamp, only reports at or after it are scanned
+    :param end_epoch: epoch timestamp, only reports at or before it are scanned
+    :param mode_s_list: optional list of Mode S Hex IDs to limit the scan to
+    :return: tuple of (itineraries assigned, reports updated, start epoch of the earliest itinerary still in progress
+             or None)
+    """
+    num_updated = attach_unassigned_reports_to_itineraries(start_epoch, end_epoch, mode_s_list)
+
+    bounds_cursor = get_itinerary_bounds_cursor(start_epoch, end_epoch, mode_s_list)
+
+    earliest_open_epoch = None
+    num_itineraries = 0
+    itinerary_rows = []
+
+    try:
+        for mode_s_hex, min_epoch, max_epoch, is_complete in bounds_cursor:
+            if not is_complete:
+                if earliest_open_epoch is None or min_epoch < earliest_open_epoch:
+                    earliest_open_epoch = min_epoch
+                continue
+
+            itinerary_rows.append((mode_s_hex, min_epoch, max_epoch, generate_itinerary_id(mode_s_hex, min_epoch)))
+            if len(itinerary_rows) >= ITINERARY_BATCH_SIZE:
+                num_updated += apply_itinerary_assignments(itinerary_rows)
+                num_itineraries += len(itinerary_rows)
+                itinerary_rows = []
+                logger.info('Assigned {} itineraries ({} reports) so far'.format(num_itineraries, num_updated))
+
+        if itinerary_rows:
+            num_updated += apply_itinerary_assignments(itinerary_rows)
+            num_itineraries += len(itinerary_rows)
+    finally:
+        # The cursor is WITH HOLD, so it outlives the transaction. It has to be closed even if an update failed, or
+        # the next shard on this connection can't declare it again.
+        try:
+            bounds_cursor.close()
+        except:
+            # The failed update aborted the transaction, which has to be rolled back before the cursor can be closed
+            dbconn.rollback()
+            bounds_cursor.close()
+
+    return num_itineraries, num_updated, earliest_open_epoch
+
+
+def init_itinerary_worker(worker_config):
+    """
+    Pool initializer - applies the parent's config and sets up the one-connection DB pool that this worker process
+    uses for all of its shards
+    """
+    global itinerary_worker_db_pool
+    apply_config(worker_config)
+    itinerary_worker_db_pool = pg_utils.get_connection_pool('itinerary', max_connections=1, **db_params)
+
+
+def assign_itineraries_for_shard_in_worker(worker_args):
+    """
+    Pool task - assign the itineraries of one shard of aircraft on this worker's own DB connection, which is
+    reopened if a previous shard lost it. Never raises, so that one bad shard doesn't stop the pool.
+
+    :param worker_args: tuple of (list of Mode S Hex IDs, start epoch, end epoch, per_mode_s). With per_mode_s
+                        each aircraft is processed with calc_time_diffs_for_mode_s instead of the set-based scan.
+    :return: tuple of (aircraft processed, itineraries assigned, reports updated, earliest in-progress epoch or
+             None, error message or None)
+    """
+    global dbconn
+    mode_s_list, start_epoch, end_epoch, per_mode_s = worker_args
+    dbconn = itinerary_worker_db_pool.get_thread_connection()
+    if not dbconn:
+        return len(mode_s_list), 0, 0, None, 'No DB Connection'
+
+    try:
+        if per_mode_s:
+            for mode_s in mode_s_list:
+                calc_time_diffs_for_mode_s(mode_s)
+            return len(mode_s_list), 0, 0, None, None
+
+        num_itineraries, num_updated, earliest_open_epoch = assign_complete_itineraries(start_epoch, end_epoch,
+                                                                                        mode_s_list)
+        return len(mode_s_list), num_itineraries, num_updated, earliest_open_epoch, None
+    except Exception as shard_error:
+        logger.exception('Issue assigning itineraries for a shard of {} aircraft'.format(len(mode_s_list)))
+        try:
+            dbconn.rollback()
+        except:
+            pass
+        return len(mode_s_list), 0, 0, None, str(shard_error)
+
+
+def assign_itineraries_in_parallel(config, start_epoch, end_epoch, num_workers, per_mode_s=False):
+    """
+    Shard the aircraft with reports missing an itinerary ID across num_workers processes, each with its own DB
+    connection. Aircraft are independent of each other, so the shards can be assigned in any order.
+
+    :param config: dict of the parsed config.yml, applied in each worker
+    :param start_epoch: epoch timestamp, only reports at or after it are scanned
+    :param end_epoch: epoch timestamp, only reports at or before it are scanned
+    :param num_workers: number of worker processes
+    :param per_mode_s: use the original per aircraft assignment in each worker
+    :return: tuple of (itineraries assigned, reports updated, earliest in-progress epoch or None, number of failed
+             shards)
+    """
+    mode_s_list = get_all_unique_mode_s_without_itin_assigned(start_epoch)
+    dbconn.commit()
+    mode_s_shards = [mode_s_list[shard_start:shard_start + ITINERARY_SHARD_SIZE]
+                     for shard_start in range(0, len(mode_s_list), ITINERARY_SHARD_SIZE)]
+    logger.info('Assigning itineraries for {} aircraft in {} shards across {} worker processes'.format(
+        len(mode_s_list), len(mode_s_shards), num_workers))
+
+    num_processed = 0
+    num_itineraries = 0
+    num_updated = 0
+    earliest_open_epoch = None
+    num_failed_shards = 0
+
+    # Spawned rather than forked, so the workers don't get a copy of this process's DB connection
+    worker_pool = multiprocessing.get_context('spawn').Pool(processes=num_workers,
+                                                            initializer=init_itinerary_worker,
+                                                            initargs=(config,))
+    try:
+        worker_args = [(mode_s_shard, start_epoch, end_epoch, per_mode_s) for mode_s_shard in mode_s_shards]
+        for shard_result in worker_pool.imap_unordered(assign_itineraries_for_shard_in_worker, worker_args):
+            shard_processed, shard_itineraries, shard_updated, shard_open_epoch, shard_error = shard_result
+            num_processed += shard_processed
+            num_itineraries += shard_itineraries
+            num_updated += shard_updated
+            if shard_open_epoch is not None and (earliest_open_epoch is None or shard_open_epoch < earliest_open_epoch):
+                earliest_open_epoch = shard_open_epoch
+            if shard_error is not None:
+                num_failed_shards += 1
+                logger.error('Shard of {} aircraft failed: {}'.format(shard_processed, shard_error))
+
+            logger.info('Itinerary progress: {}/{} aircraft, {} itineraries ({} reports) assigned, {} failed '
+                        'shards'.format(num_processed, len(mode_s_list), num_itineraries, num_updated,
+                                        num_failed_shards))
+    finally:
+        worker_pool.close()
+        worker_pool.join()
+
+    return num_itineraries, num_updated, earliest_open_epoch, num_failed_shards
+
+
+def assign_itineraries_incrementally(config, full_rescan=False, num_workers=1):
+    """
+    Assign itinerary IDs to every complete itinerary with one gap scan and a join UPDATE per
+    ITINERARY_BATCH_SIZE itineraries, instead of a query per aircraft and an UPDATE + commit per itinerary. With
+    more than one worker, the aircraft are sharded across a pool of worker processes.
+
+    Each run resumes from the watermark left by the previous one: the start of the earliest itinerary that was
+    still in progress, so only reports from there on are scanned. Reports loaded afterwards with older timestamps
+    (e.g. archive loads) are only picked up by a full rescan.
+
+    :param config: dict of the parsed config.yml, applied in each worker
+    :param full_rescan: ignore the watermark and scan every report without an itinerary ID
+    :param num_workers: number of worker processes
+    :return: tuple of (itineraries assigned, reports updated)
+    """
+    watermark_cursor = dbconn.cursor()
+    pg_utils.ensure_watermarks_table(watermark_cursor)
+    dbconn.commit()
+
+    watermark_epoch = None if full_rescan else pg_utils.read_watermark(watermark_cursor, ITINERARY_JOB_NAME)
+    start_epoch = 0 if watermark_epoch is None else watermark_epoch
+    end_epoch = int(time.time())
+    logger.info('Scanning reports from {} to {} for itineraries'.format(
+        time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(start_epoch)),
+        time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(end_epoch))))
+
+    num_failed_shards = 0
+    if num_workers > 1:
+        num_itineraries, num_updated, earliest_open_epoch, num_failed_shards = \
+            assign_itineraries_in_parallel(config, start_epoch, end_epoch, num_workers)
+    else:
+        num_itineraries, num_updated, earliest_open_epoch = assign_complete_itineraries(start_epoch, end_epoch)
+
+    if num_failed_shards:
+        # The failed aircraft may have itineraries anywhere after the old watermark, so it has to stay put
+        logger.error('{} shards failed, leaving the watermark where it was'.format(num_failed_shards))
+        watermark_cursor.close()
+        return num_itineraries, num_updated
+
+    # Reports of in-progress itineraries must be scanned again next time, and anything newer than
+    # ITINERARY_MAX_TIME_DIFF_SECONDS could still be joined by reports that haven't been written yet
+    next_watermark_epoch = end_epoch - ITINERARY_MAX_TIME_DIFF_SECONDS
+    if earliest_open_epoch is not None:
+        next_watermark_epoch = min(next_watermark_epoch, earliest_open_epoch)
+    # Never move the watermark backwards, e.g. when a full rescan finds an itinerary that started before it
+    if watermark_epoch is not None:
+        next_watermark_epoch = max(next_watermark_epoch, watermark_epoch)
+    pg_utils.write_watermark(watermark_cursor, ITINERARY_JOB_NAME, next_watermark_epoch)
+    dbconn.commit()
+    watermark_cursor.close()
+
+    logger.info('Assigned {} itineraries ({} reports), next run starts from {}'.format(
+        num_itineraries, num_updated, time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(next_watermark_epoch))))
+
+    return num_itineraries, num_updated
+
+
+def assign_itineraries_per_mode_s(config, num_workers=1):
+    """
+    The original assignment, one gap scan per aircraft and an UPDATE per itinerary. With more than one worker, the
+    aircraft are sharded across a pool of worker processes.
+
+    :param config: dict of the parsed config.yml, applied in each worker
+    :param num_workers: number of worker processes
+    """
+    if num_workers > 1:
+        assign_itineraries_in_parallel(config, 0, int(time.time()), num_workers, per_mode_s=True)
+        return
+
+    mode_s_list_to_process = get_all_unique_mode_s_without_itin_assigned()
+
+    num_to_process = len(mode_s_list_to_process)
+
+    mode_s_count = 0
 
-    return itinerary_id_generated
+    for mode_s in mode_s_list_to_process:
+        mode_s_count += 1
+        logger.info('Calcing Itinerary IDs for Mode S: {} - Progress on whole dataset (Processed/Total): {}/{} Mode S IDs'.format(mode_s,
+                                                                                                                mode_s_count,
+                                                                                                                num_to_process))
+        calc_time_diffs_for_mode_s(mode_s)
 
 
-mode_s_list_to_process = get_all_unique_mode_s_without_itin_assigned()
+def main():
+    """
+    Load config.yml, connect to the DB and run the assignment. --full ignores the watermark, --per-mode-s runs the
+    original per aircraft assignment and --workers=N overrides itineraryworkers.
+    """
+    global dbconn
+    with open('../config.yml', 'r') as yaml_config_file:
+        config = yaml.safe_load(yaml_config_file)
+    apply_config(config)
+    dbconn = pg_utils.database_connection(**db_params)
+
+    num_workers = ITINERARY_WORKERS
+    for arg in sys.argv[1:]:
+        if arg.startswith('--workers='):
+            num_workers = int(arg.split('=', 1)[1])
 
-num_to_process = len(mode_s_list_to_process)
+    if '--per-mode-s' in sys.argv:
+        assign_itineraries_per_mode_s(config, num_workers)
+    else:
+        assign_itineraries_incrementally(config, full_rescan='--full' in sys.argv, num_workers=num_workers)
 
-mode_s_count = 0
 
-for mode_s in mode_s_list_to_process:
-    mode_s_count += 1
-    logger.info('Calcing Itinerary IDs for Mode S: {} - Progress on whole dataset (Processed/Total): {}/{} Mode S IDs'.format(mode_s,
-                                                                                                            mode_s_count,
-                                                                                                            num_to_process))
-    calc_time_diffs_for_mode_s(mode_s)
+if __name__ == '__main__':
+    main()
@@ -1,93 +1,344 @@
 import logging
+import multiprocessing
+import sys
 import time
 
+import numpy as np
 import yaml
 
+from model import holding_pattern
+from model import itinerary_tracker
 from utils import postgres as pg_utils
 
-with open('../config.yml', 'r') as yaml_config_file:
-    config = yaml.load(yaml_config_file)
-
 FORMAT = '%(asctime)-15s %(levelname)s: %(message)s'
 logging.basicConfig(level=logging.INFO, format=FORMAT)
 logger = logging.getLogger(__name__)
 
-db_hostname = config['database']['hostname']
-db_port = config['database']['port']
-db_name = config['database']['dbname']
-db_user = config['database']['user']
-db_pwd = config['database']['pwd']
+# Name of this job's row in the watermarks table, and of the itinerary job's row it waits on
+PATTERN_JOB_NAME = 'pattern_analytics'
+ITINERARY_JOB_NAME = 'itinerary_assignment'
+
+# The settings below are read from config.yml by apply_config, in the main process and in every worker
+ITINERARY_MAX_TIME_DIFF_SECONDS = itinerary_tracker.default_max_gap_sec
+
+# Number of worker processes (each with its own DB connection), and itineraries handed to a worker at a time
+PATTERN_WORKERS = 1
+PATTERN_SHARD_SIZE = 200
+
+aircraftpatterns_column_names = ['mode_s_hex', 'pattern_centroid', 'pattern_cent_long', 'pattern_cent_lat',
+                                 'report_epoch', 'reporter', 'itinerary_id']
+
+# Connection parameters of the DB in config.yml
+db_params = None
+
+# DB connection of this process, opened by main or taken from the worker's pool
+dbconn = None
+# One-connection pool of this process, when running as a pattern worker
+pattern_worker_db_pool = None
+
+
+def apply_config(config):
+    """
+    Set the job's settings and DB connection parameters from config.yml
+
+    :param config: dict of the parsed config.yml
+    """
+    global ITINERARY_MAX_TIME_DIFF_SECONDS, PATTERN_WORKERS, PATTERN_SHARD_SIZE, db_params
+    ITINERARY_MAX_TIME_DIFF_SECONDS = int(config['itinerarymaxtimediffseconds'])
+    PATTERN_WORKERS = int(config.get('patternworkers', 1))
+    PATTERN_SHARD_SIZE = int(config.get('patternshardsize', 200))
+    db_params = {'dbname': config['database']['dbname'],
+                 'dbhost': config['database']['hostname'],
+                 'dbport': config['database']['port'],
+                 'dbuser': config['database']['user'],
+                 'dbpasswd': config['database']['pwd']}
+
+
+def get_itinerary_ids_ended_between(start_epoch, end_epoch):
+    """
+    Queries the database for the itineraries whose last report is after start_epoch and at or before end_epoch
+
+    :param start_epoch: epoch timestamp, exclusive
+    :param end_epoch: epoch timestamp, inclusive
+    :return: list of tuples of (itinerary ID, epoch of its first report or None if it may have started before
+        start_epoch), ordered by first report so each shard holds itineraries from around the same time
+    """
+    logger.info('Fetching a list of all itineraries that ended since the last run.')
+    itinerary_cursor = dbconn.cursor()
+
+    # Itineraries ending after start_epoch have reports after it, so only the partitions from there on are read
+    sql = '''SELECT aircraftreports.itinerary_id, MIN(aircraftreports.report_epoch)
+               FROM aircraftreports
+                 WHERE aircraftreports.itinerary_id IS NOT NULL
+                       AND aircraftreports.report_epoch > %s
+               GROUP BY aircraftreports.itinerary_id
+               HAVING MAX(aircraftreports.report_epoch) <= %s
+               ORDER BY MIN(aircraftreports.report_epoch), aircraftreports.itinerary_id'''
+    itinerary_cursor.execute(sql, (start_epoch, end_epoch))
+    itinerary_starts = []
+    for itinerary_id, min_epoch in itinerary_cursor.fetchall():
+        # An itinerary whose first report here is within a gap of start_epoch may carry on from before it, so its
+        # real start isn't known
+        if start_epoch and min_epoch <= start_epoch + ITINERARY_MAX_TIME_DIFF_SECONDS:
+            min_epoch = None
+        itinerary_starts.append((itinerary_id, min_epoch))
+    itinerary_cursor.close()
+
+    return itinerary_starts
+
+
+def get_itinerary_tracks(itinerary_ids, min_start_epoch=None):
+    """
+    Fetch the located reports of a list of itineraries in one query
+
+    :param itinerary_ids: list of itinerary IDs
+    :param min_start_epoch: epoch of the earliest first report of the itineraries, if known, so the partitions before
+        it are skipped
+    :return: dict of itinerary ID -> tuple of (mode_s_hex, reporters, epochs, lons, lats), each in report_epoch order
+    """
+    track_cursor = dbconn.cursor()
+
+    sql = '''SELECT aircraftreports.itinerary_id, aircraftreports.mode_s_hex, aircraftreports.reporter,
+                    aircraftreports.report_epoch,
+                    ST_X(aircraftreports.report_location::GEOMETRY), ST_Y(aircraftreports.report_location::GEOMETRY)
+               FROM aircraftreports
+                 WHERE aircraftreports.itinerary_id = ANY(%s)
+                       AND aircraftreports.report_location IS NOT NULL
+                       {}
+               ORDER BY aircraftreports.itinerary_id, aircraftreports.report_epoch'''.format(
+        '' if min_start_epoch is None else 'AND aircraftreports.report_epoch >= %s')
+    track_cursor.execute(sql, (itinerary_ids,) if min_start_epoch is None else (itinerary_ids, min_start_epoch))
+    report_rows = track_cursor.fetchall()
+    track_cursor.close()
 
-dbconn = pg_utils.database_connection(dbname=db_name,
-                                      dbhost=db_hostname,
-                                      dbport=db_port,
-                                      dbuser=db_user,
-                                      dbpasswd=db_pwd)
+    itinerary_tracks = {}
+    track_start = 0
+    for row_num in range(1, len(report_rows) + 1):
+        if row_num < len(report_rows) and report_rows[row_num][0] == report_rows[track_start][0]:
+            continue
+        track_rows = report_rows[track_start:row_num]
+        itinerary_tracks[track_rows[0][0]] = (track_rows[0][1],
+                                              [report_row[2] for report_row in track_rows],
+                                              [report_row[3] for report_row in track_rows],
+                                              np.array([report_row[4] for report_row in track_rows]),
+                                              np.array([report_row[5] for report_row in track_rows]))
+        track_start = row_num
 
+    return itinerary_tracks
 
-def get_all_unique_itinerary_ids_without_patterns_analyzed():
+
+def find_patterns_for_itineraries(itinerary_ids, min_start_epoch=None):
     """
-    Queries the database to find all of the unqiue mode_s_hex codes that have at least 1 record without an itinerary ID
-    assigned (null)
+    Run holding pattern detection on each itinerary, then replace any aircraftpatterns rows they already have with
+    the patterns found, in one transaction. Analysing an itinerary twice (e.g. after a failed run) leaves one set of
+    rows for it.
 
-    :return: list of Mode S Hex IDs (strings) that have at least 1 record without an itinerary ID assigned
+    :param itinerary_ids: list of itinerary IDs
+    :param min_start_epoch: epoch of the earliest first report of the itineraries, or None if it isn't known
+    :return: number of patterns inserted
     """
-    logger.info('Fetching a list of all Mode-s hex codes that are missing at least 1 itinerary ID.')
-    uniq_mode_s_cursor = dbconn.cursor()
+    pattern_rows = []
+    for itinerary_id, itinerary_track in get_itinerary_tracks(itinerary_ids, min_start_epoch).items():
+        mode_s_hex, reporters, epochs, lons, lats = itinerary_track
+        for pattern in holding_pattern.find_holding_patterns(lons, lats):
+            centroid_lon, centroid_lat = pattern.centroid
+            pattern_rows.append((mode_s_hex,
+                                 'SRID=4326;POINT({} {})'.format(centroid_lon, centroid_lat),
+                                 centroid_lon,
+                                 centroid_lat,
+                                 epochs[pattern.point_index],
+                                 reporters[pattern.point_index],
+                                 itinerary_id))
 
-    sql = '''SELECT 
-              DISTINCT aircraftreports.mode_s_hex 
-                FROM aircraftreports 
-                  WHERE aircraftreports.itinerary_id IS NULL'''
-    uniq_mode_s_cursor.execute(sql)
+    pattern_cursor = dbconn.cursor()
+    pattern_cursor.execute('DELETE FROM aircraftpatterns WHERE itinerary_id = ANY(%s)', (itinerary_ids,))
+    pg_utils.copy_rows_into_table(pattern_cursor, 'aircraftpatterns', aircraftpatterns_column_names, pattern_rows)
+    dbconn.commit()
+    pattern_cursor.close()
 
-    return [record[0] for record in uniq_mode_s_cursor.fetchall()]
+    return len(pattern_rows)
 
 
-def assign_itinerary_id_for_mode_s(mode_s_hex_for_update, itinerary_id, min_time, max_time):
+def init_pattern_worker(worker_config):
     """
-    Given a mode s hex code, itinerary id, and 2 epoch timestamps, assign the itinerary ID to the appropriate rows
+    Pool initializer - applies the parent's config and sets up the one-connection DB pool that this worker process
+    uses for all of its shards
+    """
+    global pattern_worker_db_pool
+    apply_config(worker_config)
+    pattern_worker_db_pool = pg_utils.get_connection_pool('pattern', max_connections=1, **db_params)
 
-    :param mode_s_hex_for_update: Mode-s hex code (str)
-    :param itinerary_id: itinerary ID (str)
-    :param min_time: epoch timestamp, minimum timestamp
-    :param max_time: epoch timestamp, maximum timestamp
 
+def get_shard_min_start_epoch(itinerary_starts):
+    """
+    :param itinerary_starts: list of tuples of (itinerary ID, first report epoch or None)
+    :return: the earliest first report epoch, or None if any of them isn't known
     """
-    min_timestamp = time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(min_time))
-    max_timestamp = time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(max_time))
+    start_epochs = [itinerary_start[1] for itinerary_start in itinerary_starts]
+    return None if None in start_epochs else min(start_epochs)
 
-    logger.info(
-        'Assigning Itinerary ID {} for Mode S {} between times {} and {}'.format(itinerary_id,
-                                                                           mode_s_hex_for_update,
-                                                                           min_timestamp,
-                                                                           max_timestamp))
-    logger.debug(
-        'Between {} and {}'.format(min_time, max_time))
 
-    itinerary_cursor = dbconn.cursor()
+def find_patterns_for_shard_in_worker(itinerary_shard):
+    """
+    Pool task - analyse one shard of itineraries on this worker's own DB connection, which is reopened if a
+    previous shard lost it. Never raises, so that one bad shard doesn't stop the pool.
 
-    sql = "UPDATE aircraftreports SET itinerary_id = '{0}' WHERE aircraftreports.mode_s_hex = '{1}' " \
-          "AND aircraftreports.report_epoch BETWEEN {2} AND {3} ".format(itinerary_id,
-                                                                         mode_s_hex_for_update,
-                                                                         min_time,
-                                                                         max_time)
-    logger.debug('Assigning Itinerary ID with sql: {}'.format(sql))
+    :param itinerary_shard: tuple of (list of itinerary IDs, earliest first report epoch or None)
+    :return: tuple of (itineraries processed, patterns inserted, error message or None)
+    """
+    global dbconn
+    itinerary_ids, min_start_epoch = itinerary_shard
+    dbconn = pattern_worker_db_pool.get_thread_connection()
+    if not dbconn:
+        return len(itinerary_ids), 0, 'No DB Connection'
+
+    try:
+        return len(itinerary_ids), find_patterns_for_itineraries(itinerary_ids, min_start_epoch), None
+    except Exception as shard_error:
+        logger.exception('Issue finding patterns for a shard of {} itineraries'.format(len(itinerary_ids)))
+        try:
+            dbconn.rollback()
+        except:
+            pass
+        return len(itinerary_ids), 0, str(shard_error)
+
+
+def find_patterns_in_shards(config, itinerary_starts, num_workers):
+    """
+    Shard the itineraries across num_workers processes, each with its own DB connection, or analyse the shards in
+    this process with one worker. Itineraries are independent of each other, so the shards can finish in any order.
+
+    :param config: dict of the parsed config.yml, applied in each worker
+    :param itinerary_starts: list of tuples of (itinerary ID, first report epoch or None), as returned by
+        get_itinerary_ids_ended_between
+    :param num_workers: number of worker processes
+    :return: tuple of (patterns inserted, number of failed shards)
+    """
+    itinerary_shards = []
+    for shard_start in range(0, len(itinerary_starts), PATTERN_SHARD_SIZE):
+        shard_itinerary_starts = itinerary_starts[shard_start:shard_start + PATTERN_SHARD_SIZE]
+        itinerary_shards.append(([itinerary_start[0] for itinerary_start in shard_itinerary_starts],
+                                 get_shard_min_start_epoch(shard_itinerary_starts)))
+    logger.info('Finding patterns in {} itineraries in {} shards across {} worker processes'.format(
+        len(itinerary_starts), len(itinerary_shards), num_workers))
+
+    num_processed = 0
+    num_patterns = 0
+    num_failed_shards = 0
+
+    def record_shard_result(shard_result):
+        nonlocal num_processed, num_patterns, num_failed_shards
+        shard_processed, shard_patterns, shard_error = shard_result
+        num_processed += shard_processed
+        num_patterns += shard_patterns
+        if shard_error is not None:
+            num_failed_shards += 1
+            logger.error('Shard of {} itineraries failed: {}'.format(shard_processed, shard_error))
+
+        logger.info('Pattern progress: {}/{} itineraries, {} patterns found, {} failed shards'.format(
+            num_processed, len(itinerary_starts), num_patterns, num_failed_shards))
+
+    if num_workers <= 1:
+        for itinerary_ids, min_start_epoch in itinerary_shards:
+            try:
+                record_shard_result((len(itinerary_ids), find_patterns_for_itineraries(itinerary_ids, min_start_epoch),
+                                     None))
+            except Exception as shard_error:
+                logger.exception('Issue finding patterns for a shard of {} itineraries'.format(len(itinerary_ids)))
+                dbconn.rollback()
+                record_shard_result((len(itinerary_ids), 0, str(shard_error)))
+        return num_patterns, num_failed_shards
+
+    # Spawned rather than forked, so the workers don't get a copy of this process's DB connection
+    worker_pool = multiprocessing.get_context('spawn').Pool(processes=num_workers,
+                                                            initializer=init_pattern_worker,
+                                                            initargs=(config,))
+    try:
+        for shard_result in worker_pool.imap_unordered(find_patterns_for_shard_in_worker, itinerary_shards):
+            record_shard_result(shard_result)
+    finally:
+        worker_pool.close()
+        worker_pool.join()
+
+    return num_patterns, num_failed_shards
+
+
+def find_patterns_incrementally(config, full_rescan=False, num_workers=1):
+    """
+    Find the holding patterns of every itinerary that ended since the last run, and write them to aircraftpatterns.
 
-    itinerary_cursor.execute(sql)
+    Each run resumes from the watermark left by the previous one, the end of the latest itinerary it analysed. An
+    itinerary is only analysed once it's over: no reports for ITINERARY_MAX_TIME_DIFF_SECONDS, and (when the
+    itinerary job has run) ended before the itinerary job's own watermark, so all of its reports have their ID.
 
-    # commit the query for each of the itinerary assignments as we loop through them
+    :param config: dict of the parsed config.yml, applied in each worker
+    :param full_rescan: ignore the watermark and analyse every itinerary again
+    :param num_workers: number of worker processes
+    :return: tuple of (itineraries analysed, patterns inserted)
+    """
+    watermark_cursor = dbconn.cursor()
+    pg_utils.ensure_watermarks_table(watermark_cursor)
+    dbconn.commit()
+
+    watermark_epoch = None if full_rescan else pg_utils.read_watermark(watermark_cursor, PATTERN_JOB_NAME)
+    start_epoch = 0 if watermark_epoch is None else watermark_epoch
+    end_epoch = int(time.time()) - ITINERARY_MAX_TIME_DIFF_SECONDS
+    itinerary_watermark_epoch = pg_utils.read_watermark(watermark_cursor, ITINERARY_JOB_NAME)
+    if itinerary_watermark_epoch is not None:
+        end_epoch = min(end_epoch, itinerary_watermark_epoch)
+    dbconn.commit()
+
+    if end_epoch <= start_epoch:
+        logger.info('No itineraries have ended since the last run')
+        watermark_cursor.close()
+        return 0, 0
+
+    logger.info('Finding patterns in itineraries that ended from {} to {}'.format(
+        time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(start_epoch)),
+        time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(end_epoch))))
+
+    itinerary_starts = get_itinerary_ids_ended_between(start_epoch, end_epoch)
     dbconn.commit()
-    itinerary_cursor.close()
 
+    num_patterns, num_failed_shards = find_patterns_in_shards(config, itinerary_starts, num_workers)
 
+    if num_failed_shards:
+        # The failed itineraries aren't marked anywhere, so they're only retried if the watermark stays put
+        logger.error('{} shards failed, leaving the watermark where it was'.format(num_failed_shards))
+        watermark_cursor.close()
+        return len(itinerary_starts), num_patterns
+
+    # Never move the watermark backwards, e.g. on a full rescan
+    next_watermark_epoch = end_epoch if watermark_epoch is None else max(end_epoch, watermark_epoch)
+    pg_utils.write_watermark(watermark_cursor, PATTERN_JOB_NAME, next_watermark_epoch)
+    dbconn.commit()
+    watermark_cursor.close()
+
+    logger.info('Found {} patterns in {} itineraries, next run starts from {}'.format(
+        num_patterns, len(itinerary_starts),
+        time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(next_watermark_epoch))))
+
+    return len(itinerary_starts), num_patterns
+
+
+def main():
+    """
+    Load config.yml, connect to the DB and find the patterns. --full ignores the watermark and --workers=N overrides
+    patternworkers.
+    """
+    global dbconn
+    with open('../config.yml', 'r') as yaml_config_file:
+        config = yaml.safe_load(yaml_config_file)
+    apply_config(config)
+    dbconn = pg_utils.database_connection(**db_params)
 
-itinerary_id_list_to_process = get_all_unique_mode_s_without_itin_assigned()
+    num_workers = PATTERN_WORKERS
+    for arg in sys.argv[1:]:
+        if arg.startswith('--workers='):
+            num_workers = int(arg.split('=', 1)[1])
 
-num_to_process = len(mode_s_list_to_process)
+    find_patterns_incrementally(config, full_rescan='--full' in sys.argv, num_workers=num_workers)
 
-mode_s_count = 0
 
-for mode_s in mode_s_list_to_process:
-    mode_s_count += 1
-    logger.info('Calcing Itinerary IDs for Mode S: {} - Progress: {}/{}'.format(mode_s, mode_s_count, num_to_process))
+if __name__ == '__main__':
+    main()
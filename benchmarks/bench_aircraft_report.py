@@ -0,0 +1,94 @@
+"""
+Compares construction time and memory per report of AircraftReport against CompactAircraftReport, for both
+dump1090 and VRS records.
+
+Run from the repo root:
+    python -m benchmarks.bench_aircraft_report
+"""
+
+import logging
+import sys
+import timeit
+import tracemalloc
+
+from model import aircraft_report
+
+logging.basicConfig(level=logging.WARNING)
+
+NUM_REPORTS = 200000
+
+dump1090_record = {'hex': 'a1b2c3', 'squawk': '1200', 'flight': 'N123AB  ', 'lat': 35.123456, 'lon': -80.654321,
+                   'nucp': 7, 'seen_pos': 0.4, 'altitude': 12500, 'vert_rate': -640, 'track': 231, 'speed': 287,
+                   'category': 'A1', 'messages': 1832, 'seen': 0.1, 'rssi': -21.4}
+dump1090_snapshot_epoch = 1506817898.4
+
+vrs_record = {'PosTime': 1506817898412, 'Icao': 'a1b2c3', 'Alt': 24000, 'Spd': 410.2, 'Sqk': '4521',
+              'Trak': 92.5, 'Long': -81.144791, 'Lat': 36.547302, 'Gnd': False, 'CMsgs': 5120, 'Mlat': False,
+              'Call': 'DAL123', 'Vsi': 64}
+
+
+def build_original_dump1090():
+    return aircraft_report.AircraftReport(**dict(dump1090_record, time=dump1090_snapshot_epoch - 0.4))
+
+
+def build_compact_dump1090():
+    return aircraft_report.CompactAircraftReport.from_dump1090(dump1090_record,
+                                                                snapshot_epoch=dump1090_snapshot_epoch)
+
+
+def build_original_vrs():
+    return aircraft_report.AircraftReport(hex=vrs_record['Icao'].upper(),
+                                          time=vrs_record['PosTime'] / 1000,
+                                          speed=vrs_record['Spd'],
+                                          squawk=vrs_record['Sqk'],
+                                          flight=aircraft_report.flight_format.format(vrs_record['Call']),
+                                          altitude=vrs_record['Alt'],
+                                          isMetric=False,
+                                          track=vrs_record['Trak'],
+                                          lon=vrs_record['Long'],
+                                          lat=vrs_record['Lat'],
+                                          vert_rate=vrs_record['Vsi'],
+                                          seen=0,
+                                          validposition=1,
+                                          validtrack=1,
+                                          reporter="",
+                                          mlat=vrs_record['Mlat'],
+                                          is_ground=vrs_record['Gnd'],
+                                          report_location=None,
+                                          messages=vrs_record['CMsgs'],
+                                          seen_pos=0,
+                                          category=None)
+
+
+def build_compact_vrs():
+    return aircraft_report.CompactAircraftReport.from_vrs(vrs_record, seen=0, seen_pos=0)
+
+
+def time_per_report_usec(build_function):
+    best_run_sec = min(timeit.repeat(build_function, number=NUM_REPORTS, repeat=3))
+    return best_run_sec / NUM_REPORTS * 1e6
+
+
+def memory_per_report_bytes(build_function):
+    tracemalloc.start()
+    reports_list = [build_function() for _ in range(NUM_REPORTS)]
+    current_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del reports_list
+    return current_bytes / NUM_REPORTS
+
+
+def run_benchmarks():
+    print('Python {}, {} reports per run'.format(sys.version.split()[0], NUM_REPORTS))
+    print('{:<30}{:>16}{:>20}'.format('', 'usec/report', 'bytes/report'))
+    for label, build_function in [('AircraftReport dump1090', build_original_dump1090),
+                                  ('CompactAircraftReport dump1090', build_compact_dump1090),
+                                  ('AircraftReport VRS', build_original_vrs),
+                                  ('CompactAircraftReport VRS', build_compact_vrs)]:
+        print('{:<30}{:>16.2f}{:>20.0f}'.format(label,
+                                                time_per_report_usec(build_function),
+                                                memory_per_report_bytes(build_function)))
+
+
+if __name__ == '__main__':
+    run_benchmarks()
@@ -0,0 +1,66 @@
+"""
+Compares expanding VRS archive short trails ('Cos') one point at a time into CompactAircraftReports against the
+vectorised ReportBatch.from_vrs_trails.
+
+Run from the repo root:
+    python -m benchmarks.bench_archive_trails
+"""
+
+import logging
+import random
+import time
+
+from model import aircraft_report
+from model import report_batch
+
+logging.basicConfig(level=logging.WARNING)
+
+NUM_RECORDS = 20000
+MAX_TRAIL_POINTS = 40
+BOUNDING_BOX = (32.0, 38.0, -83.0, -77.0)
+
+
+def build_archive_records():
+    random.seed(1)
+    archive_records = []
+    for record_num in range(NUM_RECORDS):
+        past_track = []
+        for point_num in range(random.randint(0, MAX_TRAIL_POINTS)):
+            past_track += [random.uniform(30, 40), random.uniform(-85, -75), 1506817898412.0 + point_num * 1000,
+                           random.choice([24000.0, 31000.0, None])]
+        archive_records.append({'PosTime': 1506817898412, 'Icao': 'a{:05x}'.format(record_num), 'Alt': 24000,
+                                'Spd': 410.2, 'Sqk': '4521', 'Trak': 92.5, 'Long': -81.1, 'Lat': 36.5, 'Gnd': False,
+                                'CMsgs': 5120, 'Mlat': False, 'Call': 'DAL123', 'TT': 'a', 'Cos': past_track})
+    return archive_records
+
+
+def expand_trails_per_point(archive_records):
+    minlat83, maxlat83, minlong83, maxlong83 = BOUNDING_BOX
+    reports_list = []
+    for aircraft_record in archive_records:
+        past_track = aircraft_record['Cos']
+        for past_track_reading_index in range(len(past_track) // 4):
+            if past_track[(past_track_reading_index * 4) + 3]:
+                lat83 = past_track[(past_track_reading_index * 4) + 0]
+                long83 = past_track[(past_track_reading_index * 4) + 1]
+                if lat83 < minlat83 or lat83 > maxlat83 or long83 < minlong83 or long83 > maxlong83:
+                    continue
+                reports_list.append(aircraft_report.CompactAircraftReport.from_vrs(
+                    aircraft_record, seen=0, seen_pos=0, missing_flight='',
+                    report_time=past_track[(past_track_reading_index * 4) + 2] / 1000,
+                    lat=lat83, lon=long83, altitude=past_track[(past_track_reading_index * 4) + 3]))
+    return reports_list
+
+
+def run_benchmarks():
+    archive_records = build_archive_records()
+    for label, expand_function in [('per point', expand_trails_per_point),
+                                   ('vectorised', lambda records: report_batch.ReportBatch.from_vrs_trails(
+                                       records, *BOUNDING_BOX))]:
+        start_time = time.time()
+        num_reports = len(expand_function(archive_records))
+        print('{:<12}{:>10} reports{:>10.3f} sec'.format(label, num_reports, time.time() - start_time))
+
+
+if __name__ == '__main__':
+    run_benchmarks()
@@ -0,0 +1,77 @@
+"""
+Compares great circle distances computed one pair at a time with utils.mathutils.haversine_distance_meters against
+the vectorised utils.mathutils.distance_meters, one-to-many (a receiver to every report) and many-to-many (pairs
+of reports, and a distance matrix), and times the vectorised bearing, destination and cross-track functions.
+
+Run from the repo root:
+    python -m benchmarks.bench_geodesy
+"""
+
+import logging
+import time
+
+import numpy as np
+
+from utils import mathutils
+
+logging.basicConfig(level=logging.WARNING)
+
+NUM_POINTS = 1000000
+MATRIX_SIZE = 2000
+RECEIVER_LOCATION = (-80.9, 35.2)
+BOUNDING_BOX = (32.0, 38.0, -83.0, -77.0)
+
+
+def build_points(num_points, seed):
+    np.random.seed(seed)
+    minlat83, maxlat83, minlong83, maxlong83 = BOUNDING_BOX
+    return np.random.uniform(minlong83, maxlong83, num_points), np.random.uniform(minlat83, maxlat83, num_points)
+
+
+def time_call(label, num_results, function, *args):
+    start_time = time.time()
+    result = function(*args)
+    elapsed_sec = time.time() - start_time
+    print('{:<36}{:>12}{:>12.3f}{:>14.3f}'.format(label, num_results, elapsed_sec, elapsed_sec / num_results * 1e9))
+    return result
+
+
+def run_benchmarks():
+    lons, lats = build_points(NUM_POINTS, 1)
+    other_lons, other_lats = build_points(NUM_POINTS, 2)
+    receiver_lon, receiver_lat = RECEIVER_LOCATION
+    lon_list, lat_list = lons.tolist(), lats.tolist()
+    other_lon_list, other_lat_list = other_lons.tolist(), other_lats.tolist()
+
+    print('{:<36}{:>12}{:>12}{:>14}'.format('', 'results', 'sec', 'nsec/result'))
+
+    scalar_one_to_many = time_call(
+        'scalar one-to-many distance', NUM_POINTS,
+        lambda: [mathutils.haversine_distance_meters(receiver_lon, receiver_lat, lon, lat)
+                 for lon, lat in zip(lon_list, lat_list)])
+    vectorised_one_to_many = time_call('vectorised one-to-many distance', NUM_POINTS,
+                                       mathutils.distance_meters, receiver_lon, receiver_lat, lons, lats)
+
+    scalar_pairs = time_call(
+        'scalar pairwise distance', NUM_POINTS,
+        lambda: [mathutils.haversine_distance_meters(lon, lat, other_lon, other_lat)
+                 for lon, lat, other_lon, other_lat in zip(lon_list, lat_list, other_lon_list, other_lat_list)])
+    vectorised_pairs = time_call('vectorised pairwise distance', NUM_POINTS,
+                                 mathutils.distance_meters, lons, lats, other_lons, other_lats)
+
+    time_call('vectorised distance matrix', MATRIX_SIZE * MATRIX_SIZE, mathutils.distance_matrix_meters,
+              lons[:MATRIX_SIZE], lats[:MATRIX_SIZE], other_lons[:MATRIX_SIZE], other_lats[:MATRIX_SIZE])
+    bearings = time_call('vectorised initial bearing', NUM_POINTS,
+                         mathutils.initial_bearing_degrees, receiver_lon, receiver_lat, lons, lats)
+    time_call('vectorised destination point', NUM_POINTS,
+              mathutils.destination_point, receiver_lon, receiver_lat, bearings, vectorised_one_to_many)
+    time_call('vectorised cross-track distance', NUM_POINTS, mathutils.cross_track_distance_meters,
+              other_lons, other_lats, receiver_lon, receiver_lat, lons, lats)
+
+    print('Max difference from scalar: {:.2e} m one-to-many, {:.2e} m pairwise'.format(
+        np.max(np.abs(vectorised_one_to_many - np.array(scalar_one_to_many))),
+        np.max(np.abs(vectorised_pairs - np.array(scalar_pairs)))))
+
+
+if __name__ == '__main__':
+    run_benchmarks()
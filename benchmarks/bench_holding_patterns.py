@@ -0,0 +1,169 @@
+"""
+Times model.holding_pattern.find_holding_patterns on synthetic holding and cross country tracks of increasing
+length, against the same walk testing every new segment against the whole line (no grid). The two have to find
+the same patterns. This shows what the grid saves, but isn't a comparison with find_pattern_num itself.
+
+With --validate=N, compares the patterns of the N longest itineraries of the last week in the DB of config.yml
+with the find_pattern_num function of sql/pattern_finder.sql (which has to be loaded), and times find_pattern_num
+against fetching the track and running find_holding_patterns. Pattern counts and vertex counts should match.
+Centroids of patterns made of several partly overlapping loops can differ, see model/holding_pattern.py.
+
+Run from the repo root:
+    python -m benchmarks.bench_holding_patterns [--validate=N]
+"""
+
+import logging
+import math
+import sys
+import time
+
+import numpy as np
+
+from model import holding_pattern
+from utils import mathutils
+
+logging.basicConfig(level=logging.WARNING)
+
+HOLD_TRACK_LENGTHS = [1000, 10000, 100000]
+CROSS_COUNTRY_TRACK_LENGTHS = [1000, 5000, 20000]
+POINTS_PER_LAP = 120
+HOLD_CENTRE = (-80.9, 35.2)
+
+# A validated pattern's centroid may differ from the SQL one by this much
+MAX_CENTROID_DIFF_METERS = 50.0
+
+
+def build_holding_track(num_points):
+    """
+    :return: tuple of (lons, lats) of a racetrack hold flown for num_points points, drifting with the wind
+    """
+    np.random.seed(1)
+    lap_position = np.arange(num_points) % POINTS_PER_LAP / float(POINTS_PER_LAP)
+    angles = 2 * math.pi * lap_position
+    lons = HOLD_CENTRE[0] + 0.08 * np.clip(1.6 * np.cos(angles), -1, 1) + np.arange(num_points) * 2e-6
+    lats = HOLD_CENTRE[1] + 0.03 * np.sin(angles)
+    return lons + np.random.normal(0, 2e-4, num_points), lats + np.random.normal(0, 2e-4, num_points)
+
+
+def build_cross_country_track(num_points):
+    """
+    :return: tuple of (lons, lats) of a track that never crosses itself, so the line is never reset
+    """
+    np.random.seed(1)
+    lons = HOLD_CENTRE[0] + np.arange(num_points) * 2e-3
+    lats = HOLD_CENTRE[1] + 0.02 * np.sin(np.arange(num_points) / 50.0)
+    return lons, lats + np.random.normal(0, 2e-5, num_points)
+
+
+def find_holding_patterns_without_grid(lons, lats):
+    # A single cell, so every new segment is tested against the whole line
+    return holding_pattern.find_holding_patterns(lons, lats, cell_size=1e9)
+
+
+def run_benchmarks():
+    print('{:<16}{:>10}{:>10}{:>14}{:>14}'.format('track', 'points', 'patterns', 'grid sec', 'no grid sec'))
+    for label, build_track, num_points in ([('hold', build_holding_track, num_points)
+                                            for num_points in HOLD_TRACK_LENGTHS] +
+                                           [('cross country', build_cross_country_track, num_points)
+                                            for num_points in CROSS_COUNTRY_TRACK_LENGTHS]):
+        lons, lats = build_track(num_points)
+
+        start_time = time.time()
+        patterns = holding_pattern.find_holding_patterns(lons, lats)
+        grid_sec = time.time() - start_time
+
+        start_time = time.time()
+        patterns_without_grid = find_holding_patterns_without_grid(lons, lats)
+        no_grid_sec = time.time() - start_time
+
+        if [(pattern.point_index, pattern.num_vertices) for pattern in patterns] != \
+                [(pattern.point_index, pattern.num_vertices) for pattern in patterns_without_grid]:
+            print('Grid and no grid patterns differ for the {} track of {} points'.format(label, num_points))
+        print('{:<16}{:>10}{:>10}{:>14.3f}{:>14.3f}'.format(label, num_points, len(patterns), grid_sec, no_grid_sec))
+
+
+def validate_against_sql(num_itineraries):
+    """
+    Compare the patterns found for the longest of a sample of itineraries with find_pattern_num's. The pattern
+    count, vertex counts and centroids (within MAX_CENTROID_DIFF_METERS) have to match.
+    """
+    import yaml
+
+    from utils import postgres as pg_utils
+
+    with open('config.yml', 'r') as yaml_config_file:
+        config = yaml.safe_load(yaml_config_file)
+
+    dbconn = pg_utils.database_connection(dbname=config['database']['dbname'],
+                                          dbhost=config['database']['hostname'],
+                                          dbport=config['database']['port'],
+                                          dbuser=config['database']['user'],
+                                          dbpasswd=config['database']['pwd'])
+    cur = dbconn.cursor()
+    cur.execute('''SELECT itinerary_id
+                     FROM aircraftreports
+                     WHERE itinerary_id IS NOT NULL
+                       AND report_epoch >= %s
+                     GROUP BY itinerary_id
+                     ORDER BY count(*) DESC
+                     LIMIT %s''', (int(time.time()) - 7 * 24 * 60 * 60, num_itineraries))
+    itinerary_ids = [itinerary_row[0] for itinerary_row in cur.fetchall()]
+
+    num_mismatched = 0
+    total_sql_sec = 0.0
+    total_fetch_sec = 0.0
+    total_numpy_sec = 0.0
+    print('{:<40}{:>8}{:>8}{:>8}{:>10}{:>12}{:>12}'.format('itinerary', 'points', 'sql', 'numpy', 'sql sec',
+                                                            'fetch sec', 'numpy sec'))
+    for itinerary_id in itinerary_ids:
+        start_time = time.time()
+        cur.execute('''SELECT patternnumber, ST_X(patterncentroid), ST_Y(patterncentroid), patternnumvertices
+                         FROM find_pattern_num(%s)''', (itinerary_id,))
+        sql_patterns = cur.fetchall()
+        sql_sec = time.time() - start_time
+
+        # find_pattern_num reads the track itself, so fetching it counts against the NumPy version too
+        start_time = time.time()
+        cur.execute('''SELECT ST_X(report_location::GEOMETRY), ST_Y(report_location::GEOMETRY)
+                         FROM aircraftreports
+                         WHERE itinerary_id = %s
+                         ORDER BY report_epoch''', (itinerary_id,))
+        track = np.array(cur.fetchall(), dtype=np.float64).reshape(-1, 2)
+        fetch_sec = time.time() - start_time
+
+        start_time = time.time()
+        patterns = holding_pattern.find_holding_patterns(track[:, 0], track[:, 1])
+        numpy_sec = time.time() - start_time
+
+        total_sql_sec += sql_sec
+        total_fetch_sec += fetch_sec
+        total_numpy_sec += numpy_sec
+        print('{:<40}{:>8}{:>8}{:>8}{:>10.3f}{:>12.3f}{:>12.3f}'.format(itinerary_id, len(track), len(sql_patterns),
+                                                                         len(patterns), sql_sec, fetch_sec,
+                                                                         numpy_sec))
+
+        is_match = len(sql_patterns) == len(patterns)
+        for sql_pattern, pattern in zip(sql_patterns, patterns):
+            _, sql_centroid_lon, sql_centroid_lat, sql_num_vertices = sql_pattern
+            centroid_diff_meters = mathutils.haversine_distance_meters(sql_centroid_lon, sql_centroid_lat,
+                                                                       pattern.centroid[0], pattern.centroid[1])
+            if sql_num_vertices != pattern.num_vertices or centroid_diff_meters > MAX_CENTROID_DIFF_METERS:
+                is_match = False
+        if not is_match:
+            num_mismatched += 1
+            print('  mismatch, sql: {}, numpy: {}'.format(sql_patterns, patterns))
+
+    dbconn.rollback()
+    cur.close()
+    dbconn.close()
+    print('{} of {} itineraries mismatched, {:.3f} sec in find_pattern_num, {:.3f} sec fetching tracks and {:.3f} '
+          'sec in find_holding_patterns ({:.1f}x faster)'.format(
+              num_mismatched, len(itinerary_ids), total_sql_sec, total_fetch_sec, total_numpy_sec,
+              total_sql_sec / max(total_fetch_sec + total_numpy_sec, 1e-9)))
+
+
+if __name__ == '__main__':
+    run_benchmarks()
+    for arg in sys.argv[1:]:
+        if arg.startswith('--validate='):
+            validate_against_sql(int(arg.split('=', 1)[1]))
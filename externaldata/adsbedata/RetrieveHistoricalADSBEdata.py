@@ -7,12 +7,14 @@ import datetime
 import io
 import logging
 import os
+import tempfile
 import zipfile
 
 import requests
 import yaml
 
 from model import aircraft_report
+from model import report_partitions
 
 logger = logging.getLogger(__name__)
 parent_dir = os.path.dirname(os.path.realpath(__file__))
@@ -29,6 +31,10 @@ def get_config():
         return yaml.load(yaml_config_file)
 
 
+# Bytes per chunk when streaming an archive download to disk
+download_chunk_size = 1024 * 1024
+
+
 def get_and_load_archive_data_by_date(zip_url, zip_filename):
     logger.info('Getting and Loading Archive Data for URL: {}'.format(zip_url))
     extract_dir = zip_filename[:-4]
@@ -49,7 +55,66 @@ def get_and_load_archive_data_by_date(zip_url, zip_filename):
                                                  minlat83=minlat83,
                                                  maxlat83=maxlat83,
                                                  minlong83=minlong83,
-                                                 maxlong83=maxlong83)
+                                                 maxlong83=maxlong83,
+                                                 batch_size=bulk_load_batch_size,
+                                                 num_workers=archive_num_workers,
+                                                 streaming=archive_streaming,
+                                                 db_params=get_db_params(local_config),
+                                                 partition_interval=partition_interval)
+
+
+def stream_and_load_archive_zip_by_date(zip_url, zip_filename):
+    """
+    Stream the archive zip download into a temp file and load its JSON members straight out of the zip, without
+    holding the download in memory or extracting anything to disk. The temp file is removed once it's loaded, unless
+    any of its files were malformed or failed to load.
+    """
+    logger.info('Streaming and Loading Archive Data for URL: {}'.format(zip_url))
+    if not os.path.exists(zip_dir):
+        os.makedirs(zip_dir)
+
+    # delete=False so that the ingest worker processes can open the zip by name on Windows too
+    with tempfile.NamedTemporaryFile(prefix=zip_filename[:-4] + '_', suffix='.zip', dir=zip_dir,
+                                     delete=False) as temp_zip_file:
+        temp_zip_path = temp_zip_file.name
+        with requests.get(zip_url, stream=True) as req:
+            req.raise_for_status()
+            for download_chunk in req.iter_content(chunk_size=download_chunk_size):
+                temp_zip_file.write(download_chunk)
+
+    ingest_summary = aircraft_report.get_aircraft_data_from_zip(temp_zip_path,
+                                                                minlat83=minlat83,
+                                                                maxlat83=maxlat83,
+                                                                minlong83=minlong83,
+                                                                maxlong83=maxlong83,
+                                                                batch_size=bulk_load_batch_size,
+                                                                num_workers=archive_num_workers,
+                                                                streaming=archive_streaming,
+                                                                db_params=get_db_params(local_config),
+                                                                partition_interval=partition_interval)
+
+    if ingest_summary['malformed_json_files'] or ingest_summary['failed_json_files']:
+        # Keep the download so the files that didn't load can be looked at, or loaded again, without fetching it
+        logger.warning('Keeping {} - {} malformed and {} failed JSON files'.format(
+            temp_zip_path, len(ingest_summary['malformed_json_files']), len(ingest_summary['failed_json_files'])))
+    else:
+        os.remove(temp_zip_path)
+
+
+def get_db_params(config):
+    """
+    Connection settings for the archive ingest worker processes, which each open their own DB connection
+
+    :param config: dict of the parsed config.yml
+    :return: dict of utils.postgres.database_connection keyword args, or None if there's no database section
+    """
+    if 'database' not in config:
+        return None
+    return {'dbname': config['database']['dbname'],
+            'dbhost': config['database']['hostname'],
+            'dbport': config['database']['port'],
+            'dbuser': config['database']['user'],
+            'dbpasswd': config['database']['pwd']}
 
 
 def get_list_of_datestamps_inclusive(start_date, end_date):
@@ -71,14 +136,26 @@ minlat83 = local_config['archiveboundingbox']['minlat83']
 maxlat83 = local_config['archiveboundingbox']['maxlat83']
 minlong83 = local_config['archiveboundingbox']['minlong83']
 maxlong83 = local_config['archiveboundingbox']['maxlong83']
+bulk_load_batch_size = local_config.get('bulkloadbatchsize', aircraft_report.bulk_load_batch_size)
+archive_num_workers = local_config.get('archiveworkers', 1)
+archive_streaming = local_config.get('archivestreaming', False)
+archive_extract = local_config.get('archiveextract', False)
+# The archive's days are loaded into partitions of their own, with the same interval as the live ones
+partition_interval = local_config.get('partitions', {}).get('interval', report_partitions.default_partition_interval)
 
 start_date = local_config['startdate']
 end_date = local_config['enddate']
 
-datestamps_list = get_list_of_datestamps_inclusive(start_date, end_date)
-
-for datestamp in datestamps_list:
-    logger.info('Retrieving data for datestamp: {}'.format(datestamp))
-    zip_name = '{}.zip'.format(datestamp)
-    archive_dl_url = archive_base_url + zip_name
-    get_and_load_archive_data_by_date(archive_dl_url, zip_name)
+# The ingest worker processes re-import this module on platforms that spawn them (Windows), so only
+# kick off the downloads in the parent process
+if __name__ == '__main__':
+    datestamps_list = get_list_of_datestamps_inclusive(start_date, end_date)
+
+    for datestamp in datestamps_list:
+        logger.info('Retrieving data for datestamp: {}'.format(datestamp))
+        zip_name = '{}.zip'.format(datestamp)
+        archive_dl_url = archive_base_url + zip_name
+        if archive_extract:
+            get_and_load_archive_data_by_date(archive_dl_url, zip_name)
+        else:
+            stream_and_load_archive_zip_by_date(archive_dl_url, zip_name)
@@ -1,13 +1,22 @@
 # Stub out some common entry points to later convert to tests after everything is wired up together
 
 import logging
+import threading
 import time
 import os
 import yaml
 import sys
 
-from model import aircraft_report
+from model import aircraft_state_cache
+from model import ingest_pipeline
+from model import itinerary_tracker
+from model import pattern_alerts
+from model import receiver_poller
+from model import report_bus
+from model import report_partitions
 from model import report_receiver
+from model import report_spool
+from model import sbs_stream
 from utils import postgres as pg_utils
 
 
@@ -15,19 +24,11 @@ with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'config.yml'
     config = yaml.load(yaml_config_file)
 
 # log_formatter = logging.Formatter("%(levelname)s: %(asctime)s - %(name)s - %(process)s - %(message)s")
-FORMAT = '%(asctime)-15s %(levelname)s: %(message)s'
+FORMAT = '%(asctime)-15s %(levelname)s: %(threadName)s: %(message)s'
 logging.basicConfig(level=logging.INFO, format=FORMAT)
 logger = logging.getLogger(__name__)
 
 # config vars
-aircraft_data_url1 = config['feed1']['url']
-receiver1_lat83 = config['receiver1']['lat83']
-receiver1_long83 = config['receiver1']['long83']
-
-aircraft_data_url2 = config['feed2']['url']
-receiver2_lat83 = config['receiver2']['lat83']
-receiver2_long83 = config['receiver2']['long83']
-
 db_hostname = config['database']['hostname']
 db_port = config['database']['port']
 db_name = config['database']['dbname']
@@ -38,56 +39,357 @@ sleep_time_sec = config['waittimesec']
 
 total_samples_cutoff_val = config['samplescutoff']
 
-postgres_db_connection = pg_utils.database_connection(dbname=db_name,
-                                                      dbhost=db_hostname,
-                                                      dbport=db_port,
-                                                      dbuser=db_user,
-                                                      dbpasswd=db_pwd)
+request_timeout_sec = config.get('requesttimeoutsec', receiver_poller.default_request_timeout_sec)
+
+failure_wait_sec = config.get('failurewaitsec', receiver_poller.default_failure_wait_sec)
+
+sbs_flush_interval_sec = config.get('sbsflushsec', sbs_stream.default_flush_interval_sec)
+
+state_cache_ttl_sec = config.get('statecachettlsec', aircraft_state_cache.default_state_ttl_sec)
+
+pipeline_config = config.get('pipeline', {})
+
+spool_config = config.get('spool', {})
+
+bus_config = config.get('bus', {})
+
+partitions_config = config.get('partitions', {})
+
+stamp_itineraries = config.get('stampitineraries', False)
+
+pattern_alerts_config = config.get('patternalerts', {})
+
+
+# Session settings for the ingest role's connections, e.g. synchronous_commit: 'off'
+ingest_session_settings = config['database'].get('roles', {}).get('ingest', {})
+
+ingest_db_pool = pg_utils.get_connection_pool(
+    'ingest',
+    dbname=db_name,
+    dbhost=db_hostname,
+    dbport=db_port,
+    dbuser=db_user,
+    dbpasswd=db_pwd,
+    max_connections=config['database'].get('maxconnections', pg_utils.default_max_connections),
+    session_settings=ingest_session_settings,
+    checkout_timeout_sec=config['database'].get('checkouttimeoutsec'))
+
+
+def connect_to_db():
+    """
+    :return: a connection checked out of the ingest pool, or None if the database can't be reached
+    """
+    return ingest_db_pool.getconn()
+
+
+postgres_db_connection = connect_to_db()
+
+
+def get_receiver_configs(config):
+    """
+    Build the list of receiver settings from the config. Receivers are listed under the 'receivers' key, each
+    with a name, url, lat83, long83 and an optional waittimesec, minwaittimesec and maxwaittimesec. Older
+    configs with numbered feedN/receiverN pairs are still supported.
+
+    :param config: dict of the parsed config.yml
+    :return: list of dicts with name, url, lat83, long83, waittimesec, minwaittimesec and maxwaittimesec keys
+    """
+    receiver_configs = []
+
+    if 'receivers' in config:
+        for receiver_config in config['receivers']:
+            wait_time_sec = receiver_config.get('waittimesec', config['waittimesec'])
+            min_wait_time_sec = receiver_config.get('minwaittimesec', config.get('minwaittimesec', wait_time_sec))
+            max_wait_time_sec = receiver_config.get('maxwaittimesec', config.get('maxwaittimesec', wait_time_sec))
+            receiver_configs.append({'name': receiver_config['name'],
+                                     'url': receiver_config['url'],
+                                     'lat83': receiver_config['lat83'],
+                                     'long83': receiver_config['long83'],
+                                     'waittimesec': wait_time_sec,
+                                     'minwaittimesec': min_wait_time_sec,
+                                     'maxwaittimesec': max_wait_time_sec})
+        return receiver_configs
+
+    receiver_num = 1
+    while 'feed{}'.format(receiver_num) in config:
+        receiver_configs.append({'name': 'piaware{}'.format(receiver_num),
+                                 'url': config['feed{}'.format(receiver_num)]['url'],
+                                 'lat83': config['receiver{}'.format(receiver_num)]['lat83'],
+                                 'long83': config['receiver{}'.format(receiver_num)]['long83'],
+                                 'waittimesec': config['waittimesec'],
+                                 'minwaittimesec': config.get('minwaittimesec', config['waittimesec']),
+                                 'maxwaittimesec': config.get('maxwaittimesec', config['waittimesec'])})
+        receiver_num += 1
+
+    return receiver_configs
+
+
+def build_itinerary_tracker():
+    """
+    Create the tracker that stamps itinerary IDs on the reports as they're written, restoring the itineraries in
+    progress from the DB, if enabled in the config
+
+    :return: ItineraryTracker, or None if itineraries are left to the batch job
+    """
+    if not stamp_itineraries:
+        return None
+
+    tracker = itinerary_tracker.ItineraryTracker(max_gap_sec=config.get('itinerarymaxtimediffseconds',
+                                                                        itinerary_tracker.default_max_gap_sec))
+    with ingest_db_pool.connection() as dbconn:
+        if dbconn:
+            try:
+                tracker.restore_from_db(dbconn)
+            except:
+                logger.exception('Issue restoring itineraries from DB, starting without them')
+                dbconn.rollback()
+        else:
+            logger.error('No DB Connection. Itineraries in progress weren\'t restored')
+    return tracker
+
+
+def build_pattern_monitor():
+    """
+    :return: PatternAlertMonitor checking the live reports for holding patterns, or None if disabled in the config
+    """
+    if not pattern_alerts_config.get('enabled', False):
+        return None
+    return pattern_alerts.get_pattern_alert_monitor(pattern_alerts_config)
 
-radio_receiver_1 = report_receiver.RadioReceiver(name='piaware1',
-                                                 type='raspi',
-                                                 lat83=receiver1_lat83,
-                                                 long83=receiver1_long83,
-                                                 data_access_url='',
-                                                 location="")
 
-radio_receiver_2 = report_receiver.RadioReceiver(name='piaware2',
-                                                 type='raspi',
-                                                 lat83=receiver2_lat83,
-                                                 long83=receiver2_long83,
-                                                 data_access_url='',
-                                                 location="")
+def build_receiver_pollers(spool=None, bus=None, tracker=None, monitor=None):
+    """
+    Create a RadioReceiver and a ReceiverPoller, with its own DB connection, for every receiver in the config.
+    Receivers with a tcp:// url get an SbsStreamReceiver reading their SBS-1 output instead.
+
+    :param spool: optional ReportSpool for reports that can't be loaded while the DB is down
+    :param bus: optional ReportBus to publish the reports to instead of loading them into the DB
+    :param tracker: optional ItineraryTracker to stamp the reports' itinerary IDs with
+    :param monitor: optional PatternAlertMonitor to check the reports for holding patterns
+    :return: list of ReceiverPoller objects
+    """
+    receiver_pollers = []
+    for receiver_config in get_receiver_configs(config):
+        radio_receiver = build_radio_receiver(receiver_config)
+
+        report_producer = None
+        if bus is not None:
+            report_producer = bus.get_producer(report_bus.get_default_partition_name(radio_receiver))
+
+        poller_kwargs = {'radio_receiver': radio_receiver,
+                         'dbconn': connect_to_db() if bus is None else None,
+                         'max_samples': total_samples_cutoff_val,
+                         'request_timeout_sec': request_timeout_sec,
+                         'failure_wait_sec': failure_wait_sec,
+                         'state_ttl_sec': state_cache_ttl_sec,
+                         'report_spool': spool,
+                         'db_connect': connect_to_db,
+                         'report_producer': report_producer,
+                         'itinerary_tracker': tracker,
+                         'pattern_monitor': monitor}
+
+        sbs_address = sbs_stream.parse_sbs_url(receiver_config['url'])
+        if sbs_address is not None:
+            receiver_pollers.append(sbs_stream.SbsStreamReceiver(host=sbs_address[0],
+                                                                 port=sbs_address[1],
+                                                                 flush_interval_sec=sbs_flush_interval_sec,
+                                                                 **poller_kwargs))
+        else:
+            receiver_pollers.append(receiver_poller.ReceiverPoller(
+                poll_interval_sec=receiver_config['waittimesec'],
+                min_poll_interval_sec=receiver_config['minwaittimesec'],
+                max_poll_interval_sec=receiver_config['maxwaittimesec'],
+                **poller_kwargs))
+
+    return receiver_pollers
+
+
+def build_radio_receiver(receiver_config):
+    return report_receiver.RadioReceiver(name=receiver_config['name'],
+                                         type='raspi',
+                                         lat83=receiver_config['lat83'],
+                                         long83=receiver_config['long83'],
+                                         data_access_url=receiver_config['url'],
+                                         location="")
+
+
+def build_ingest_pipeline(spool=None, tracker=None, monitor=None):
+    """
+    Create the staged fetch -> parse -> write pipeline, with a fetcher for every receiver in the config and one
+    DB connection for the writer
+
+    :param spool: optional ReportSpool for reports that are dropped or can't be written while the DB is down
+    :param tracker: optional ItineraryTracker to stamp the reports' itinerary IDs with
+    :param monitor: optional PatternAlertMonitor to check the reports for holding patterns
+    :return: IngestPipeline
+    """
+    pipeline = ingest_pipeline.IngestPipeline(
+        dbconn=postgres_db_connection,
+        snapshot_queue_size=pipeline_config.get('snapshotqueuesize', ingest_pipeline.default_queue_size),
+        report_queue_size=pipeline_config.get('reportqueuesize', ingest_pipeline.default_queue_size),
+        drop_policy=pipeline_config.get('droppolicy', ingest_pipeline.default_drop_policy),
+        put_timeout_sec=pipeline_config.get('puttimeoutsec'),
+        max_coalesce_polls=pipeline_config.get('coalescepolls', ingest_pipeline.default_max_coalesce_polls),
+        max_coalesce_sec=pipeline_config.get('coalescesec', ingest_pipeline.default_max_coalesce_sec),
+        state_ttl_sec=state_cache_ttl_sec,
+        report_spool=spool,
+        db_connect=connect_to_db,
+        itinerary_tracker=tracker,
+        pattern_monitor=monitor)
+
+    for receiver_config in get_receiver_configs(config):
+        sbs_address = sbs_stream.parse_sbs_url(receiver_config['url'])
+        if sbs_address is not None:
+            pipeline.add_stream_receiver(sbs_stream.SbsStreamReceiver,
+                                         build_radio_receiver(receiver_config),
+                                         max_samples=total_samples_cutoff_val,
+                                         host=sbs_address[0],
+                                         port=sbs_address[1],
+                                         flush_interval_sec=sbs_flush_interval_sec,
+                                         request_timeout_sec=request_timeout_sec,
+                                         failure_wait_sec=failure_wait_sec)
+            continue
+
+        pipeline.add_receiver(build_radio_receiver(receiver_config),
+                              poll_interval_sec=receiver_config['waittimesec'],
+                              max_samples=total_samples_cutoff_val,
+                              min_poll_interval_sec=receiver_config['minwaittimesec'],
+                              max_poll_interval_sec=receiver_config['maxwaittimesec'],
+                              request_timeout_sec=request_timeout_sec,
+                              failure_wait_sec=failure_wait_sec)
+
+    return pipeline
+
+
+def build_report_spool(tracker=None):
+    """
+    Create the on-disk report spool and start its replayer, if the spool is enabled in the config
+
+    :param tracker: optional ItineraryTracker to stamp the replayed reports' itinerary IDs with
+    :return: tuple of (ReportSpool, SpoolReplayer), or (None, None) if the spool is disabled
+    """
+    if not spool_config.get('enabled', False):
+        return None, None
+
+    spool = report_spool.ReportSpool(spool_dir=spool_config['dir'],
+                                     segment_max_bytes=spool_config.get('segmentmaxbytes',
+                                                                        report_spool.default_segment_max_bytes))
+    replayer = report_spool.SpoolReplayer(
+        spool,
+        db_connect=connect_to_db,
+        batch_size=spool_config.get('replaybatchsize', report_spool.default_replay_batch_size),
+        replay_interval_sec=spool_config.get('replayintervalsec', report_spool.default_replay_interval_sec),
+        itinerary_tracker=tracker)
+    replayer.start()
+    logger.info('Spooling reports that can\'t be written to {}, {} bytes waiting to be replayed'.format(
+        spool_config['dir'], spool.get_backlog_bytes()))
+
+    return spool, replayer
+
+
+def build_partition_manager():
+    """
+    Start maintaining the report_epoch partitions of aircraftreports in the background, if enabled in the config
+
+    :return: ReportPartitionManager, or None if partition maintenance is disabled
+    """
+    if not partitions_config.get('enabled', True):
+        return None
+
+    partition_manager = report_partitions.get_partition_manager(partitions_config, db_connect=connect_to_db)
+    partition_manager.start()
+    return partition_manager
 
 
 def harvest_aircraft_json_from_pi():
     logger.info('Aircraft ingest beginning.')
-    total_samples_count = 0
-    failure_num = 0
-    while total_samples_count < total_samples_cutoff_val:
-        try:
-            start_time = time.time()
-
-            current_reports_list = aircraft_report.get_aircraft_data_from_url(aircraft_data_url1)
-            if len(current_reports_list) > 0:
-                aircraft_report.load_aircraft_reports_list_into_db(
-                    aircraft_reports_list=current_reports_list,
-                    radio_receiver=radio_receiver_1,
-                    dbconn=postgres_db_connection)
-
-            end_time = time.time()
-            logger.debug('{} seconds for data pull from Pi'.format((end_time - start_time)))
-            total_samples_count += 1
-            time.sleep(sleep_time_sec)
-        except:
-            # Workaround for failing connection when pi gets busy
-            logger.exception('Issue getting data from a receiver {}'.format(radio_receiver_1))
-            time.sleep(120)
-            failure_num += 1
-            if failure_num > 10:
-                exit(1)
 
+    partition_manager = build_partition_manager()
+    # With the bus, the reports are stamped by the bus writer, which sees every receiver's reports
+    tracker = None if bus_config.get('enabled', False) else build_itinerary_tracker()
+    spool, replayer = build_report_spool(tracker)
+    monitor = build_pattern_monitor()
+    try:
+        if bus_config.get('enabled', False):
+            receiver_pollers = build_receiver_pollers(spool, bus=report_bus.get_report_bus(bus_config),
+                                                      monitor=monitor)
+            logger.info('Publishing reports from {} receivers to the {} report bus'.format(
+                len(receiver_pollers), bus_config.get('backend', 'file')))
+            failed_pollers = receiver_poller.poll_receivers_concurrently(receiver_pollers)
+            num_pollers = len(receiver_pollers)
+        elif pipeline_config.get('enabled', False):
+            pipeline = build_ingest_pipeline(spool, tracker, monitor)
+            logger.info('Running staged ingest pipeline for {} receivers'.format(len(pipeline.fetchers)))
+            failed_pollers = pipeline.run()
+            num_pollers = len(pipeline.fetchers)
+        else:
+            receiver_pollers = build_receiver_pollers(spool, tracker=tracker, monitor=monitor)
+            logger.info('Polling {} receivers: {}'.format(len(receiver_pollers),
+                                                          [poller.radio_receiver.name for poller in receiver_pollers]))
+            failed_pollers = receiver_poller.poll_receivers_concurrently(receiver_pollers)
+            num_pollers = len(receiver_pollers)
+    finally:
+        if replayer is not None:
+            replayer.stop()
+            spool.close()
+        if partition_manager is not None:
+            partition_manager.stop()
+        if monitor is not None:
+            logger.info('Checked {} reports for holding patterns, {} alerts raised'.format(monitor.reports_observed,
+                                                                                         monitor.alerts_raised))
+        ingest_db_pool.log_stats()
+
+    if failed_pollers and len(failed_pollers) == num_pollers:
+        logger.error('All receivers failed, exiting.')
+        exit(1)
+
+
+def write_reports_from_bus():
+    """
+    DB writer process for the report bus: consumes the reports published by the pollers and loads them into the DB
+    until Ctrl-C
+    """
+    bus = report_bus.get_report_bus(bus_config)
+    consumer_group = bus_config.get('consumergroup', report_bus.default_consumer_group)
+    writer = report_bus.BusWriter(bus.get_consumer(consumer_group),
+                                  db_connect=connect_to_db,
+                                  batch_size=bus_config.get('batchsize', report_bus.default_consumer_batch_size),
+                                  poll_interval_sec=bus_config.get('pollintervalsec',
+                                                                   report_bus.default_consumer_poll_interval_sec),
+                                  itinerary_tracker=build_itinerary_tracker())
+
+    after_write = None
+    if bus_config.get('deleteconsumed', False):
+        def after_write():
+            bus.delete_consumed_segments([consumer_group])
+
+    logger.info('Writing reports from the report bus into DB as consumer group {}'.format(consumer_group))
+    partition_manager = build_partition_manager()
+    stop_event = threading.Event()
+    try:
+        writer.run(stop_event, after_write=after_write)
+    except KeyboardInterrupt:
+        logger.info('Stopping report bus writer.')
+        stop_event.set()
+    finally:
+        if partition_manager is not None:
+            partition_manager.stop()
+
+
+def maintain_report_partitions():
+    """
+    Run one pass of partition maintenance, e.g. from cron when no ingest process is maintaining them
+    """
+    partition_manager = report_partitions.get_partition_manager(partitions_config, db_connect=connect_to_db)
+    num_created, num_detached = partition_manager.maintain()
+    logger.info('Created {} and detached {} partitions of aircraftreports'.format(num_created, num_detached))
 
 
 if __name__ == '__main__':
     logger.debug('Entry from main.py main started')
-    harvest_aircraft_json_from_pi()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == 'buswriter':
+        write_reports_from_bus()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'partitions':
+        maintain_report_partitions()
+    else:
+        harvest_aircraft_json_from_pi()
@@ -1,16 +1,18 @@
 """
 Aircraft report defined as a record from the mode-s BEAST feed
-Each report is sent to Kafka for ingestion into Postgres/PostGIS and a Storm Spout
+Each report is loaded into Postgres/PostGIS, either directly or through the report bus (see model.report_bus),
+which stands in for Kafka
 """
 
+import contextlib
+import io
 import json
 import logging
+import multiprocessing
 import os
 import time
 import shutil
-
-# TODO: Refactor the DB connection into a param, so there's not need to import main here
-import main
+import zipfile
 
 import requests
 
@@ -18,8 +20,12 @@ import fileinput
 
 from utils import mathutils
 
+from model import report_partitions
 from model import report_receiver
 
+from utils import jsonstream
+from utils import postgres as pg_utils
+
 logger = logging.getLogger(__name__)
 logger.setLevel('INFO')
 
@@ -28,6 +34,12 @@ ft_to_meters = 0.3048
 reporter_format = "{:10.10}"
 flight_format = "{:8.8}"
 
+# Number of reports sent per COPY + merge round trip when bulk loading
+bulk_load_batch_size = 50000
+
+# TODO: Set in config file
+default_ingested_dir = 'F:\\ingested'
+
 # A number of different implementations of dump1090 exist,
 # offering varying amounts of info from the auto-updating data.json
 # The dump1090mutable has a far richer json interface, where the planes are
@@ -54,6 +66,20 @@ adsb_vrs_keynames = ["PosTime", "Icao", "Alt", "Spd", "Sqk", "Trak", "Long", "La
                      "CMsgs", "Mlat"]
 vrs_adsb_file_keynames = adsb_vrs_keynames + ["Cos", "TT"]
 
+class BulkLoadError(Exception):
+    """
+    Raised by bulk_load_aircraft_reports_list_into_db once every batch has been tried, if any of them failed to load.
+    Carries the counts of the batches that did load.
+    """
+
+    def __init__(self, num_failed_batches, num_batches, reports_inserted, reports_duplicate):
+        super(BulkLoadError, self).__init__('{}/{} batches failed to load'.format(num_failed_batches, num_batches))
+        self.num_failed_batches = num_failed_batches
+        self.num_batches = num_batches
+        self.reports_inserted = reports_inserted
+        self.reports_duplicate = reports_duplicate
+
+
 """
 Partial original implementation of this class pulled from this repo: 
 https://github.com/stephen-hocking/ads-b-logger
@@ -165,44 +191,37 @@ class AircraftReport(object):
         
         :param database_connection: Open database connection
         :param update: bool to indicate an update or insert
-        :return: None
+        :return: number of rows written (0 if the report was a duplicate)
         """
 
         # Need to extract datetime fields from time
         # Need to encode lat/lon appropriately for PostGIS storage (spatially indexed)
         cur = database_connection.cursor()
 
-        coordinates = "POINT(%s %s)" % (self.lon, self.lat)
-
         if update:
-            params = [self.mode_s_hex, self.squawk, self.flight, self.is_metric,
-                      self.mlat, self.altitude, self.speed, self.vert_rate,
-                      self.track, coordinates, self.lat, self.lon,
-                      self.messages, self.time, self.reporter,
-                      self.rssi, self.nucp, self.is_ground,
-                      self.mode_s_hex, self.squawk, flight_format.format(self.flight),
-                      reporter_format.format(self.reporter), self.time, self.messages, self.is_anon]
-
-            sql = '''UPDATE aircraftreports SET (mode_s_hex, squawk, flight, is_metric, is_mlat, altitude, speed, vert_rate, bearing, report_location, latitude83, longitude83, messages_sent, report_epoch, reporter, rssi, nucp, is_ground, is_anon)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, ST_PointFromText(%s, 4326), %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            WHERE mode_s_hex LIKE %s AND squawk LIKE %s AND flight LIKE %s AND reporter LIKE %s
-            AND report_epoch = %s AND messages_sent = %s'''
-
+            params = list(self.to_db_row()) + [self.mode_s_hex, self.squawk, flight_format.format(self.flight),
+                                               reporter_format.format(self.reporter), self.time, self.messages]
+            rows_written = update_report_statement.execute(cur, params)
         else:
             logger.debug('Inserting Aircraft record: {}'.format(self))
-            params = [self.mode_s_hex, self.squawk, self.flight, self.is_metric,
-                      self.mlat, self.altitude, self.speed, self.vert_rate,
-                      self.track, coordinates, self.lat, self.lon,
-                      self.messages, self.time, self.reporter,
-                      self.rssi, self.nucp, self.is_ground, self.is_anon]
-            sql = '''INSERT INTO aircraftreports (mode_s_hex, squawk, flight, is_metric, is_mlat, altitude, speed, vert_rate, bearing, report_location, latitude83, longitude83, messages_sent, report_epoch, reporter, rssi, nucp, is_ground, is_anon)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, ST_PointFromText(%s, 4326), %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT DO NOTHING;'''
-
-        logger.debug(cur.mogrify(sql, params))
-        cur.execute(sql, params)
+            rows_written = insert_report_statement.execute(cur, self.to_db_row())
+
         cur.close()
 
+        return rows_written
+
+    def to_db_row(self):
+        """
+        Values of this report in the same order as staging_column_names, used by the bulk COPY loader
+
+        :return: tuple of column values
+        """
+        return (self.mode_s_hex, self.squawk, self.flight, self.is_metric,
+                self.mlat, self.altitude, self.speed, self.vert_rate,
+                self.track, self.lon, self.lat,
+                self.messages, self.time, self.reporter,
+                self.rssi, self.nucp, self.is_ground, self.is_anon)
+
     def delete_from_db(self, db_connection):
         """
         Delete a record that matches this object - assuming sampling once a second, the combination of
@@ -212,18 +231,10 @@ class AircraftReport(object):
         :return: 
         """
         cur = db_connection.cursor()
-        sql = '''DELETE FROM aircraftreports WHERE '''
-        sql = sql + (" mode_s_hex like '%s' " % self.mode_s_hex)
-        sql = sql + (" and flight like '%s' " % flight_format.format(self.flight))
-        sql = sql + (" and reporter like '%s'" %
-                     reporter_format.format(self.reporter))
-        sql = sql + (" and report_epoch=%s " % self.time)
-        sql = sql + (" and altitude=%s " % self.altitude)
-        sql = sql + (" and speed=%s " % self.speed)
-        sql = sql + (" and messages_sent=%s" % self.messages)
-
-        logger.debug(cur.mogrify(sql))
-        cur.execute(sql)
+        delete_report_statement.execute(cur, [self.mode_s_hex, flight_format.format(self.flight),
+                                              reporter_format.format(self.reporter), self.time, self.altitude,
+                                              self.speed, self.messages])
+        cur.close()
 
     def distance(self, other_location):
         """Returns distance in meters from another object with lat/lon"""
@@ -241,33 +252,262 @@ class AircraftReport(object):
         # }
 
 
-def get_aircraft_data_from_url(url_string, url_params=None):
+class CompactAircraftReport(object):
+    """
+    Fixed-layout version of AircraftReport that uses __slots__ instead of a per-instance __dict__, for the
+    ingest paths that create millions of reports. Values passed to __init__ are stored as-is (already metric),
+    so use from_dump1090 or from_vrs to build one from the source JSON; both skip the generic keyword scan and
+    the getattr/setattr passes of AircraftReport.__init__.
+    """
+
+    __slots__ = ('mode_s_hex', 'hex', 'squawk', 'flight', 'altitude', 'speed', 'vert_rate', 'track', 'lon', 'lat',
+                 'time', 'seen', 'seen_pos', 'messages', 'category', 'mlat', 'rssi', 'nucp', 'is_ground', 'is_anon',
+                 'is_metric', 'reporter', 'report_location', 'validposition', 'validtrack')
+
+    def __init__(self, mode_s_hex, lat, lon, time, altitude=0, speed=0, vert_rate=0.0, track=0, squawk=None,
+                 flight=None, seen=9999999, seen_pos=-1, messages=0, category=None, mlat=False, rssi=None, nucp=-1,
+                 is_ground=False, reporter=None, is_metric=True):
+        self.mode_s_hex = mode_s_hex
+        self.hex = mode_s_hex
+        self.lat = lat
+        self.lon = lon
+        self.time = time
+        self.altitude = altitude
+        self.speed = speed
+        self.vert_rate = vert_rate
+        self.track = track
+        self.squawk = squawk
+        self.flight = flight
+        self.seen = seen
+        self.seen_pos = seen_pos
+        self.messages = messages
+        self.category = category
+        self.mlat = mlat
+        self.rssi = rssi
+        self.nucp = nucp
+        self.is_ground = is_ground
+        self.reporter = reporter
+        self.is_metric = is_metric
+        self.report_location = None
+        self.validposition = 1
+        self.validtrack = 1
+
+        # FA anonymizes the mode-s hex for certain aircraft, and denotes it with a ~ as
+        # the first character in the fake mode-s hex code they send back on the MLAT results
+        self.is_anon = mode_s_hex[:1] == '~'
+        if self.is_anon:
+            self.process_anon_detection()
+
+    @classmethod
+    def from_dump1090(cls, dumpfmt_aircraft_report, snapshot_epoch=None):
+        """
+        Build a report from one aircraft dict of dump1090's aircraft.json, converting to metric units
+
+        :param dumpfmt_aircraft_report: dict containing at least the dump1090_minimum_keynames
+        :param snapshot_epoch: the 'now' value of the aircraft.json snapshot
+        :return: CompactAircraftReport
+        """
+        get_value = dumpfmt_aircraft_report.get
+
+        altitude = dumpfmt_aircraft_report['altitude']
+        is_ground = altitude == 'ground'
+        if is_ground:
+            altitude = 0
+
+        # aircraft.json has no per-aircraft time, and AircraftReport used to leave it at 0, so every live row had a
+        # report_epoch of 0. The epoch of the last position (snapshot 'now' less its seen_pos age) is stored instead,
+        # which is also what the AircraftStateCache position signature and the itinerary gap scan rely on.
+        report_time = get_value('time')
+        if report_time is None:
+            if snapshot_epoch is not None:
+                report_time = snapshot_epoch - get_value('seen_pos', get_value('seen', 0))
+            else:
+                report_time = 0
+
+        nucp = get_value('nucp')
+
+        # mode_s_hex is left in the case dump1090 sends it, same as ingest_dump1090_report_list has always done
+        return cls(mode_s_hex=dumpfmt_aircraft_report['hex'],
+                   lat=dumpfmt_aircraft_report['lat'],
+                   lon=dumpfmt_aircraft_report['lon'],
+                   time=report_time,
+                   altitude=int(altitude * ft_to_meters),
+                   speed=int(dumpfmt_aircraft_report['speed'] * knots_to_kmh),
+                   vert_rate=get_value('vert_rate', 0.0) * ft_to_meters,
+                   track=dumpfmt_aircraft_report['track'],
+                   squawk=get_value('squawk'),
+                   flight=get_value('flight'),
+                   seen=get_value('seen', 9999999),
+                   seen_pos=get_value('seen_pos', -1),
+                   messages=get_value('messages', 0),
+                   category=get_value('category'),
+                   # mutability dump1090 has mlat set to list of attributes mlat'ed, we want a boolean
+                   mlat='mlat' in dumpfmt_aircraft_report,
+                   rssi=get_value('rssi'),
+                   nucp=-1 if nucp is None else nucp,
+                   is_ground=is_ground,
+                   reporter=get_value('reporter'))
+
+    @classmethod
+    def from_vrs(cls, vrs_aircraft_report, seen, seen_pos, missing_flight=' ', report_time=None, lat=None, lon=None,
+                 altitude=None, speed=None):
+        """
+        Build a report from one VRS (adsbexchange) acList record, converting to metric units. Position, time,
+        altitude and speed can be overridden with the values from one point of the record's Cos short trail.
+
+        :param vrs_aircraft_report: dict containing at least the adsb_vrs_keynames
+        :param seen: seconds since the aircraft was last seen
+        :param seen_pos: seconds since the aircraft's position was last updated
+        :param missing_flight: flight value to use when the record has no Call
+        :param report_time: epoch seconds of the position (defaults to the record's PosTime)
+        :param lat: latitude (defaults to the record's Lat)
+        :param lon: longitude (defaults to the record's Long)
+        :param altitude: altitude in feet (defaults to the record's Alt)
+        :param speed: speed in knots (defaults to the record's Spd)
+        :return: CompactAircraftReport
+        """
+        if report_time is None:
+            report_time = vrs_aircraft_report['PosTime'] / 1000
+        if lat is None:
+            lat = vrs_aircraft_report['Lat']
+        if lon is None:
+            lon = vrs_aircraft_report['Long']
+        if altitude is None:
+            altitude = vrs_aircraft_report['Alt']
+        if speed is None:
+            speed = vrs_aircraft_report['Spd']
+
+        if 'Call' in vrs_aircraft_report:
+            flight = flight_format.format(vrs_aircraft_report['Call'])
+        else:
+            flight = missing_flight
+
+        return cls(mode_s_hex=vrs_aircraft_report['Icao'].upper(),
+                   lat=lat,
+                   lon=lon,
+                   time=report_time,
+                   altitude=int(altitude * ft_to_meters),
+                   speed=int(speed * knots_to_kmh),
+                   vert_rate=vrs_aircraft_report.get('Vsi', 0.0) * ft_to_meters,
+                   track=vrs_aircraft_report['Trak'],
+                   squawk=vrs_aircraft_report['Sqk'],
+                   flight=flight,
+                   seen=seen,
+                   seen_pos=seen_pos,
+                   messages=vrs_aircraft_report['CMsgs'],
+                   mlat=vrs_aircraft_report['Mlat'],
+                   is_ground=vrs_aircraft_report['Gnd'],
+                   reporter='')
+
+    @classmethod
+    def from_sbs(cls, mode_s_hex, sbs_aircraft_state, report_time):
+        """
+        Build a report from the merged SBS-1 (BaseStation) messages of one aircraft, converting to metric units
+
+        :param mode_s_hex: the aircraft's hex ident
+        :param sbs_aircraft_state: dict of the aircraft's latest lat, lon, altitude, speed, track, vert_rate,
+                                   squawk, flight, is_ground and messages, see model.sbs_stream
+        :param report_time: epoch of the position message
+        :return: CompactAircraftReport
+        """
+        get_value = sbs_aircraft_state.get
+
+        return cls(mode_s_hex=mode_s_hex,
+                   lat=sbs_aircraft_state['lat'],
+                   lon=sbs_aircraft_state['lon'],
+                   time=report_time,
+                   altitude=int(get_value('altitude', 0) * ft_to_meters),
+                   speed=int(sbs_aircraft_state['speed'] * knots_to_kmh),
+                   vert_rate=get_value('vert_rate', 0.0) * ft_to_meters,
+                   track=sbs_aircraft_state['track'],
+                   squawk=get_value('squawk'),
+                   flight=get_value('flight'),
+                   seen=0,
+                   seen_pos=0,
+                   messages=get_value('messages', 0),
+                   is_ground=get_value('is_ground', False))
+
+    def to_dict(self):
+        """Returns a dict of all of the report's fields"""
+        return {slot_name: getattr(self, slot_name) for slot_name in self.__slots__}
+
+    def __str__(self):
+        fields = ['  {}: {}'.format(k, v) for k, v in self.to_dict().items()]
+        return "{}(\n{})".format(self.__class__.__name__, '\n'.join(fields))
+
+    def to_json(self):
+        """Returns a JSON representation of an aircraft report on one line"""
+        return json.dumps(self.to_dict(), sort_keys=True, separators=(',', ':'))
+
+    # The unit conversions and DB methods only touch fields that exist in both layouts, so share them
+    convert_to_metric = AircraftReport.convert_to_metric
+    convert_from_metric_to_us = AircraftReport.convert_from_metric_to_us
+    send_aircraft_to_db = AircraftReport.send_aircraft_to_db
+    to_db_row = AircraftReport.to_db_row
+    delete_from_db = AircraftReport.delete_from_db
+    distance = AircraftReport.distance
+    process_anon_detection = AircraftReport.process_anon_detection
+
+
+def get_aircraft_data_from_url(url_string, url_params=None, timeout=None, as_batch=False, session=None):
     """
+    One-off fetch of a snapshot. Pollers should use a model.snapshot_client.SnapshotClient instead, which keeps
+    the connection alive and skips unchanged snapshots.
+
     :param url_string: string containing a URL (e.g. http://piaware1/dump1090-fa/data.json)
     :param url_params: Only used for ADSBE data pulls
-    :return: list of AircraftReport objects
+    :param timeout: seconds to wait for the receiver to respond before raising (None waits forever)
+    :param as_batch: return the dump1090 or VRS snapshot as one columnar ReportBatch instead of a list
+    :param session: optional requests.Session to reuse its connection
+    :return: list of AircraftReport objects, or a ReportBatch
     """
     current_report_pulled_time = time.time()
 
+    http = session if session is not None else requests
     if url_params:
-        response = requests.get(url_string, params=url_params)
+        response = http.get(url_string, params=url_params, timeout=timeout)
     else:
-        response = requests.get(url_string)
+        response = http.get(url_string, timeout=timeout)
+
+    return parse_aircraft_json(response.content, current_report_pulled_time, as_batch=as_batch)
+
+
+def parse_aircraft_json(json_text, report_pulled_timestamp, as_batch=False):
+    """
+    Parse one aircraft JSON snapshot (dump1090 aircraft.json, VRS acList, or a plain list of report dicts)
+
+    :param json_text: the JSON document as a string, or the raw UTF-8 bytes of the response
+    :param report_pulled_timestamp: epoch when the snapshot was pulled, used for the age of VRS positions
+    :param as_batch: return the dump1090 or VRS snapshot as one columnar ReportBatch instead of a list
+    :return: list of AircraftReport objects, or a ReportBatch
+    """
     try:
-        data = json.loads(response.text)
+        # Decoding the bytes directly skips the charset detection requests does for response.text
+        if isinstance(json_text, bytes):
+            json_text = json_text.decode('utf-8')
+        data = json.loads(json_text)
     except:
         logger.warning('Unable to parse the aircraft JSON from dump1090')
         return []
+
+    if as_batch and ('aircraft' in data or 'acList' in data):
+        # Imported here since report_batch imports this module
+        from model import report_batch
+        if 'aircraft' in data:
+            return report_batch.ReportBatch.from_dump1090(data['aircraft'], snapshot_epoch=data.get('now'))
+        return report_batch.ReportBatch.from_vrs(data['acList'])
+
     # Check for dump1090 JSON Schema (should contain a list of reports with an aircraft key in the JSON)
     if 'aircraft' in data:
-        reports_list = ingest_dump1090_report_list(data['aircraft'])
+        reports_list = ingest_dump1090_report_list(data['aircraft'], snapshot_epoch=data.get('now'))
 
     # VRS style JSON Schema - such as the JSON from adsbexchange.com
     elif 'acList' in data:
         reports_list = []
         for vrs_report in data['acList']:
-            vrs_aircraft_report_parsed = ingest_vrs_format_record(vrs_report, current_report_pulled_time)
-            reports_list.append(vrs_aircraft_report_parsed)
+            vrs_aircraft_report_parsed = ingest_vrs_format_record(vrs_report, report_pulled_timestamp)
+            if vrs_aircraft_report_parsed is not None:
+                reports_list.append(vrs_aircraft_report_parsed)
 
     else:
         # Wildcard format so we just load each JSON key directly into each AircraftReport object
@@ -276,199 +516,725 @@ def get_aircraft_data_from_url(url_string, url_params=None):
     return reports_list
 
 
-def get_aircraft_data_from_files(file_directory, minlat83, maxlat83, minlong83, maxlong83):
+def get_aircraft_data_from_files(file_directory, minlat83, maxlat83, minlong83, maxlong83, bulk=True,
+                                 batch_size=bulk_load_batch_size, dbconn=None, num_workers=1, db_params=None,
+                                 ingested_dir=default_ingested_dir, streaming=False,
+                                 partition_interval=report_partitions.default_partition_interval):
     """
-    Sample record:
+    Load every VRS archive JSON file in a directory into the DB, expanding each aircraft's short trail into
+    one report per trail point, and move each loaded file into ingested_dir.
+
     Args:
         file_directory: A string containing a filepath
+        minlat83, maxlat83, minlong83, maxlong83: Bounding box that trail points must fall within to be loaded
+        bulk: COPY each file's reports into the DB in batches instead of one INSERT per report
+        batch_size: Number of reports per COPY batch
+        dbconn: Open database connection (defaults to a new connection from db_params if given, otherwise the
+            connection opened by main.py). Only used when num_workers is 1
+        num_workers: Number of worker processes to spread the files across. Each worker opens its own DB
+            connection with db_params
+        db_params: dict of database_connection keyword args (dbname, dbuser, dbhost, dbpasswd, dbport), required
+            when num_workers is more than 1
+        ingested_dir: Directory that files are moved into once they are loaded
+        streaming: Parse each file's acList incrementally and load it in batch_size chunks, so memory use stays
+            flat however large the file is
+        partition_interval: Interval ('daily' or 'weekly') of the aircraftreports partitions to create for the
+            reports before loading them, so they don't land in the default partition. None leaves the partitions
+            alone. Does nothing if aircraftreports isn't partitioned
 
     Returns:
-        A list of AircraftReports
+        Dict summarising the run, with the number of files processed, the total reports inserted and
+        duplicated, and the lists of malformed and failed files
     """
-    radio_receiver_vrs = report_receiver.RadioReceiver(name='archive',
-                                                       type='vrs',
-                                                       lat83=0,
-                                                       long83=0,
-                                                       data_access_url='',
-                                                       location='')
-
     files_to_process = []
-    malformed_json_files = []
 
     for file in os.listdir(file_directory):
         if file.endswith('.json'):
             logger.info('Found Aircraft JSON data file: {}'.format(os.path.join(file_directory, file)))
             files_to_process.append(os.path.join(file_directory, file))
 
-    for json_file in files_to_process:
-        aircraft_report_list = []
+    return ingest_archive_json_files(files_to_process, file_directory,
+                                     bounding_box=(minlat83, maxlat83, minlong83, maxlong83),
+                                     bulk=bulk,
+                                     batch_size=batch_size,
+                                     dbconn=dbconn,
+                                     num_workers=num_workers,
+                                     db_params=db_params,
+                                     ingested_dir=ingested_dir,
+                                     streaming=streaming,
+                                     partition_interval=partition_interval)
+
+
+def get_aircraft_data_from_zip(zip_path, minlat83, maxlat83, minlong83, maxlong83, bulk=True,
+                               batch_size=bulk_load_batch_size, dbconn=None, num_workers=1, db_params=None,
+                               streaming=False, partition_interval=report_partitions.default_partition_interval):
+    """
+    Load every VRS archive JSON file inside a zip into the DB, reading each member straight out of the zip instead
+    of extracting it to disk first. Takes the same args as get_aircraft_data_from_files, except there is no
+    ingested_dir since nothing is extracted that would need moving.
+
+    Args:
+        zip_path: Path of the archive zip file
+
+    Returns:
+        Dict summarising the run, same as get_aircraft_data_from_files
+    """
+    with zipfile.ZipFile(zip_path) as archive_zip:
+        members_to_process = [member_name for member_name in archive_zip.namelist() if member_name.endswith('.json')]
+    logger.info('Found {} Aircraft JSON data files in zip: {}'.format(len(members_to_process), zip_path))
+
+    return ingest_archive_json_files(members_to_process, zip_path,
+                                     bounding_box=(minlat83, maxlat83, minlong83, maxlong83),
+                                     bulk=bulk,
+                                     batch_size=batch_size,
+                                     dbconn=dbconn,
+                                     num_workers=num_workers,
+                                     db_params=db_params,
+                                     ingested_dir=None,
+                                     streaming=streaming,
+                                     zip_path=zip_path,
+                                     partition_interval=partition_interval)
+
+
+def ingest_archive_json_files(files_to_process, archive_name, bounding_box, bulk, batch_size, dbconn, num_workers,
+                              db_params, ingested_dir, streaming, zip_path=None,
+                              partition_interval=report_partitions.default_partition_interval):
+    """
+    Shared by get_aircraft_data_from_files and get_aircraft_data_from_zip - loads each archive JSON file, either
+    serially on dbconn or across a pool of num_workers processes, and returns the run summary
+
+    :param files_to_process: list of file paths, or of member names when zip_path is given
+    :param archive_name: directory or zip name, for logging
+    :param zip_path: path of the zip that the files are members of (None for files on disk)
+    :param partition_interval: interval of the partitions to create for each file's reports, or None
+    """
+    ingest_summary = {'files_processed': 0,
+                      'reports_inserted': 0,
+                      'reports_duplicate': 0,
+                      'malformed_json_files': [],
+                      'failed_json_files': []}
+
+    if num_workers > 1:
+        if db_params is None:
+            raise ValueError('db_params are required to open a DB connection in each archive ingest worker')
+
+        logger.info('Ingesting {} archive files across {} worker processes'.format(len(files_to_process),
+                                                                                   num_workers))
+        worker_pool = multiprocessing.Pool(processes=num_workers,
+                                           initializer=init_archive_ingest_worker,
+                                           initargs=(db_params,))
         try:
-            file_data = json.load(open(json_file, encoding='utf-8'))
-            logger.info('Success AR parsing JSON data file: {}'.format(json_file))
+            worker_args = [(json_file, bounding_box, bulk, batch_size, ingested_dir, streaming, zip_path,
+                            partition_interval) for json_file in files_to_process]
+            for file_result in worker_pool.imap_unordered(ingest_archive_json_file_in_worker, worker_args):
+                add_archive_file_result_to_summary(ingest_summary, file_result, len(files_to_process))
+        finally:
+            worker_pool.close()
+            worker_pool.join()
 
-        except:
+    else:
+        if dbconn is None and db_params is not None:
+            dbconn = pg_utils.database_connection(**db_params)
+        elif dbconn is None:
+            # Imported here rather than at the top of the module, since importing main reads config.yml and connects
+            # to the DB, which nothing else in this module needs
+            import main
+            dbconn = main.postgres_db_connection
+
+        for json_file in files_to_process:
+            file_result = ingest_archive_json_file(json_file, bounding_box, dbconn, bulk, batch_size, ingested_dir,
+                                                   streaming, zip_path, partition_interval)
+            add_archive_file_result_to_summary(ingest_summary, file_result, len(files_to_process))
+
+    malformed_json_files = ingest_summary['malformed_json_files']
+    if len(malformed_json_files) > 0:
+        logger.info('{} Malformed JSON Files found: {}'.format(len(malformed_json_files), malformed_json_files))
+    if len(ingest_summary['failed_json_files']) > 0:
+        logger.error('{} JSON Files failed to load: {}'.format(len(ingest_summary['failed_json_files']),
+                                                               ingest_summary['failed_json_files']))
+    logger.info('Archive ingest of {} complete: {} files, {} reports inserted, {} duplicates skipped'.format(
+        archive_name, ingest_summary['files_processed'], ingest_summary['reports_inserted'],
+        ingest_summary['reports_duplicate']))
+
+    return ingest_summary
+
+
+def add_archive_file_result_to_summary(ingest_summary, file_result, num_files):
+    """
+    Fold the result of one ingest_archive_json_file call into the run summary and log the overall progress
+    """
+    ingest_summary['files_processed'] += 1
+    ingest_summary['reports_inserted'] += file_result['reports_inserted']
+    ingest_summary['reports_duplicate'] += file_result['reports_duplicate']
+    if file_result['malformed']:
+        ingest_summary['malformed_json_files'].append(file_result['json_file'])
+    elif file_result['error']:
+        ingest_summary['failed_json_files'].append((file_result['json_file'], file_result['error']))
+
+    logger.info('Archive ingest progress: {}/{} files, {} reports inserted, {} duplicates skipped'.format(
+        ingest_summary['files_processed'], num_files, ingest_summary['reports_inserted'],
+        ingest_summary['reports_duplicate']))
 
-            # temp workaround to fix malformed JSON in archive files - replace common strin
-            # issues in-place before parsing
+
+# DB connection of this process, when running as an archive ingest pool worker
+archive_worker_db_pool = None
+
+
+def init_archive_ingest_worker(db_params):
+    """Pool initializer - sets up the one-connection DB pool that this worker process uses for all of its files"""
+    global archive_worker_db_pool
+    archive_worker_db_pool = pg_utils.get_connection_pool('archive', max_connections=1, **db_params)
+
+
+def ingest_archive_json_file_in_worker(worker_args):
+    """
+    Pool task wrapper around ingest_archive_json_file, using this worker's own DB connection, which is reopened
+    if a previous file lost it
+    """
+    json_file, bounding_box, bulk, batch_size, ingested_dir, streaming, zip_path, partition_interval = worker_args
+    return ingest_archive_json_file(json_file, bounding_box, archive_worker_db_pool.get_thread_connection(), bulk,
+                                    batch_size, ingested_dir, streaming, zip_path, partition_interval)
+
+
+def ingest_archive_json_file(json_file, bounding_box, dbconn, bulk, batch_size, ingested_dir, streaming=False,
+                             zip_path=None, partition_interval=report_partitions.default_partition_interval):
+    """
+    Parse one VRS archive JSON file, load its reports into the DB and move it into ingested_dir. A file that
+    fails to load, even partly, is left where it is with the error in the result, so it's loaded again next run.
+    Never raises, so that one bad file doesn't stop a pool of workers.
+
+    :param json_file: path of the archive JSON file, or its member name when zip_path is given
+    :param bounding_box: tuple of (minlat83, maxlat83, minlong83, maxlong83)
+    :param dbconn: Open database connection
+    :param bulk: bool to COPY the reports into the DB in batches
+    :param batch_size: number of reports per COPY batch
+    :param ingested_dir: directory to move the file into once it is loaded
+    :param streaming: parse the acList incrementally and load the reports in batch_size chunks, instead of
+                      loading the whole file into memory first
+    :param zip_path: path of the zip that json_file is a member of. The member is read straight from the zip,
+                     and isn't moved afterwards
+    :param partition_interval: interval of the aircraftreports partitions to create for the reports before they're
+                               loaded, or None to leave the partitions alone
+    :return: dict with the json_file, reports_inserted, reports_duplicate, malformed flag and error message
+    """
+    file_result = {'json_file': json_file,
+                   'reports_inserted': 0,
+                   'reports_duplicate': 0,
+                   'malformed': False,
+                   'error': None}
+
+    radio_receiver_vrs = report_receiver.RadioReceiver(name='archive',
+                                                       type='vrs',
+                                                       lat83=0,
+                                                       long83=0,
+                                                       data_access_url='',
+                                                       location='')
+
+    if not dbconn:
+        # Leave the file where it is so that it's picked up again on the next run
+        logger.error('No DB Connection. Archive JSON file not loaded: {}'.format(json_file))
+        file_result['error'] = 'No DB connection'
+        return file_result
+
+    partition_manager = None
+    if partition_interval is not None:
+        # Archive reports are days or years old, so their partitions usually don't exist yet
+        partition_manager = report_partitions.ReportPartitionManager(lambda: dbconn, interval=partition_interval)
+
+    try:
+        if streaming:
+            # Chunks that were loaded before a parse error stay loaded - the (mode_s_hex, report_epoch) dedup
+            # makes it safe to load the file again once it is fixed
             try:
-                cleaned_archive_json_file = clean_malformed_json_file(json_file)
-
-                # Now that the JSON file is cleaned up, let's try this again
-                try:
-                    file_data = json.load(open(cleaned_archive_json_file, encoding='utf-8'))
-                    logger.info('Success parsing fixed JSON data file: {}'.format(json_file))
-
-                except Exception as err:
-                    # First pass of fixing the common JSON issue didn't work, so we're skipping this file for now
-                    logger.error('Error parsing Fixed JSON data : {} \n Error file: {}'.format(err, json_file))
-                    malformed_json_files.append(json_file)
-                    continue
-
-            except:
-                continue
-
-        for aircraft_record in file_data['acList']:
-            logger.debug('Aircraft Record in acList: {}'.format(aircraft_record))
-            valid = True
-
-            for json_key_name in vrs_adsb_file_keynames:
-                if json_key_name not in aircraft_record:
-                    valid = False
-                    logger.debug('Aircraft in acList is missing an expected json key: {}'.format(json_key_name))
-                    break
-
-            if valid:
-                report_time = aircraft_record['PosTime'] / 1000
-                mode_s_hex = aircraft_record['Icao'].upper()
-                altitude = aircraft_record['Alt']
-                speed = aircraft_record['Spd']
-                squawk = aircraft_record['Sqk']
-                if 'Call' in aircraft_record:
-                    flight = flight_format.format(aircraft_record['Call'])
-                else:
-                    flight = ''
-                track = aircraft_record['Trak']
-                long83 = aircraft_record['Long']
-                lat83 = aircraft_record['Lat']
-
-                is_ground = aircraft_record['Gnd']
-                messages = aircraft_record['CMsgs']
-                mlat = aircraft_record['Mlat']
-                tt = aircraft_record['TT']
-
-                if 'Vsi' in aircraft_record:
-                    vert_rate = aircraft_record['Vsi']
-                else:
-                    vert_rate = 0.0
-                is_metric = False
-
-                # Calculate each position in the past track data and insert as an Aircraft record
-                # Process is a little convoluted due to the weird JSON schema used in the data with 'short tracks'
-
-                past_track = aircraft_record['Cos']
-                # a means each position in the track includes the altitude
-                # lat, long, epoch ms, altitude
-                # Example record snippet: "TT": "a", "Trt": 2,
-                #  "Cos": [36.547302, -81.144791, 1506817898412.0, 24000.0,
-                #           36.565704, -81.144619, 1506817909334.0, 24000.0,
-                #           36.582092, -81.144505, 1506817919022.0, 24000.0,
-
-                # s means each position in the track includes the speed
-                if tt == 'a' or tt == 's':
-                    num_positions_in_track = len(past_track) / 4
-                    for past_track_reading_index in range(int(num_positions_in_track)):
-                        # check that the 4th value exists within each track reading
-                        if past_track[(past_track_reading_index * 4) + 3]:
-                            if tt == 'a':
-                                altitude = past_track[(past_track_reading_index * 4) + 3]
-                            elif tt == 's':
-                                speed = past_track[(past_track_reading_index * 4) + 3]
-                            lat83 = past_track[(past_track_reading_index * 4) + 0]
-                            long83 = past_track[(past_track_reading_index * 4) + 1]
-                            # if lat83 < -90.0 or lat83 > 90.0 or long83 < -180.0 or long83 > 180.0:
-                            if lat83 < minlat83 or lat83 > maxlat83 or long83 < minlong83 or long83 > maxlong83:
-                                #logger.error('Invalid lat/long detected within a trail: {}, {}'.format(lat83, long83))
-                                # skip this record
-                                continue
-
-                            # converting millis to seconds
-                            report_time = past_track[(past_track_reading_index * 4) + 2] / 1000
-
-                            seen = seen_pos = 0
-
-                            record = AircraftReport(hex=mode_s_hex,
-                                                    time=report_time,
-                                                    speed=speed,
-                                                    squawk=squawk,
-                                                    flight=flight,
-                                                    altitude=altitude,
-                                                    isMetric=is_metric,
-                                                    track=track,
-                                                    lon=long83,
-                                                    lat=lat83,
-                                                    vert_rate=vert_rate,
-                                                    seen=seen,
-                                                    validposition=1,
-                                                    validtrack=1,
-                                                    reporter="",
-                                                    mlat=mlat,
-                                                    is_ground=is_ground,
-                                                    report_location=None,
-                                                    messages=messages,
-                                                    seen_pos=seen_pos,
-                                                    category=None)
-
-                            logger.debug('New aircraft report generated from within a track within an '
-                                         'acList within an archive JSON record: {}'.format(record))
-                            aircraft_report_list.append(record)
-
-                else:
-                    logger.info('TT not a or s: {} '.format(aircraft_record))
-
-        # Load all of the aircraft reports from this JSON file into the DB before moving on to the next file
-        load_aircraft_reports_list_into_db(aircraft_reports_list=aircraft_report_list,
-                                           radio_receiver=radio_receiver_vrs,
-                                           dbconn=main.postgres_db_connection)
-
-        # TODO: Set in config file
-        destination = 'F:\ingested'
-        if not os.path.exists(destination):
-            os.makedirs(destination)
+                for aircraft_report_chunk in iter_report_chunks_from_archive_file(json_file, *bounding_box,
+                                                                                  chunk_size=batch_size,
+                                                                                  zip_path=zip_path):
+                    if partition_manager is not None:
+                        partition_manager.create_partitions_for_epochs(aircraft_report_chunk.epoch)
+                    reports_inserted, reports_duplicate = load_aircraft_reports_list_into_db(
+                        aircraft_reports_list=aircraft_report_chunk,
+                        radio_receiver=radio_receiver_vrs,
+                        dbconn=dbconn,
+                        bulk=bulk,
+                        batch_size=batch_size)
+                    file_result['reports_inserted'] += reports_inserted
+                    file_result['reports_duplicate'] += reports_duplicate
+            except jsonstream.JsonStreamError as err:
+                logger.error('Error streaming JSON data : {} \n Error file: {}'.format(err, json_file))
+                file_result['malformed'] = True
+                return file_result
+
+        else:
+            file_data = parse_archive_json_file(json_file, zip_path=zip_path)
+            if file_data is None:
+                file_result['malformed'] = True
+                return file_result
+
+            aircraft_report_list = get_reports_from_archive_data(file_data, *bounding_box)
+            if partition_manager is not None:
+                partition_manager.create_partitions_for_epochs(aircraft_report_list.epoch)
+
+            # Load all of the aircraft reports from this JSON file into the DB before moving on to the next file
+            reports_inserted, reports_duplicate = load_aircraft_reports_list_into_db(
+                aircraft_reports_list=aircraft_report_list,
+                radio_receiver=radio_receiver_vrs,
+                dbconn=dbconn,
+                bulk=bulk,
+                batch_size=batch_size)
+            file_result['reports_inserted'] = reports_inserted
+            file_result['reports_duplicate'] = reports_duplicate
+
+    except BulkLoadError as err:
+        # The batches that loaded stay loaded, and the (mode_s_hex, report_epoch) dedup makes it safe to load the
+        # whole file again, so it's left where it is for the next run
+        logger.error('Archive JSON file only partly loaded ({}): {}'.format(err, json_file))
+        file_result['reports_inserted'] += err.reports_inserted
+        file_result['reports_duplicate'] += err.reports_duplicate
+        file_result['error'] = str(err)
+        return file_result
+    except Exception as err:
+        logger.exception('Issue ingesting archive JSON file: {}'.format(json_file))
+        file_result['error'] = str(err)
+        return file_result
+
+    if zip_path is not None:
+        return file_result
+
+    os.makedirs(ingested_dir, exist_ok=True)
+    try:
+        shutil.move(json_file, ingested_dir)
+    except:
+        logger.error('Cant move file')
+
+    return file_result
+
+
+@contextlib.contextmanager
+def open_archive_json_file(json_file, zip_path=None):
+    """
+    Open an archive JSON file for reading as text, either from disk or straight out of a zip without extracting it
+
+    :param json_file: path of the file, or its member name when zip_path is given
+    :param zip_path: path of the zip that json_file is a member of
+    :return: context manager giving a text file object
+    """
+    if zip_path is None:
+        with open(json_file, encoding='utf-8') as json_file_handle:
+            yield json_file_handle
+    else:
+        with zipfile.ZipFile(zip_path) as archive_zip:
+            with archive_zip.open(json_file) as member_handle:
+                yield io.TextIOWrapper(member_handle, encoding='utf-8')
+
+
+def parse_archive_json_file(json_file, zip_path=None):
+    """
+    Load an archive JSON file, cleaning up the common malformations and retrying once if it doesn't parse.
+    Files on disk are cleaned in-place, zip members are cleaned in memory.
+
+    :param json_file: path of the archive JSON file, or its member name when zip_path is given
+    :param zip_path: path of the zip that json_file is a member of
+    :return: the parsed JSON, or None if it couldn't be parsed even after cleaning
+    """
+    try:
+        with open_archive_json_file(json_file, zip_path) as json_file_handle:
+            json_text = json_file_handle.read()
+    except UnicodeDecodeError as err:
+        # Not text at all, so there's nothing to clean up
+        logger.error('Error decoding JSON data file: {} \n Error file: {}'.format(err, json_file))
+        return None
+
+    try:
+        file_data = json.loads(json_text)
+        logger.info('Success AR parsing JSON data file: {}'.format(json_file))
+        return file_data
+
+    except:
+        # temp workaround to fix malformed JSON in archive files - replace common strin
+        # issues in-place before parsing
         try:
-            shutil.move(json_file, destination)
+            if zip_path is None:
+                clean_malformed_json_file(json_file)
+                with open(json_file, encoding='utf-8') as json_file_handle:
+                    json_text = json_file_handle.read()
+            else:
+                json_text = clean_malformed_json_text(json_text)
         except:
-            logger.error('Cant move file')
-            pass
+            logger.exception('Could not clean malformed JSON data file: {}'.format(json_file))
+            return None
 
-    if len(malformed_json_files) > 0:
-        logger.info('{} Malformed JSON Files found: {}'.format(len(malformed_json_files), malformed_json_files))
+        # Now that the JSON file is cleaned up, let's try this again
+        try:
+            file_data = json.loads(json_text)
+            logger.info('Success parsing fixed JSON data file: {}'.format(json_file))
+            return file_data
+
+        except Exception as err:
+            # First pass of fixing the common JSON issue didn't work, so we're skipping this file for now
+            logger.error('Error parsing Fixed JSON data : {} \n Error file: {}'.format(err, json_file))
+            return None
+
+
+def get_reports_from_archive_data(file_data, minlat83, maxlat83, minlong83, maxlong83):
+    """
+    Expand the short trail ('Cos') of every aircraft in a parsed archive file into one report per trail point
+
+    :param file_data: parsed archive JSON, containing an acList
+    :return: ReportBatch of the trail points inside the bounding box
+    """
+    # Imported here since report_batch imports this module
+    from model import report_batch
+
+    return report_batch.ReportBatch.from_vrs_trails(file_data['acList'], minlat83, maxlat83, minlong83, maxlong83)
+
+
+def iter_report_chunks_from_archive_file(json_file, minlat83, maxlat83, minlong83, maxlong83,
+                                         chunk_size=bulk_load_batch_size, zip_path=None):
+    """
+    Stream the acList of an archive file one record at a time, and yield the expanded short trail reports in
+    batches of roughly chunk_size. Peak memory is one chunk no matter how large the file is.
+
+    :param json_file: path of the archive JSON file, or its member name when zip_path is given
+    :param chunk_size: number of trail points to collect before expanding and yielding them
+    :param zip_path: path of the zip that json_file is a member of
+    :return: generator of ReportBatch objects
+    :raises jsonstream.JsonStreamError: if the file can't be parsed (reports before the bad spot are still yielded)
+    """
+    # Imported here since report_batch imports this module
+    from model import report_batch
+
+    record_chunk = []
+    num_trail_points = 0
+
+    with open_archive_json_file(json_file, zip_path) as json_file_handle:
+        for aircraft_record in jsonstream.iter_json_array_items(json_file_handle, 'acList'):
+            record_chunk.append(aircraft_record)
+            num_trail_points += len(aircraft_record.get('Cos') or []) // 4
+            if num_trail_points >= chunk_size:
+                yield report_batch.ReportBatch.from_vrs_trails(record_chunk, minlat83, maxlat83, minlong83, maxlong83)
+                record_chunk = []
+                num_trail_points = 0
 
+    if record_chunk:
+        yield report_batch.ReportBatch.from_vrs_trails(record_chunk, minlat83, maxlat83, minlong83, maxlong83)
+
+
+def load_aircraft_reports_list_into_db(aircraft_reports_list, radio_receiver, dbconn, bulk=False,
+                                       batch_size=bulk_load_batch_size, commit=True, itinerary_tracker=None):
+    """
+    Load a list of AircraftReports into the aircraftreports table. Duplicates of (mode_s_hex, report_epoch)
+    that are already in the table are skipped.
+
+    :param aircraft_reports_list: list of AircraftReport objects, or a columnar ReportBatch
+    :param radio_receiver: RadioReceiver that the reports came from
+    :param dbconn: Open database connection
+    :param bulk: bool to COPY the reports through a staging table in batches instead of INSERTing them with the
+                 prepared insert statement
+    :param batch_size: number of reports per COPY batch (only used when bulk is True)
+    :param commit: commit once the reports are loaded. Pass False to leave the transaction open so several loads
+                   can be committed together (only used when bulk is False - bulk loads commit every batch)
+    :param itinerary_tracker: optional ItineraryTracker that stamps each report's itinerary_id (only used when bulk
+                              is False - archive loads are left to the batch itinerary job)
+    :return: tuple of (number of rows inserted, number of duplicate rows skipped)
+    :raises psycopg2.Error: if the insert fails (only when bulk is False). The transaction is rolled back first, so
+                            the connection can be used again, and any earlier uncommitted loads on it are lost too
+    :raises BulkLoadError: if any batch failed to load (only when bulk is True - the other batches are still loaded)
+    """
+    if bulk:
+        return bulk_load_aircraft_reports_list_into_db(aircraft_reports_list=aircraft_reports_list,
+                                                       radio_receiver=radio_receiver,
+                                                       dbconn=dbconn,
+                                                       batch_size=batch_size)
 
-def load_aircraft_reports_list_into_db(aircraft_reports_list, radio_receiver, dbconn):
     num_reports = len(aircraft_reports_list)
     logger.info('Loading list of {} reports into DB.'.format(num_reports))
 
-    reports_loaded = 0
+    if not dbconn:
+        logger.error('No DB Connection. {} aircraft reports not inserted'.format(num_reports))
+        return 0, 0
 
-    for aircraft in aircraft_reports_list:
-        reports_loaded += 1
-        if not reports_loaded % 100000:
-            logger.info('Progress loading aircraft reports list into DB: {}/{}'.format(reports_loaded, num_reports))
+    db_rows = get_db_rows_for_reports(aircraft_reports_list, radio_receiver)
+    try:
+        reports_inserted, reports_duplicate = insert_db_rows_into_aircraftreports(dbconn, db_rows,
+                                                                                  itinerary_tracker=itinerary_tracker)
+    except:
+        # The failed statement aborts the whole transaction, so nothing in it could be committed anyway
+        logger.exception('Issue inserting {} aircraft reports into DB, rolling back'.format(num_reports))
+        try:
+            dbconn.rollback()
+        except:
+            logger.exception('Issue rolling back, DB connection lost')
+        raise
+
+    if commit:
+        dbconn.commit()
+
+    return reports_inserted, reports_duplicate
+
+
+def bulk_load_aircraft_reports_list_into_db(aircraft_reports_list, radio_receiver, dbconn,
+                                            batch_size=bulk_load_batch_size):
+    """
+    Streams the reports into a temp staging table with COPY FROM STDIN, batch_size reports at a time, and
+    merges each batch into aircraftreports with a single INSERT ... SELECT ... ON CONFLICT DO NOTHING.
+    Each batch is committed on its own, so a failed batch is rolled back and the rest are still loaded, but the
+    failure is raised once they have all been tried so the caller can load the reports again.
+
+    :param aircraft_reports_list: list of AircraftReport objects, or a columnar ReportBatch
+    :param radio_receiver: RadioReceiver that the reports came from
+    :param dbconn: Open database connection
+    :param batch_size: number of reports per COPY batch
+    :return: tuple of (number of rows inserted, number of duplicate rows skipped)
+    :raises BulkLoadError: if any batch failed to load
+    """
+    if is_report_batch(aircraft_reports_list):
+        aircraft_reports_list = prepare_report_batch_for_db(aircraft_reports_list, radio_receiver)
+
+    num_reports = len(aircraft_reports_list)
+    logger.info('Bulk loading list of {} reports into DB in batches of {}.'.format(num_reports, batch_size))
+
+    if not dbconn:
+        logger.error('No DB Connection. {} aircraft reports not inserted'.format(num_reports))
+        return 0, 0
+
+    reports_inserted = 0
+    reports_duplicate = 0
+    num_batches = 0
+    num_failed_batches = 0
+
+    for batch_start in range(0, num_reports, batch_size):
+        if is_report_batch(aircraft_reports_list):
+            batch_rows = aircraft_reports_list.filter(slice(batch_start, batch_start + batch_size)).to_db_rows()
+            aircraft_batch = []
+        else:
+            batch_rows = []
+            aircraft_batch = aircraft_reports_list[batch_start:batch_start + batch_size]
+
+        for aircraft in aircraft_batch:
+            if aircraft.validposition and aircraft.validtrack:
+                aircraft.reporter = radio_receiver.name
+                batch_rows.append(aircraft.to_db_row())
+            else:
+                logger.error("Dropped report - no valid position or no validtrack found: {}".format(
+                    aircraft.to_json()))
 
+        if not batch_rows:
+            continue
+
+        num_batches += 1
+        try:
+            batch_inserted, batch_duplicate = merge_db_rows_into_aircraftreports(dbconn, batch_rows)
+            dbconn.commit()
+        except:
+            logger.exception('Issue bulk loading batch of {} reports into DB'.format(len(batch_rows)))
+            dbconn.rollback()
+            num_failed_batches += 1
+            continue
+
+        reports_inserted += batch_inserted
+        reports_duplicate += batch_duplicate
+        logger.info('Progress bulk loading aircraft reports list into DB: {}/{}'.format(
+            min(batch_start + batch_size, num_reports), num_reports))
+
+    logger.info('Bulk load complete: {} inserted, {} duplicates skipped'.format(reports_inserted, reports_duplicate))
+
+    if num_failed_batches:
+        raise BulkLoadError(num_failed_batches, num_batches, reports_inserted, reports_duplicate)
+
+    return reports_inserted, reports_duplicate
+
+
+def get_db_rows_for_reports(aircraft_reports_list, radio_receiver):
+    """
+    Rows (see AircraftReport.to_db_row) for the reports with a valid position, stamped with the receiver's name
+
+    :param aircraft_reports_list: list of AircraftReport objects, or a columnar ReportBatch
+    :param radio_receiver: RadioReceiver that the reports came from
+    :return: list of row tuples in staging_column_names order
+    """
+    if is_report_batch(aircraft_reports_list):
+        return prepare_report_batch_for_db(aircraft_reports_list, radio_receiver).to_db_rows()
+
+    db_rows = []
+    for aircraft in aircraft_reports_list:
         if aircraft.validposition and aircraft.validtrack:
             aircraft.reporter = radio_receiver.name
-            if dbconn:
-                try:
-                    aircraft.send_aircraft_to_db(dbconn)
-                except:
-                    logger.exception('Issue inserting into DB: {}'.format(aircraft))
-            else:
-                logger.error('No DB Connection. Aircraft not inserted; {}'.format(aircraft))
+            db_rows.append(aircraft.to_db_row())
         else:
-            logger.error("Dropped report - no valid position or no validtrack found: {}".format(aircraft.to_JSON()))
+            logger.error("Dropped report - no valid position or no validtrack found: {}".format(aircraft.to_json()))
+    return db_rows
 
-    if dbconn:
-        dbconn.commit()
+
+def is_report_batch(aircraft_reports):
+    """Whether the reports are a columnar ReportBatch rather than a list of report objects"""
+    return hasattr(aircraft_reports, 'to_db_rows')
+
+
+def prepare_report_batch_for_db(report_batch, radio_receiver):
+    """
+    Vectorised equivalent of the per-report prep done by the loaders: convert to metric, stamp the reporter and
+    drop reports without a valid position
+
+    :param report_batch: ReportBatch
+    :param radio_receiver: RadioReceiver that the reports came from
+    :return: ReportBatch ready to be written
+    """
+    report_batch.convert_to_metric()
+    report_batch.reporter = radio_receiver.name
+
+    valid_mask = report_batch.valid_position_mask()
+    num_invalid = len(report_batch) - int(valid_mask.sum())
+    if num_invalid:
+        logger.error('Dropped {} reports from batch - no valid position found'.format(num_invalid))
+        report_batch = report_batch.filter(valid_mask)
+
+    return report_batch
+
+
+# Staging table columns, in the same order as AircraftReport.to_db_row().
+# Numeric columns are all DOUBLE PRECISION so that float epochs/tracks from the archives COPY cleanly, and are
+# cast to the aircraftreports column types during the merge
+staging_table_name = 'aircraftreports_staging'
+staging_column_names = ['mode_s_hex', 'squawk', 'flight', 'is_metric', 'is_mlat', 'altitude', 'speed', 'vert_rate',
+                        'bearing', 'longitude83', 'latitude83', 'messages_sent', 'report_epoch', 'reporter',
+                        'rssi', 'nucp', 'is_ground', 'is_anon']
+
+# Rows stamped by an ItineraryTracker have the itinerary ID appended
+stamped_column_names = staging_column_names + ['itinerary_id']
+
+create_staging_table_sql = \
+    '''CREATE TEMP TABLE IF NOT EXISTS aircraftreports_staging (
+         mode_s_hex TEXT, squawk TEXT, flight TEXT, is_metric BOOLEAN, is_mlat BOOLEAN,
+         altitude DOUBLE PRECISION, speed DOUBLE PRECISION, vert_rate DOUBLE PRECISION, bearing DOUBLE PRECISION,
+         longitude83 DOUBLE PRECISION, latitude83 DOUBLE PRECISION, messages_sent DOUBLE PRECISION,
+         report_epoch DOUBLE PRECISION, reporter TEXT, rssi DOUBLE PRECISION, nucp DOUBLE PRECISION,
+         is_ground BOOLEAN, is_anon BOOLEAN, itinerary_id TEXT)
+       ON COMMIT DELETE ROWS'''
+
+# DISTINCT ON removes duplicates within the batch itself, ON CONFLICT removes the ones already in the table
+merge_staging_table_sql = \
+    '''INSERT INTO aircraftreports (mode_s_hex, squawk, flight, is_metric, is_mlat, altitude, speed, vert_rate,
+                                  bearing, report_location, latitude83, longitude83, messages_sent, report_epoch,
+                                  reporter, rssi, nucp, is_ground, is_anon, itinerary_id)
+         SELECT DISTINCT ON (staged.mode_s_hex, staged.epoch_int)
+                staged.mode_s_hex, staged.squawk, staged.flight, staged.is_metric, staged.is_mlat,
+                staged.altitude, staged.speed, staged.vert_rate, staged.bearing,
+                ST_SetSRID(ST_MakePoint(staged.longitude83, staged.latitude83), 4326)::GEOGRAPHY,
+                staged.latitude83, staged.longitude83, staged.messages_sent, staged.epoch_int,
+                staged.reporter, staged.rssi, staged.nucp, staged.is_ground, staged.is_anon, staged.itinerary_id
+           FROM (SELECT aircraftreports_staging.*, ROUND(aircraftreports_staging.report_epoch)::INTEGER AS epoch_int
+                   FROM aircraftreports_staging) AS staged
+          ORDER BY staged.mode_s_hex, staged.epoch_int
+       ON CONFLICT DO NOTHING'''
+
+
+# Server-side prepared statements for the live (non-COPY) path, see utils.postgres.PreparedStatement.
+# Their parameters are in staging_column_names order, like AircraftReport.to_db_row()
+db_row_param_types = ['TEXT', 'TEXT', 'TEXT', 'BOOLEAN', 'BOOLEAN', 'DOUBLE PRECISION', 'DOUBLE PRECISION',
+                      'DOUBLE PRECISION', 'DOUBLE PRECISION', 'DOUBLE PRECISION', 'DOUBLE PRECISION',
+                      'DOUBLE PRECISION', 'DOUBLE PRECISION', 'TEXT', 'DOUBLE PRECISION', 'DOUBLE PRECISION',
+                      'BOOLEAN', 'BOOLEAN']
+
+aircraftreports_insert_columns = \
+    '''mode_s_hex, squawk, flight, is_metric, is_mlat, altitude, speed, vert_rate, bearing, report_location,
+       latitude83, longitude83, messages_sent, report_epoch, reporter, rssi, nucp, is_ground, is_anon'''
+
+insert_report_statement = pg_utils.PreparedStatement(
+    'insert_aircraftreport',
+    '''INSERT INTO aircraftreports ({})
+       VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, ST_SetSRID(ST_MakePoint($10, $11), 4326)::GEOGRAPHY,
+               $11, $10, $12, $13, $14, $15, $16, $17, $18)
+       ON CONFLICT DO NOTHING'''.format(aircraftreports_insert_columns),
+    db_row_param_types)
+
+# One array per column (stamped_column_names), so a whole batch is a single EXECUTE with an accurate row count
+insert_reports_batch_statement = pg_utils.PreparedStatement(
+    'insert_aircraftreports_batch',
+    '''INSERT INTO aircraftreports ({}, itinerary_id)
+       SELECT r.mode_s_hex, r.squawk, r.flight, r.is_metric, r.is_mlat, r.altitude, r.speed, r.vert_rate,
+              r.bearing, ST_SetSRID(ST_MakePoint(r.longitude83, r.latitude83), 4326)::GEOGRAPHY,
+              r.latitude83, r.longitude83, r.messages_sent, r.report_epoch, r.reporter, r.rssi, r.nucp,
+              r.is_ground, r.is_anon, r.itinerary_id
+         FROM unnest($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, $17, $18, $19)
+              AS r ({})
+       ON CONFLICT DO NOTHING'''.format(aircraftreports_insert_columns, ', '.join(stamped_column_names)),
+    [param_type + '[]' for param_type in db_row_param_types + ['TEXT']])
+
+update_report_statement = pg_utils.PreparedStatement(
+    'update_aircraftreport',
+    '''UPDATE aircraftreports SET ({}) =
+         ($1, $2, $3, $4, $5, $6, $7, $8, $9, ST_SetSRID(ST_MakePoint($10, $11), 4326)::GEOGRAPHY,
+          $11, $10, $12, $13, $14, $15, $16, $17, $18)
+       WHERE mode_s_hex = $19 AND squawk = $20 AND flight = $21 AND reporter = $22
+         AND report_epoch = $23 AND messages_sent = $24'''.format(aircraftreports_insert_columns),
+    db_row_param_types + ['TEXT', 'TEXT', 'TEXT', 'TEXT', 'DOUBLE PRECISION', 'DOUBLE PRECISION'])
+
+delete_report_statement = pg_utils.PreparedStatement(
+    'delete_aircraftreport',
+    '''DELETE FROM aircraftreports
+       WHERE mode_s_hex = $1 AND flight = $2 AND reporter = $3 AND report_epoch = $4
+         AND altitude = $5 AND speed = $6 AND messages_sent = $7''',
+    ['TEXT', 'TEXT', 'TEXT', 'DOUBLE PRECISION', 'DOUBLE PRECISION', 'DOUBLE PRECISION', 'DOUBLE PRECISION'])
+
+# Rows per EXECUTE of the prepared batch insert
+insert_batch_size = 1000
+
+
+def insert_db_rows_into_aircraftreports(dbconn, db_rows, batch_size=insert_batch_size, itinerary_tracker=None):
+    """
+    Insert rows (see AircraftReport.to_db_row) with the prepared batch insert, batch_size rows per EXECUTE.
+    For the small, frequent batches of the live path, where a COPY through the staging table is overkill.
+    Does not commit.
+
+    :param dbconn: Open database connection
+    :param db_rows: list of row tuples in staging_column_names order
+    :param batch_size: rows per EXECUTE
+    :param itinerary_tracker: optional ItineraryTracker that stamps each row's itinerary_id
+    :return: tuple of (number of rows inserted, number of duplicate rows skipped)
+    """
+    if itinerary_tracker is not None:
+        db_rows = itinerary_tracker.stamp_db_rows(db_rows)
+
+    cur = dbconn.cursor()
+    num_inserted = 0
+    for batch_start in range(0, len(db_rows), batch_size):
+        batch_rows = db_rows[batch_start:batch_start + batch_size]
+        # Transpose the rows into one list per column
+        db_columns = [list(db_column) for db_column in zip(*batch_rows)]
+        if itinerary_tracker is None:
+            db_columns.append([None] * len(batch_rows))
+        num_inserted += insert_reports_batch_statement.execute(cur, db_columns)
+    cur.close()
+
+    return num_inserted, len(db_rows) - num_inserted
+
+
+def merge_db_rows_into_aircraftreports(dbconn, db_rows, itinerary_tracker=None):
+    """
+    COPY a batch of rows (see AircraftReport.to_db_row) into the temp staging table and merge them into
+    aircraftreports. Does not commit.
+
+    :param dbconn: Open database connection
+    :param db_rows: list of row tuples in staging_column_names order
+    :param itinerary_tracker: optional ItineraryTracker that stamps each row's itinerary_id
+    :return: tuple of (number of rows inserted, number of duplicate rows skipped)
+    """
+    column_names = staging_column_names
+    if itinerary_tracker is not None:
+        db_rows = itinerary_tracker.stamp_db_rows(db_rows)
+        column_names = stamped_column_names
+
+    cur = dbconn.cursor()
+    cur.execute(create_staging_table_sql)
+    cur.execute('TRUNCATE {}'.format(staging_table_name))
+
+    num_staged = pg_utils.copy_rows_into_table(cur, staging_table_name, column_names, db_rows)
+
+    cur.execute(merge_staging_table_sql)
+    num_inserted = cur.rowcount
+    cur.close()
+
+    return num_inserted, num_staged - num_inserted
 
 
 def ingest_vrs_format_record(vrs_aircraft_report, report_pulled_timestamp):
@@ -480,57 +1246,21 @@ def ingest_vrs_format_record(vrs_aircraft_report, report_pulled_timestamp):
             logger.exception('VRS Record key is invalid: {}'.format(key_name))
             break
     if valid:
-        report_position_time = vrs_aircraft_report['PosTime'] / 1000
-        hex = vrs_aircraft_report['Icao'].upper()
-        altitude = vrs_aircraft_report['Alt']
-        speed = vrs_aircraft_report['Spd']
-        squawk = vrs_aircraft_report['Sqk']
-        if 'Call' in vrs_aircraft_report:
-            flight = flight_format.format(vrs_aircraft_report['Call'])
-        else:
-            flight = ' '
-        track = vrs_aircraft_report['Trak']
-        lon = vrs_aircraft_report['Long']
-        lat = vrs_aircraft_report['Lat']
-        is_ground = vrs_aircraft_report['Gnd']
-        messages = vrs_aircraft_report['CMsgs']
-        mlat = vrs_aircraft_report['Mlat']
-
-        if 'Vsi' in vrs_aircraft_report:
-            vert_rate = vrs_aircraft_report['Vsi']
-        else:
-            vert_rate = 0.0
-        is_metric = False
         if report_pulled_timestamp is not None:
-            seen = seen_pos = (report_pulled_timestamp - report_position_time)
+            seen = seen_pos = (report_pulled_timestamp - vrs_aircraft_report['PosTime'] / 1000)
         else:
-            seen_pos = 0
-        plane = AircraftReport(hex=hex,
-                               time=report_position_time,
-                               speed=speed,
-                               squawk=squawk,
-                               flight=flight,
-                               altitude=altitude,
-                               isMetric=is_metric,
-                               track=track,
-                               lon=lon,
-                               lat=lat,
-                               vert_rate=vert_rate,
-                               seen=seen,
-                               validposition=1,
-                               validtrack=1,
-                               reporter="",
-                               mlat=mlat,
-                               is_ground=is_ground,
-                               report_location=None,
-                               messages=messages,
-                               seen_pos=seen_pos,
-                               category=None)
-
-        return plane
-
-
-def ingest_dump1090_report_list(dumpfmt_aircraft_report_list):
+            seen = seen_pos = 0
+
+        return CompactAircraftReport.from_vrs(vrs_aircraft_report, seen=seen, seen_pos=seen_pos)
+
+
+def ingest_dump1090_report_list(dumpfmt_aircraft_report_list, snapshot_epoch=None):
+    """
+    :param dumpfmt_aircraft_report_list: list of aircraft dicts from the 'aircraft' key of dump1090's aircraft.json
+    :param snapshot_epoch: the 'now' value of the aircraft.json snapshot, used to work out the epoch of each
+                           aircraft's last position from its seen_pos (or seen) age
+    :return: list of CompactAircraftReport objects
+    """
     dump1090_ingested_reports_list = []
     for dumpfmt_aircraft_report in dumpfmt_aircraft_report_list:
         valid = True
@@ -539,24 +1269,10 @@ def ingest_dump1090_report_list(dumpfmt_aircraft_report_list):
                 valid = False
                 break
         if valid:
-            if dumpfmt_aircraft_report['altitude'] == 'ground':
-                dumpfmt_aircraft_report['altitude'] = 0
-                dump1090_aircraft_report = AircraftReport(**dumpfmt_aircraft_report)
-                setattr(dump1090_aircraft_report, 'is_ground', True)
-            else:
-                dump1090_aircraft_report = AircraftReport(**dumpfmt_aircraft_report)
-                setattr(dump1090_aircraft_report, 'is_ground', False)
-            setattr(dump1090_aircraft_report, 'validposition', 1)
-            setattr(dump1090_aircraft_report, 'validtrack', 1)
-
-            # mutability dump1090 has mlat set to list of attributes mlat'ed, we want a boolean
-            if 'mlat' not in dumpfmt_aircraft_report:
-                setattr(dump1090_aircraft_report, 'mlat', False)
-            else:
-                setattr(dump1090_aircraft_report, 'mlat', True)
-
-            setattr(dump1090_aircraft_report, 'mode_s_hex', dumpfmt_aircraft_report['hex'])
-            logger.debug(dump1090_aircraft_report.to_json())
+            dump1090_aircraft_report = CompactAircraftReport.from_dump1090(dumpfmt_aircraft_report,
+                                                                           snapshot_epoch=snapshot_epoch)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(dump1090_aircraft_report.to_json())
 
             dump1090_ingested_reports_list.append(dump1090_aircraft_report)
 
@@ -570,6 +1286,13 @@ def clean_malformed_json_file(json_file):
     in_file = open(json_file).read()
     out_file = open(json_file, 'w')
 
+    out_file.write(clean_malformed_json_text(in_file))
+    out_file.close()
+
+    return json_file
+
+
+def clean_malformed_json_text(in_file):
     # combos of strings in k,v pairs to find and replace, eg. 'findthis', 'replacewiththis'
     find_replace_dict = {',,{': '{',
                          ',{': '{',
@@ -579,7 +1302,4 @@ def clean_malformed_json_file(json_file):
     for find_replace_combo in find_replace_dict.keys():
         in_file = in_file.replace(find_replace_combo, find_replace_dict[find_replace_combo])
 
-    out_file.write(in_file)
-    out_file.close()
-
-    return json_file
+    return in_file
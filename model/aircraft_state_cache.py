@@ -0,0 +1,103 @@
+"""
+In-memory cache of the last persisted position of each aircraft seen by a receiver, used to drop reports that
+don't carry a new position before they are sent to the DB
+"""
+
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Aircraft not seen in any poll for this many seconds are evicted from the cache
+default_state_ttl_sec = 300
+
+
+def position_signature(aircraft_report):
+    """
+    The parts of a report that change when the aircraft has a new position. Epoch is rounded to whole seconds, as
+    Postgres does when it stores the report_epoch column that the (mode_s_hex, report_epoch) unique constraint is on.
+
+    :param aircraft_report: AircraftReport object
+    :return: tuple of (lat, lon, whole second epoch)
+    """
+    return aircraft_report.lat, aircraft_report.lon, int(round(aircraft_report.time))
+
+
+class AircraftStateCache(object):
+    """
+    Remembers, per mode_s_hex, the position signature of the last report that was persisted and the last time the
+    aircraft showed up in a poll at all
+    """
+
+    def __init__(self, ttl_sec=default_state_ttl_sec):
+        self.ttl_sec = ttl_sec
+        # mode_s_hex -> position signature of the last persisted report
+        self.persisted_positions = {}
+        # mode_s_hex -> wall clock time the aircraft was last seen in a poll
+        self.last_seen_times = {}
+
+        self.reports_checked = 0
+        self.reports_skipped = 0
+        # Aircraft in the last get_changed_reports call that weren't already in the cache
+        self.last_new_aircraft_count = 0
+
+    def __len__(self):
+        return len(self.last_seen_times)
+
+    def get_changed_reports(self, aircraft_reports_list, now=None):
+        """
+        Filter out the reports whose position is the same as the last one persisted for that aircraft
+
+        :param aircraft_reports_list: list of AircraftReport objects from one poll
+        :param now: wall clock time of the poll (defaults to time.time())
+        :return: list of AircraftReport objects that carry a new position
+        """
+        if now is None:
+            now = time.time()
+
+        changed_reports_list = []
+        num_new_aircraft = 0
+        for aircraft in aircraft_reports_list:
+            if aircraft.mode_s_hex not in self.last_seen_times:
+                num_new_aircraft += 1
+            self.last_seen_times[aircraft.mode_s_hex] = now
+            if self.persisted_positions.get(aircraft.mode_s_hex) != position_signature(aircraft):
+                changed_reports_list.append(aircraft)
+
+        num_skipped = len(aircraft_reports_list) - len(changed_reports_list)
+        self.reports_checked += len(aircraft_reports_list)
+        self.reports_skipped += num_skipped
+        self.last_new_aircraft_count = num_new_aircraft
+        logger.debug('State cache skipped {}/{} unchanged reports'.format(num_skipped, len(aircraft_reports_list)))
+
+        return changed_reports_list
+
+    def mark_persisted(self, aircraft_reports_list):
+        """
+        Record the positions of reports that have been written to the DB
+
+        :param aircraft_reports_list: list of AircraftReport objects that were loaded
+        """
+        for aircraft in aircraft_reports_list:
+            self.persisted_positions[aircraft.mode_s_hex] = position_signature(aircraft)
+
+    def evict_stale(self, now=None):
+        """
+        Drop every aircraft that hasn't been seen in a poll for longer than ttl_sec
+
+        :param now: wall clock time to measure staleness from (defaults to time.time())
+        :return: number of aircraft evicted
+        """
+        if now is None:
+            now = time.time()
+
+        stale_mode_s_hexes = [mode_s_hex for mode_s_hex, last_seen in self.last_seen_times.items()
+                              if now - last_seen > self.ttl_sec]
+        for mode_s_hex in stale_mode_s_hexes:
+            del self.last_seen_times[mode_s_hex]
+            self.persisted_positions.pop(mode_s_hex, None)
+
+        if stale_mode_s_hexes:
+            logger.debug('Evicted {} stale aircraft from the state cache'.format(len(stale_mode_s_hexes)))
+
+        return len(stale_mode_s_hexes)
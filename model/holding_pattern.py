@@ -0,0 +1,372 @@
+"""
+Holding pattern detection over an itinerary's track, in place of the find_pattern_num plpgsql function of
+sql/pattern_finder.sql. That function rebuilds ST_BuildArea(ST_Node(line)) on every point once the line passes
+50 points, which is quadratic per itinerary. Here the track is walked once, and each new segment is only tested
+against the earlier segments of the line that share a cell of a uniform grid with it.
+
+The semantics follow find_pattern_num: the line grows point by point, a pattern is reported at the first point
+where the line has more than min_vertices points and has crossed (or touched) itself, and the next line starts
+from that point. Coordinates are planar lon/lat degrees, as they are for the geometry functions in SQL.
+
+Known deviations from find_pattern_num, whose pattern is ST_BuildArea of the whole noded line:
+- Each crossing adds the loop from the crossed segment to the crossing as one ring. A ring nested inside another
+  is a hole, as it is in ST_BuildArea, but rings that partly overlap each other have the overlap counted in both
+  instead of once.
+- A loop that runs around an earlier, smaller loop of the same line is a self-intersecting ring, which the shoelace
+  area counts lobe by lobe with their winding rather than as ST_BuildArea's faces.
+Both only change the centroid (and polygon) of patterns made of several loops. The pattern count and vertex counts
+follow find_pattern_num. benchmarks/bench_holding_patterns.py --validate compares the two on real itineraries.
+"""
+
+import logging
+import math
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# find_pattern_num only checks lines of more than 50 points
+default_min_vertices = 50
+
+# Grid cell size, as a multiple of the track's median segment length
+grid_cell_segment_lengths = 4
+
+# Cell size used when every segment of the track has zero length
+default_grid_cell_size = 0.01
+
+# Segments spanning more cells than this (e.g. across a gap in coverage) are kept out of the grid, and tested
+# against every new segment instead
+max_cells_per_segment = 64
+
+
+class HoldingPattern(object):
+    """
+    One pattern found in a track - the same outputs as a row of find_pattern_num
+    """
+
+    def __init__(self, pattern_number, rings, start_end, centroid, num_vertices, point_index):
+        """
+        :param pattern_number: 1 for the first pattern of the track, 2 for the next...
+        :param rings: list of closed rings (each a (n, 2) array of lon/lat) enclosed by the line
+        :param start_end: (lon, lat) where the track crossed itself to close the pattern
+        :param centroid: (lon, lat) area weighted centroid of the rings
+        :param num_vertices: number of points in the line when the pattern was found
+        :param point_index: index in the track of the point the pattern was found at
+        """
+        self.pattern_number = pattern_number
+        self.rings = rings
+        self.start_end = start_end
+        self.centroid = centroid
+        self.num_vertices = num_vertices
+        self.point_index = point_index
+
+    def __repr__(self):
+        return 'HoldingPattern(pattern_number={}, centroid={}, num_vertices={}, point_index={})'.format(
+            self.pattern_number, self.centroid, self.num_vertices, self.point_index)
+
+    def get_polygon_wkt(self):
+        """
+        :return: WKT of the pattern's POLYGON (MULTIPOLYGON if the line enclosed more than one ring outside of the
+                 others), with the rings nested inside another as its holes
+        """
+        ring_nesting = get_ring_nesting(self.rings)
+        ring_depths = ring_nesting.sum(axis=1)
+
+        polygon_wkts = []
+        for shell_num in np.flatnonzero(ring_depths % 2 == 0):
+            # The holes of a shell are the rings directly inside it
+            polygon_rings = [self.rings[shell_num]] + [
+                self.rings[hole_num] for hole_num in np.flatnonzero(ring_nesting[:, shell_num])
+                if ring_depths[hole_num] == ring_depths[shell_num] + 1]
+            polygon_wkts.append('({})'.format(', '.join(
+                '({})'.format(', '.join('{} {}'.format(lon, lat) for lon, lat in ring)) for ring in polygon_rings)))
+
+        if len(polygon_wkts) == 1:
+            return 'POLYGON{}'.format(polygon_wkts[0])
+        return 'MULTIPOLYGON({})'.format(', '.join(polygon_wkts))
+
+
+class SegmentGrid(object):
+    """
+    Uniform grid of the segments of a line, keyed by (column, row) of the cells each segment's bounding box covers
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.oversized_segments = []
+
+    def clear(self):
+        self.cells = {}
+        self.oversized_segments = []
+
+    def get_cells(self, cell_bounds):
+        min_col, min_row, max_col, max_row = cell_bounds
+        return [(col, row) for col in range(min_col, max_col + 1) for row in range(min_row, max_row + 1)]
+
+    def add(self, segment_index, cell_bounds):
+        min_col, min_row, max_col, max_row = cell_bounds
+        if (max_col - min_col + 1) * (max_row - min_row + 1) > max_cells_per_segment:
+            self.oversized_segments.append(segment_index)
+            return
+        for cell in self.get_cells(cell_bounds):
+            cell_segments = self.cells.get(cell)
+            if cell_segments is None:
+                self.cells[cell] = [segment_index]
+            else:
+                cell_segments.append(segment_index)
+
+    def get_segment_cell_bounds(self, from_lon, from_lat, to_lon, to_lat):
+        """
+        :return: list of [min col, min row, max col, max row] of the cells covered by a segment's bounding box
+        """
+        from_col = int(math.floor(from_lon / self.cell_size))
+        from_row = int(math.floor(from_lat / self.cell_size))
+        to_col = int(math.floor(to_lon / self.cell_size))
+        to_row = int(math.floor(to_lat / self.cell_size))
+        return [min(from_col, to_col), min(from_row, to_row), max(from_col, to_col), max(from_row, to_row)]
+
+    def remove(self, segment_index, cell_bounds):
+        """Take a segment added with the same cell_bounds back out of the grid"""
+        min_col, min_row, max_col, max_row = cell_bounds
+        if (max_col - min_col + 1) * (max_row - min_row + 1) > max_cells_per_segment:
+            self.oversized_segments.remove(segment_index)
+            return
+        for cell in self.get_cells(cell_bounds):
+            cell_segments = self.cells[cell]
+            cell_segments.remove(segment_index)
+            if not cell_segments:
+                del self.cells[cell]
+
+    def get_candidates(self, cell_bounds):
+        """
+        :return: set of the indexes of segments that may intersect a segment within cell_bounds
+        """
+        min_col, min_row, max_col, max_row = cell_bounds
+        candidates = set(self.oversized_segments)
+        if (max_col - min_col + 1) * (max_row - min_row + 1) > max_cells_per_segment:
+            for cell_segments in self.cells.values():
+                candidates.update(cell_segments)
+            return candidates
+        for cell in self.get_cells(cell_bounds):
+            cell_segments = self.cells.get(cell)
+            if cell_segments is not None:
+                candidates.update(cell_segments)
+        return candidates
+
+
+def get_grid_cell_size(lons, lats):
+    """
+    :return: grid cell size (degrees) suited to the track, a few times its median segment length
+    """
+    segment_lengths = np.hypot(np.diff(lons), np.diff(lats))
+    segment_lengths = segment_lengths[segment_lengths > 0]
+    if not len(segment_lengths):
+        return default_grid_cell_size
+    return float(np.median(segment_lengths)) * grid_cell_segment_lengths
+
+
+def get_ring_area_centroid(ring):
+    """
+    :param ring: (n, 2) array of a closed ring's lon/lat, first point repeated at the end
+    :return: tuple of (area, centroid lon, centroid lat). The area is signed, positive for counter clockwise rings.
+    """
+    # Relative to the first point, so the products don't lose precision
+    origin = ring[0]
+    ring_x = ring[:, 0] - origin[0]
+    ring_y = ring[:, 1] - origin[1]
+    cross_products = ring_x[:-1] * ring_y[1:] - ring_x[1:] * ring_y[:-1]
+    area = cross_products.sum() / 2.0
+    if area == 0:
+        return 0.0, float(origin[0]), float(origin[1])
+    centroid_x = ((ring_x[:-1] + ring_x[1:]) * cross_products).sum() / (6.0 * area)
+    centroid_y = ((ring_y[:-1] + ring_y[1:]) * cross_products).sum() / (6.0 * area)
+    return float(area), float(centroid_x + origin[0]), float(centroid_y + origin[1])
+
+
+def get_points_in_ring(lons, lats, ring):
+    """
+    :param lons: longitudes of the points (array)
+    :param lats: latitudes of the points (array)
+    :param ring: (n, 2) array of a closed ring's lon/lat
+    :return: boolean array, True for the points inside the ring (even-odd rule)
+    """
+    start_x = ring[:-1, 0]
+    start_y = ring[:-1, 1]
+    end_x = ring[1:, 0]
+    end_y = ring[1:, 1]
+    point_x = np.asarray(lons)[:, np.newaxis]
+    point_y = np.asarray(lats)[:, np.newaxis]
+
+    # Count the ring edges crossed by a ray from each point towards +x
+    straddles = (start_y > point_y) != (end_y > point_y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing_x = start_x + (point_y - start_y) * (end_x - start_x) / (end_y - start_y)
+    return (straddles & (point_x < crossing_x)).sum(axis=1) % 2 == 1
+
+
+def get_ring_nesting(rings):
+    """
+    :return: (n, n) boolean array, True at [i, j] if ring i lies entirely inside ring j
+    """
+    ring_nesting = np.zeros((len(rings), len(rings)), dtype=bool)
+    for inner_num, inner_ring in enumerate(rings):
+        for outer_num, outer_ring in enumerate(rings):
+            if inner_num != outer_num:
+                ring_nesting[inner_num, outer_num] = get_points_in_ring(inner_ring[:-1, 0], inner_ring[:-1, 1],
+                                                                        outer_ring).all()
+    return ring_nesting
+
+
+def get_rings_centroid(rings):
+    """
+    :return: (lon, lat) area weighted centroid of the rings, like ST_Centroid of the (multi)polygon ST_BuildArea
+             makes of them - a ring nested inside an odd number of others is a hole, so its area is taken away
+    """
+    if len(rings) == 1:
+        return get_ring_area_centroid(rings[0])[1:]
+
+    ring_depths = get_ring_nesting(rings).sum(axis=1)
+    total_area = 0.0
+    weighted_lon = 0.0
+    weighted_lat = 0.0
+    for ring, ring_depth in zip(rings, ring_depths):
+        area, centroid_lon, centroid_lat = get_ring_area_centroid(ring)
+        area = -abs(area) if ring_depth % 2 else abs(area)
+        total_area += area
+        weighted_lon += area * centroid_lon
+        weighted_lat += area * centroid_lat
+    return weighted_lon / total_area, weighted_lat / total_area
+
+
+def find_segment_crossing(lons, lats, segment_end, candidate_ends):
+    """
+    Test the segment ending at point segment_end against a set of earlier segments, all at once
+
+    :param lons: track longitudes (array)
+    :param lats: track latitudes (array)
+    :param segment_end: index of the new segment's end point, it starts at segment_end - 1
+    :param candidate_ends: array of the end point indexes of the earlier segments
+    :return: tuple of (end point index of the crossed segment, crossing lon, crossing lat) for the crossing nearest
+             the start of the new segment, or None if it doesn't cross any of them
+    """
+    start_x = lons[segment_end - 1]
+    start_y = lats[segment_end - 1]
+    delta_x = lons[segment_end] - start_x
+    delta_y = lats[segment_end] - start_y
+
+    candidate_start_x = lons[candidate_ends - 1]
+    candidate_start_y = lats[candidate_ends - 1]
+    candidate_delta_x = lons[candidate_ends] - candidate_start_x
+    candidate_delta_y = lats[candidate_ends] - candidate_start_y
+
+    offset_x = candidate_start_x - start_x
+    offset_y = candidate_start_y - start_y
+
+    # Parallel (and collinear) segments have a zero denominator, and don't enclose anything
+    denominator = delta_x * candidate_delta_y - delta_y * candidate_delta_x
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Crossing at start + along_new * delta == candidate start + along_candidate * candidate delta
+        along_new = (offset_x * candidate_delta_y - offset_y * candidate_delta_x) / denominator
+        along_candidate = (offset_x * delta_y - offset_y * delta_x) / denominator
+    is_crossing = ((denominator != 0) & (along_new >= 0) & (along_new <= 1) &
+                   (along_candidate >= 0) & (along_candidate <= 1))
+
+    if not is_crossing.any():
+        return None
+
+    crossing_index = np.flatnonzero(is_crossing)[np.argmin(along_new[is_crossing])]
+    return (int(candidate_ends[crossing_index]),
+            float(start_x + along_new[crossing_index] * delta_x),
+            float(start_y + along_new[crossing_index] * delta_y))
+
+
+def get_loop_ring(lons, lats, segment_end, crossing):
+    """
+    :param segment_end: index of the end point of the segment that crossed the line
+    :param crossing: tuple of (end point index of the crossed segment, crossing lon, crossing lat), see
+                     find_segment_crossing
+    :return: (n, 2) array of the closed ring running from the crossing, along the track from the crossed segment,
+             back to the crossing
+    """
+    crossed_end, crossing_lon, crossing_lat = crossing
+    ring = np.empty((segment_end - crossed_end + 2, 2))
+    ring[0] = ring[-1] = (crossing_lon, crossing_lat)
+    ring[1:-1, 0] = lons[crossed_end:segment_end]
+    ring[1:-1, 1] = lats[crossed_end:segment_end]
+    return ring
+
+
+def find_holding_patterns(lons, lats, min_vertices=default_min_vertices, cell_size=None):
+    """
+    Find the patterns (loops) flown in a track, with the same results as find_pattern_num on the itinerary
+
+    :param lons: longitudes of the track's points, in report_epoch order
+    :param lats: latitudes of the track's points, in report_epoch order
+    :param min_vertices: a pattern is only reported once the line has more points than this
+    :param cell_size: grid cell size in degrees, defaults to a few times the median segment length
+    :return: list of HoldingPattern
+    """
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    num_points = len(lons)
+    if num_points < 2:
+        return []
+
+    if cell_size is None:
+        cell_size = get_grid_cell_size(lons, lats)
+
+    # Cells covered by the bounding box of the segment ending at each point, for every point at once
+    point_cols = np.floor(lons / cell_size).astype(np.int64)
+    point_rows = np.floor(lats / cell_size).astype(np.int64)
+    segment_cell_bounds = np.column_stack([np.minimum(point_cols[:-1], point_cols[1:]),
+                                           np.minimum(point_rows[:-1], point_rows[1:]),
+                                           np.maximum(point_cols[:-1], point_cols[1:]),
+                                           np.maximum(point_rows[:-1], point_rows[1:])]).tolist()
+    is_zero_length = ((lons[1:] == lons[:-1]) & (lats[1:] == lats[:-1])).tolist()
+
+    grid = SegmentGrid(cell_size)
+    patterns = []
+    is_line_started = False
+    num_vertices = 0
+    last_segment_end = None
+    rings = []
+    start_end = None
+
+    for segment_end in range(1, num_points):
+        segment_num = segment_end - 1
+        if not is_line_started:
+            # The line (re)starts with this segment
+            is_line_started = True
+            num_vertices = 2
+            grid.clear()
+            last_segment_end = None
+            rings = []
+        elif is_zero_length[segment_num] and segment_num > 0 and is_zero_length[segment_num - 1]:
+            # find_pattern_num skips a segment identical to the previous one
+            continue
+        else:
+            num_vertices += 1
+
+        if not is_zero_length[segment_num]:
+            cell_bounds = segment_cell_bounds[segment_num]
+            candidates = grid.get_candidates(cell_bounds)
+            # The previous segment always touches this one where they join
+            candidates.discard(last_segment_end)
+            if candidates:
+                crossing = find_segment_crossing(lons, lats, segment_end, np.fromiter(candidates, dtype=np.int64))
+                if crossing is not None:
+                    ring = get_loop_ring(lons, lats, segment_end, crossing)
+                    if get_ring_area_centroid(ring)[0] != 0:
+                        rings.append(ring)
+                        start_end = (float(ring[0, 0]), float(ring[0, 1]))
+
+            grid.add(segment_end, cell_bounds)
+            last_segment_end = segment_end
+
+        if rings and num_vertices > min_vertices:
+            patterns.append(HoldingPattern(len(patterns) + 1, rings, start_end, get_rings_centroid(rings),
+                                           num_vertices, segment_end))
+            is_line_started = False
+
+    return patterns
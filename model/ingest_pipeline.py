@@ -0,0 +1,388 @@
+"""
+Staged live ingest pipeline: one fetcher thread per receiver, a parser thread and a DB writer thread, joined by
+bounded queues. A slow DB commit backs up the write queue instead of delaying the next poll, and each queue has an
+explicit policy for what happens when it fills up. With a ReportSpool, reports that would be dropped, or that
+can't be written because the DB is down, are spooled to disk and replayed later instead of being lost.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+from model import aircraft_report
+from model import aircraft_state_cache
+from model import receiver_poller
+
+logger = logging.getLogger(__name__)
+
+# What a full queue does with a new item:
+#   block - the producer waits (up to put_timeout_sec) for space, which slows the upstream stage down
+#   drop_newest - the new item is discarded
+#   drop_oldest - the oldest queued item is discarded to make room for the new one
+drop_policies = ('block', 'drop_newest', 'drop_oldest')
+
+default_queue_size = 100
+default_drop_policy = 'drop_oldest'
+
+# The writer commits after this many polls, or once the oldest uncommitted poll is this old
+default_max_coalesce_polls = 10
+default_max_coalesce_sec = 2.0
+
+# Seconds between logs of the queue depths
+default_stats_interval_sec = 60
+
+# Min seconds between attempts to reopen the writer's DB connection after it's lost
+default_reconnect_wait_sec = 30
+
+
+class StageQueue(object):
+    """
+    Bounded queue between two pipeline stages, which applies a drop policy when full and counts what it drops.
+    If an overflow_handler is given, every item the policy drops is passed to it instead of being discarded.
+    """
+
+    def __init__(self, name, maxsize=default_queue_size, drop_policy=default_drop_policy, put_timeout_sec=None,
+                 overflow_handler=None):
+        if drop_policy not in drop_policies:
+            raise ValueError('Unknown queue drop policy {}, expected one of {}'.format(drop_policy, drop_policies))
+        self.name = name
+        self.drop_policy = drop_policy
+        self.put_timeout_sec = put_timeout_sec
+        self.overflow_handler = overflow_handler
+        self.items = queue.Queue(maxsize=maxsize)
+        self.dropped_count = 0
+        self.dropped_count_lock = threading.Lock()
+
+    def depth(self):
+        return self.items.qsize()
+
+    def put(self, item):
+        """
+        Add an item, applying the drop policy if the queue is full
+
+        :return: True if the item was queued, False if it was dropped
+        """
+        if self.drop_policy == 'block':
+            try:
+                self.items.put(item, timeout=self.put_timeout_sec)
+                return True
+            except queue.Full:
+                logger.warning('{} queue still full after {} sec, dropped item'.format(self.name,
+                                                                                     self.put_timeout_sec))
+                self.drop(item)
+                return False
+
+        if self.drop_policy == 'drop_newest':
+            try:
+                self.items.put_nowait(item)
+                return True
+            except queue.Full:
+                self.drop(item)
+                return False
+
+        # drop_oldest - loop since another producer could take the freed slot first
+        while True:
+            try:
+                self.items.put_nowait(item)
+                return True
+            except queue.Full:
+                try:
+                    self.drop(self.items.get_nowait())
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        """
+        :raises queue.Empty: if nothing arrives within timeout seconds
+        """
+        return self.items.get(timeout=timeout)
+
+    def drop(self, item):
+        with self.dropped_count_lock:
+            self.dropped_count += 1
+        if self.overflow_handler is not None:
+            try:
+                self.overflow_handler(item)
+            except:
+                logger.exception('Issue handing dropped item from {} queue to overflow handler'.format(self.name))
+
+
+class SnapshotFetcher(receiver_poller.ReceiverPoller):
+    """
+    ReceiverPoller that only fetches each aircraft.json snapshot and hands the raw bytes to the parser stage,
+    keeping the receiver's poll cadence independent of parsing and DB writes
+    """
+
+    def __init__(self, radio_receiver, snapshot_queue, poll_interval_sec, max_samples, **kwargs):
+        super(SnapshotFetcher, self).__init__(radio_receiver=radio_receiver,
+                                              dbconn=None,
+                                              poll_interval_sec=poll_interval_sec,
+                                              max_samples=max_samples,
+                                              **kwargs)
+        self.snapshot_queue = snapshot_queue
+
+    def poll_once(self):
+        snapshot = self.snapshot_client.fetch_snapshot()
+        self.poll_scheduler.record_latency(self.snapshot_client.last_fetch_latency_sec)
+        if snapshot is None:
+            self.poll_scheduler.record_unchanged()
+        else:
+            # The parser records the churn of this snapshot once it has been through the state cache
+            json_bytes, report_pulled_time = snapshot
+            self.snapshot_queue.put((self.radio_receiver, json_bytes, report_pulled_time))
+        return 0
+
+
+class ReportQueueProducer(object):
+    """
+    Report producer (see ReceiverPoller.report_producer) that feeds the pipeline's report queue, so receivers that
+    decode their own reports, like an SbsStreamReceiver, skip the snapshot and parser stages
+    """
+
+    def __init__(self, report_queue):
+        self.report_queue = report_queue
+
+    def append_reports(self, reports_list, radio_receiver):
+        self.report_queue.put((radio_receiver, reports_list))
+
+
+class IngestPipeline(object):
+    """
+    Fetchers -> snapshot queue -> parser -> report queue -> DB writer
+
+    The parser drops unchanged aircraft with a per-receiver AircraftStateCache. The writer coalesces several
+    polls into one transaction. With a report_spool, polls the report queue drops and polls the writer can't get
+    into the DB are spooled to disk, and the writer reopens its connection with db_connect once the DB is back.
+    With an itinerary_tracker, the writer stamps each report with its itinerary ID. With a pattern_monitor, the
+    writer checks each report for an aircraft completing a holding pattern loop as soon as it's queued.
+    """
+
+    def __init__(self, dbconn, snapshot_queue_size=default_queue_size, report_queue_size=default_queue_size,
+                 drop_policy=default_drop_policy, put_timeout_sec=None,
+                 max_coalesce_polls=default_max_coalesce_polls, max_coalesce_sec=default_max_coalesce_sec,
+                 state_ttl_sec=aircraft_state_cache.default_state_ttl_sec,
+                 stats_interval_sec=default_stats_interval_sec, report_spool=None, db_connect=None,
+                 reconnect_wait_sec=default_reconnect_wait_sec, itinerary_tracker=None, pattern_monitor=None):
+        self.dbconn = dbconn
+        self.report_spool = report_spool
+        self.itinerary_tracker = itinerary_tracker
+        self.pattern_monitor = pattern_monitor
+        self.db_connect = db_connect
+        self.reconnect_wait_sec = reconnect_wait_sec
+        self.last_reconnect_time = None
+        self.snapshot_queue = StageQueue('snapshot', snapshot_queue_size, drop_policy, put_timeout_sec)
+        self.report_queue = StageQueue('report', report_queue_size, drop_policy, put_timeout_sec,
+                                       overflow_handler=self.spool_poll if report_spool else None)
+        self.max_coalesce_polls = max_coalesce_polls
+        self.max_coalesce_sec = max_coalesce_sec
+        self.state_ttl_sec = state_ttl_sec
+        self.stats_interval_sec = stats_interval_sec
+
+        self.fetchers = []
+        self.state_caches = {}
+        self.poll_schedulers = {}
+        self.stop_event = threading.Event()
+        # Set once the parser has drained the snapshot queue and stopped, so nothing more joins the report queue
+        self.parser_done = threading.Event()
+
+        self.polls_written = 0
+        self.reports_written = 0
+        self.transactions_committed = 0
+        self.polls_spooled = 0
+
+    def add_receiver(self, radio_receiver, poll_interval_sec, max_samples, **fetcher_kwargs):
+        """
+        Add a fetcher for one receiver, with its own poll schedule. Extra keyword args go to the SnapshotFetcher
+        (request_timeout_sec, failure_wait_sec, max_failures, min_poll_interval_sec, max_poll_interval_sec).
+        """
+        fetcher = SnapshotFetcher(radio_receiver=radio_receiver,
+                                  snapshot_queue=self.snapshot_queue,
+                                  poll_interval_sec=poll_interval_sec,
+                                  max_samples=max_samples,
+                                  **fetcher_kwargs)
+        self.fetchers.append(fetcher)
+        self.poll_schedulers[radio_receiver.name] = fetcher.poll_scheduler
+        self.state_caches[radio_receiver.name] = aircraft_state_cache.AircraftStateCache(ttl_sec=self.state_ttl_sec)
+
+    def add_stream_receiver(self, stream_receiver_class, radio_receiver, max_samples, **receiver_kwargs):
+        """
+        Add a streaming receiver (e.g. sbs_stream.SbsStreamReceiver) that writes its reports straight to the
+        report queue. Extra keyword args go to stream_receiver_class.
+        """
+        self.fetchers.append(stream_receiver_class(radio_receiver=radio_receiver,
+                                                   dbconn=None,
+                                                   max_samples=max_samples,
+                                                   report_producer=ReportQueueProducer(self.report_queue),
+                                                   **receiver_kwargs))
+
+    def get_queue_depths(self):
+        """
+        :return: dict of queue name -> dict with the current depth, max size and number of items dropped
+        """
+        return {stage_queue.name: {'depth': stage_queue.depth(),
+                                   'maxsize': stage_queue.items.maxsize,
+                                   'dropped': stage_queue.dropped_count}
+                for stage_queue in (self.snapshot_queue, self.report_queue)}
+
+    def parse_snapshots(self):
+        """Parser stage - runs until stop_event is set and the snapshot queue is drained, then sets parser_done"""
+        try:
+            self.parse_snapshots_until_stopped()
+        finally:
+            self.parser_done.set()
+
+    def parse_snapshots_until_stopped(self):
+        while not (self.stop_event.is_set() and self.snapshot_queue.depth() == 0):
+            try:
+                radio_receiver, json_bytes, report_pulled_time = self.snapshot_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            try:
+                reports_list = aircraft_report.parse_aircraft_json(json_bytes, report_pulled_time)
+            except:
+                logger.exception('Issue parsing snapshot from receiver {}'.format(radio_receiver.name))
+                continue
+
+            # Positions are marked as persisted once they're queued - if the write is dropped or fails, the
+            # aircraft is written again as soon as it reports a new position
+            state_cache = self.state_caches[radio_receiver.name]
+            changed_reports_list = state_cache.get_changed_reports(reports_list, now=report_pulled_time)
+            state_cache.mark_persisted(changed_reports_list)
+            state_cache.evict_stale(now=report_pulled_time)
+            self.poll_schedulers[radio_receiver.name].record_churn(state_cache.last_new_aircraft_count,
+                                                                   len(changed_reports_list))
+
+            if changed_reports_list:
+                self.report_queue.put((radio_receiver, changed_reports_list))
+
+    def write_reports(self):
+        """Writer stage - runs until the parser is done and the report queue is drained"""
+        pending_polls = []
+        oldest_pending_time = None
+        last_stats_time = time.time()
+
+        while True:
+            # The parser may still be queueing its last snapshot's reports until parser_done is set
+            stopping = self.parser_done.is_set() and self.report_queue.depth() == 0
+            try:
+                pending_polls.append(self.report_queue.get(timeout=0.2))
+                if self.pattern_monitor is not None:
+                    # Before coalescing, so alerts aren't held back by the write
+                    self.pattern_monitor.observe_reports(pending_polls[-1][1])
+                if oldest_pending_time is None:
+                    oldest_pending_time = time.time()
+            except queue.Empty:
+                pass
+
+            if pending_polls and (stopping or len(pending_polls) >= self.max_coalesce_polls or
+                                  time.time() - oldest_pending_time >= self.max_coalesce_sec):
+                self.write_coalesced_polls(pending_polls)
+                pending_polls = []
+                oldest_pending_time = None
+
+            if time.time() - last_stats_time >= self.stats_interval_sec:
+                self.log_stats()
+                last_stats_time = time.time()
+
+            if stopping and not pending_polls:
+                return
+
+    def write_coalesced_polls(self, pending_polls):
+        """
+        Write several polls' reports in one transaction
+
+        :param pending_polls: list of (radio_receiver, reports_list) tuples
+        """
+        dbconn = self.get_dbconn()
+        if not dbconn:
+            logger.error('No DB Connection. {} polls not inserted'.format(len(pending_polls)))
+            self.spool_polls(pending_polls)
+            return
+
+        num_reports = 0
+        try:
+            for radio_receiver, reports_list in pending_polls:
+                aircraft_report.load_aircraft_reports_list_into_db(aircraft_reports_list=reports_list,
+                                                                   radio_receiver=radio_receiver,
+                                                                   dbconn=dbconn,
+                                                                   commit=False,
+                                                                   itinerary_tracker=self.itinerary_tracker)
+                num_reports += len(reports_list)
+            dbconn.commit()
+        except:
+            logger.exception('Issue writing {} coalesced polls into DB'.format(len(pending_polls)))
+            try:
+                dbconn.rollback()
+            except:
+                logger.exception('Issue rolling back, DB connection lost')
+            self.spool_polls(pending_polls)
+            return
+
+        self.polls_written += len(pending_polls)
+        self.reports_written += num_reports
+        self.transactions_committed += 1
+
+    def get_dbconn(self):
+        """
+        :return: the writer's DB connection, reopened with db_connect if it has been lost, or None if it's down
+        """
+        if self.dbconn and not self.dbconn.closed:
+            return self.dbconn
+
+        if self.db_connect is None:
+            return None
+        if self.last_reconnect_time is not None and \
+                time.time() - self.last_reconnect_time < self.reconnect_wait_sec:
+            return None
+
+        self.last_reconnect_time = time.time()
+        logger.info('Reopening the ingest pipeline DB connection')
+        self.dbconn = self.db_connect()
+        return self.dbconn
+
+    def spool_poll(self, poll):
+        """
+        :param poll: (radio_receiver, reports_list) tuple
+        """
+        radio_receiver, reports_list = poll
+        self.report_spool.append_reports(reports_list, radio_receiver)
+        self.polls_spooled += 1
+
+    def spool_polls(self, pending_polls):
+        """Spool polls that couldn't be written, if there's a spool to write them to"""
+        if self.report_spool is None:
+            return
+        for poll in pending_polls:
+            try:
+                self.spool_poll(poll)
+            except:
+                logger.exception('Issue spooling poll from receiver {}, poll lost'.format(poll[0].name))
+
+    def log_stats(self):
+        logger.info('Ingest pipeline queues: {} - {} polls / {} reports written in {} transactions, '
+                    '{} polls spooled'.format(self.get_queue_depths(), self.polls_written, self.reports_written,
+                                              self.transactions_committed, self.polls_spooled))
+
+    def run(self):
+        """
+        Start the parser and writer threads and poll every receiver until they all finish (or Ctrl-C), then drain
+        the queues and stop
+
+        :return: list of the fetchers that gave up after too many failures
+        """
+        parser_thread = threading.Thread(target=self.parse_snapshots, name='parser')
+        writer_thread = threading.Thread(target=self.write_reports, name='writer')
+        parser_thread.start()
+        writer_thread.start()
+
+        try:
+            failed_fetchers = receiver_poller.poll_receivers_concurrently(self.fetchers, stop_event=self.stop_event)
+        finally:
+            self.stop_event.set()
+            parser_thread.join()
+            writer_thread.join()
+            self.log_stats()
+
+        return failed_fetchers
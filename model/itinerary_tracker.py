@@ -0,0 +1,164 @@
+"""
+Online itinerary segmentation: stamps itinerary_id on each report as it's written to the DB, instead of leaving it
+NULL for analysis/BatchItineraryAssignment.py to fill in afterwards. An aircraft's report more than max_gap_sec
+after its previous one starts a new itinerary, with its ID made the same way as the batch job's, from the aircraft and
+the epoch of the first report seen. A report that arrives late and out of order joins the itinerary it falls in
+under that ID, even if it's earlier than the ID's epoch - rows already written keep their ID, so it isn't changed.
+
+The per-aircraft state is restored from the DB on startup, so a restart doesn't split the itineraries in progress.
+Reports that can't be placed (e.g. replayed from the spool long after the fact) are left NULL, and the batch job
+adds them to the itinerary of the stamped reports next to them, or gives them itineraries of their own.
+"""
+
+import logging
+import threading
+import time
+
+from model import aircraft_report
+
+logger = logging.getLogger(__name__)
+
+# Same gap as the batch job's itinerarymaxtimediffseconds
+default_max_gap_sec = 900
+
+# Seconds between sweeps for aircraft whose itinerary can no longer continue
+default_evict_interval_sec = 60
+
+itinerary_id_time_format = '%Y_%m_%d_%H_%M_%S'
+
+db_row_mode_s_index = aircraft_report.staging_column_names.index('mode_s_hex')
+db_row_epoch_index = aircraft_report.staging_column_names.index('report_epoch')
+
+
+def generate_itinerary_id(mode_s_hex, start_epoch):
+    """
+    :param mode_s_hex: mode-s hex code
+    :param start_epoch: epoch timestamp of the itinerary's first report
+    :return: itinerary ID (str), the local start time followed by the hex code
+    """
+    return time.strftime(itinerary_id_time_format, time.localtime(start_epoch)) + '_{}'.format(mode_s_hex)
+
+
+def get_itinerary_start_epoch(itinerary_id):
+    """
+    :param itinerary_id: ID made by generate_itinerary_id
+    :return: epoch timestamp the itinerary started at, or None if the ID isn't in that format
+    """
+    try:
+        return time.mktime(time.strptime(itinerary_id[:19], itinerary_id_time_format))
+    except (TypeError, ValueError):
+        return None
+
+
+class ItineraryTracker(object):
+    """
+    Keeps the current itinerary (ID, first and last epoch) of every aircraft seen in the last max_gap_sec. Shared by
+    all of the writers of a process, so that reports of one aircraft from several receivers land in one itinerary.
+    """
+
+    def __init__(self, max_gap_sec=default_max_gap_sec, evict_interval_sec=default_evict_interval_sec):
+        self.max_gap_sec = max_gap_sec
+        self.evict_interval_sec = evict_interval_sec
+        self.lock = threading.Lock()
+        # mode_s_hex -> [itinerary ID (None if it's being left to the batch job), first epoch, last epoch]
+        self.itinerary_states = {}
+        self.last_evict_time = time.time()
+
+        self.reports_stamped = 0
+        self.reports_unstamped = 0
+        self.itineraries_started = 0
+
+    def __len__(self):
+        return len(self.itinerary_states)
+
+    def restore_from_db(self, dbconn, now=None):
+        """
+        Load the latest report of every aircraft seen in the last max_gap_sec, so itineraries that were in progress
+        when ingest stopped carry on. An aircraft whose latest report has no itinerary ID keeps getting none until
+        its next gap, leaving that whole itinerary to the batch job.
+
+        :param dbconn: Open database connection
+        :param now: current epoch, defaults to time.time()
+        :return: number of aircraft restored
+        """
+        if now is None:
+            now = time.time()
+
+        cur = dbconn.cursor()
+        # Bounded on report_epoch, so only the latest partition(s) are read
+        cur.execute('''SELECT DISTINCT ON (mode_s_hex) mode_s_hex, itinerary_id, report_epoch
+                         FROM aircraftreports
+                         WHERE report_epoch >= %s
+                         ORDER BY mode_s_hex, report_epoch DESC''', (int(now - self.max_gap_sec),))
+        latest_reports = cur.fetchall()
+        cur.close()
+        dbconn.rollback()
+
+        with self.lock:
+            for mode_s_hex, itinerary_id, last_epoch in latest_reports:
+                start_epoch = get_itinerary_start_epoch(itinerary_id) if itinerary_id else None
+                self.itinerary_states[mode_s_hex] = [itinerary_id,
+                                                     last_epoch if start_epoch is None else start_epoch,
+                                                     last_epoch]
+
+        logger.info('Restored the itineraries of {} aircraft from the DB'.format(len(latest_reports)))
+        return len(latest_reports)
+
+    def get_itinerary_id(self, mode_s_hex, epoch):
+        """
+        Place one report in its aircraft's itinerary, starting a new one after a gap. Call with the lock held.
+
+        :return: itinerary ID, or None if the report should be left to the batch job
+        """
+        itinerary_state = self.itinerary_states.get(mode_s_hex)
+
+        if itinerary_state is None or epoch > itinerary_state[2] + self.max_gap_sec:
+            # Rounded like report_epoch is in the DB, as the batch job's IDs are
+            itinerary_id = generate_itinerary_id(mode_s_hex, int(round(epoch)))
+            self.itinerary_states[mode_s_hex] = [itinerary_id, epoch, epoch]
+            self.itineraries_started += 1
+            return itinerary_id
+
+        if epoch < itinerary_state[1] - self.max_gap_sec:
+            # Older than the current itinerary, so it belongs to one that's already over
+            return None
+
+        # An out of order report can move the itinerary's start back, but it keeps the ID its rows were stamped with
+        itinerary_state[1] = min(itinerary_state[1], epoch)
+        itinerary_state[2] = max(itinerary_state[2], epoch)
+        return itinerary_state[0]
+
+    def stamp_db_rows(self, db_rows):
+        """
+        :param db_rows: list of rows in aircraft_report.staging_column_names order, in any order
+        :return: list of the same rows with their itinerary ID (or None) appended
+        """
+        # In epoch order, so that out of order rows (e.g. several receivers in one batch) don't look like gaps
+        row_order = sorted(range(len(db_rows)), key=lambda row_num: db_rows[row_num][db_row_epoch_index])
+        itinerary_ids = [None] * len(db_rows)
+
+        with self.lock:
+            for row_num in row_order:
+                itinerary_ids[row_num] = self.get_itinerary_id(db_rows[row_num][db_row_mode_s_index],
+                                                               db_rows[row_num][db_row_epoch_index])
+            self.evict_finished(time.time())
+
+        num_unstamped = itinerary_ids.count(None)
+        self.reports_stamped += len(db_rows) - num_unstamped
+        self.reports_unstamped += num_unstamped
+
+        return [tuple(db_row) + (itinerary_id,) for db_row, itinerary_id in zip(db_rows, itinerary_ids)]
+
+    def evict_finished(self, now):
+        """
+        Every evict_interval_sec, forget the aircraft whose itinerary is over - no report for max_gap_sec. Call with
+        the lock held.
+        """
+        if now - self.last_evict_time < self.evict_interval_sec:
+            return
+        self.last_evict_time = now
+
+        finished_mode_s_hexes = [mode_s_hex for mode_s_hex, itinerary_state in self.itinerary_states.items()
+                                 if now - itinerary_state[2] > self.max_gap_sec]
+        for mode_s_hex in finished_mode_s_hexes:
+            del self.itinerary_states[mode_s_hex]
@@ -0,0 +1,343 @@
+"""
+Live holding pattern alerts. Every aircraft's recent reports are kept in a window bounded by time and points, along
+with its cumulative heading change. An alert is raised as soon as an aircraft has turned through a full loop
+within the window and its latest segment crosses its own track, instead of waiting for the itinerary to be
+assigned and analysed in batch (see model/holding_pattern.py).
+
+The window's minimum and maximum cumulative heading are kept with monotonic queues, and its segments in a small
+grid (as in model/holding_pattern.py) that's updated as reports enter and leave the window. Once the aircraft has
+turned far enough, the latest segment is only tested against the window's segments that share a grid cell with it,
+so each report costs O(1) amortised plus the segments nearby.
+"""
+
+import collections
+import logging
+import math
+import threading
+import time
+
+import numpy as np
+
+from model import holding_pattern
+from model import report_batch
+
+logger = logging.getLogger(__name__)
+
+# Seconds and number of reports kept per aircraft. A standard hold takes about 4 minutes per lap.
+default_window_sec = 600
+default_max_window_points = 300
+
+# Heading change (degrees, in one direction) that makes a loop
+default_loop_turn_deg = 360
+
+# A longer gap between an aircraft's reports starts its window over
+default_max_gap_sec = 60
+
+# Grid cell size (degrees) for the window's segments, a few times the distance flown between reports in a hold
+default_grid_cell_size = 0.02
+
+# Aircraft not reported for this many seconds are forgotten
+default_ttl_sec = 300
+default_evict_interval_sec = 60
+
+
+def get_heading_change(from_heading, to_heading):
+    """
+    :return: signed heading change in degrees, from -180 to 180, positive for a right (clockwise) turn
+    """
+    return (to_heading - from_heading + 180.0) % 360.0 - 180.0
+
+
+def get_local_bearing(from_lon, from_lat, to_lon, to_lat):
+    """
+    :return: approximate bearing in degrees between two nearby points, for reports without a track
+    """
+    return math.degrees(math.atan2((to_lon - from_lon) * math.cos(math.radians(from_lat)), to_lat - from_lat)) % 360.0
+
+
+def is_missing(value):
+    return value is None or value != value
+
+
+class PatternAlert(object):
+    """
+    One completed loop of an aircraft
+    """
+
+    def __init__(self, mode_s_hex, epoch, crossing, centroid, turn_deg, loop_sec, num_points):
+        """
+        :param mode_s_hex: mode-s hex code
+        :param epoch: epoch of the report that completed the loop
+        :param crossing: (lon, lat) where the track crossed itself
+        :param centroid: (lon, lat) centroid of the loop
+        :param turn_deg: heading change within the window, in degrees
+        :param loop_sec: seconds from the crossed segment to the report that completed the loop
+        :param num_points: reports in the window when the loop was completed
+        """
+        self.mode_s_hex = mode_s_hex
+        self.epoch = epoch
+        self.crossing = crossing
+        self.centroid = centroid
+        self.turn_deg = turn_deg
+        self.loop_sec = loop_sec
+        self.num_points = num_points
+
+    def __repr__(self):
+        return 'PatternAlert(mode_s_hex={}, epoch={}, centroid={}, turn_deg={:.0f}, loop_sec={:.0f})'.format(
+            self.mode_s_hex, self.epoch, self.centroid, self.turn_deg, self.loop_sec)
+
+
+class AircraftTurnWindow(object):
+    """
+    The recent reports of one aircraft, with the running minimum and maximum of its cumulative heading change and a
+    grid of its segments
+    """
+
+    def __init__(self, epoch, lon, lat, heading, grid_cell_size=default_grid_cell_size):
+        self.last_seen = time.time()
+        # Segments keyed by the seq of their end point, each one there while its start point is in the window
+        self.segment_grid = holding_pattern.SegmentGrid(grid_cell_size)
+        self.start(epoch, lon, lat, heading)
+
+    def start(self, epoch, lon, lat, heading):
+        """Start the window over from one report"""
+        self.next_seq = 1
+        self.cumulative_turn = 0.0
+        self.last_heading = heading
+        # (seq, epoch, lon, lat) of each report in the window
+        self.points = collections.deque([(0, epoch, lon, lat)])
+        # (seq, cumulative turn) with increasing / decreasing cumulative turn, the first being the window's min / max
+        self.min_turns = collections.deque([(0, 0.0)])
+        self.max_turns = collections.deque([(0, 0.0)])
+        # seq of a segment's end point -> its cell bounds in segment_grid
+        self.segment_cell_bounds = {}
+        self.segment_grid.clear()
+
+    def append(self, epoch, lon, lat, heading):
+        if heading is not None:
+            if self.last_heading is not None:
+                self.cumulative_turn += get_heading_change(self.last_heading, heading)
+            self.last_heading = heading
+
+        seq = self.next_seq
+        self.next_seq += 1
+        _, _, last_lon, last_lat = self.points[-1]
+        cell_bounds = self.segment_grid.get_segment_cell_bounds(last_lon, last_lat, lon, lat)
+        self.segment_grid.add(seq, cell_bounds)
+        self.segment_cell_bounds[seq] = cell_bounds
+        self.points.append((seq, epoch, lon, lat))
+        while self.min_turns and self.min_turns[-1][1] >= self.cumulative_turn:
+            self.min_turns.pop()
+        self.min_turns.append((seq, self.cumulative_turn))
+        while self.max_turns and self.max_turns[-1][1] <= self.cumulative_turn:
+            self.max_turns.pop()
+        self.max_turns.append((seq, self.cumulative_turn))
+
+    def evict(self, min_epoch, max_points):
+        """Drop the reports older than min_epoch, and the oldest past max_points"""
+        while len(self.points) > 1 and (self.points[0][1] < min_epoch or len(self.points) > max_points):
+            evicted_seq = self.points.popleft()[0]
+            # The segment starting at the evicted point leaves the window with it
+            self.segment_grid.remove(evicted_seq + 1, self.segment_cell_bounds.pop(evicted_seq + 1))
+            if self.min_turns[0][0] == evicted_seq:
+                self.min_turns.popleft()
+            if self.max_turns[0][0] == evicted_seq:
+                self.max_turns.popleft()
+
+    def get_turn(self):
+        """
+        :return: the largest heading change, in either direction, from a report in the window to the latest one
+        """
+        return max(self.cumulative_turn - self.min_turns[0][1], self.max_turns[0][1] - self.cumulative_turn)
+
+    def find_loop(self):
+        """
+        :return: tuple of (crossing, loop ring, index of the crossed segment's end point) if the latest segment
+                 crosses an earlier one in the window, or None
+        """
+        num_points = len(self.points)
+        if num_points < 4:
+            return None
+        first_seq = self.points[0][0]
+        latest_seq = self.points[-1][0]
+
+        # The segments near the latest one, but not the latest and the one it joins
+        candidate_seqs = self.segment_grid.get_candidates(self.segment_cell_bounds[latest_seq])
+        candidate_seqs.discard(latest_seq)
+        candidate_seqs.discard(latest_seq - 1)
+        if not candidate_seqs:
+            return None
+        candidate_seqs = list(candidate_seqs)
+
+        # Only the start and end points of the latest segment and the candidates, each segment's end after its start
+        segment_points = [self.points[-2], self.points[-1]]
+        for candidate_seq in candidate_seqs:
+            segment_points.append(self.points[candidate_seq - 1 - first_seq])
+            segment_points.append(self.points[candidate_seq - first_seq])
+        segment_lons = np.fromiter((point[2] for point in segment_points), dtype=np.float64, count=len(segment_points))
+        segment_lats = np.fromiter((point[3] for point in segment_points), dtype=np.float64, count=len(segment_points))
+        crossing = holding_pattern.find_segment_crossing(segment_lons, segment_lats, 1,
+                                                         np.arange(3, len(segment_points), 2))
+        if crossing is None:
+            return None
+
+        # Back to indexes in the window, to build the ring from all of its points
+        crossing = (candidate_seqs[(crossing[0] - 3) // 2] - first_seq, crossing[1], crossing[2])
+        lons = np.fromiter((point[2] for point in self.points), dtype=np.float64, count=num_points)
+        lats = np.fromiter((point[3] for point in self.points), dtype=np.float64, count=num_points)
+        return crossing, holding_pattern.get_loop_ring(lons, lats, num_points - 1, crossing), crossing[0]
+
+
+class PatternAlertMonitor(object):
+    """
+    Watches the live reports of every receiver of a process for aircraft completing a loop. Shared by all of the
+    receivers, so that an aircraft's reports from several receivers go in one window.
+    """
+
+    def __init__(self, window_sec=default_window_sec, max_window_points=default_max_window_points,
+                 loop_turn_deg=default_loop_turn_deg, max_gap_sec=default_max_gap_sec, ttl_sec=default_ttl_sec,
+                 evict_interval_sec=default_evict_interval_sec, on_alert=None):
+        """
+        :param window_sec: seconds of reports kept per aircraft
+        :param max_window_points: reports kept per aircraft
+        :param loop_turn_deg: heading change within the window that makes a loop, once the track crosses itself
+        :param max_gap_sec: a longer gap between an aircraft's reports starts its window over
+        :param ttl_sec: aircraft not reported for this many seconds are forgotten
+        :param evict_interval_sec: seconds between sweeps for aircraft past ttl_sec
+        :param on_alert: callable given each PatternAlert, defaults to logging it
+        """
+        self.window_sec = window_sec
+        self.max_window_points = max_window_points
+        self.loop_turn_deg = loop_turn_deg
+        self.max_gap_sec = max_gap_sec
+        self.ttl_sec = ttl_sec
+        self.evict_interval_sec = evict_interval_sec
+        self.on_alert = on_alert if on_alert is not None else log_alert
+        self.lock = threading.Lock()
+        # mode_s_hex -> AircraftTurnWindow
+        self.turn_windows = {}
+        self.last_evict_time = time.time()
+
+        self.reports_observed = 0
+        self.alerts_raised = 0
+
+    def __len__(self):
+        return len(self.turn_windows)
+
+    def observe(self, mode_s_hex, epoch, lon, lat, track=None):
+        """
+        Add one report to its aircraft's window. Call with the lock held.
+
+        :param track: ground track in degrees, or None to use the bearing from the previous report
+        :return: PatternAlert if the report completes a loop, otherwise None
+        """
+        if is_missing(lon) or is_missing(lat) or is_missing(epoch):
+            return None
+        heading = None if is_missing(track) else float(track)
+
+        turn_window = self.turn_windows.get(mode_s_hex)
+        if turn_window is None:
+            self.turn_windows[mode_s_hex] = AircraftTurnWindow(epoch, lon, lat, heading)
+            return None
+        turn_window.last_seen = time.time()
+
+        _, last_epoch, last_lon, last_lat = turn_window.points[-1]
+        if epoch <= last_epoch or (lon == last_lon and lat == last_lat):
+            # Out of order (e.g. from a slower receiver) or no new position
+            return None
+        if epoch - last_epoch > self.max_gap_sec:
+            turn_window.start(epoch, lon, lat, heading)
+            return None
+
+        if heading is None:
+            heading = get_local_bearing(last_lon, last_lat, lon, lat)
+        turn_window.append(epoch, lon, lat, heading)
+        turn_window.evict(epoch - self.window_sec, self.max_window_points)
+
+        turn_deg = turn_window.get_turn()
+        if turn_deg < self.loop_turn_deg:
+            return None
+
+        loop = turn_window.find_loop()
+        if loop is None:
+            return None
+        crossing, ring, crossed_end = loop
+        _, centroid_lon, centroid_lat = holding_pattern.get_ring_area_centroid(ring)
+        pattern_alert = PatternAlert(mode_s_hex, epoch, (crossing[1], crossing[2]), (centroid_lon, centroid_lat),
+                                     turn_deg, epoch - turn_window.points[crossed_end][1], len(turn_window.points))
+
+        # The next loop is counted from here
+        turn_window.start(epoch, lon, lat, heading)
+        return pattern_alert
+
+    def observe_reports(self, reports_list):
+        """
+        :param reports_list: list of AircraftReport objects, or a ReportBatch, each aircraft's in epoch order
+        :return: list of PatternAlert raised by the reports. Never raises.
+        """
+        if isinstance(reports_list, report_batch.ReportBatch):
+            located = ~reports_list.is_ground
+            report_rows = zip(reports_list.mode_s_hex[located], reports_list.epoch[located].tolist(),
+                              reports_list.lon[located].tolist(), reports_list.lat[located].tolist(),
+                              reports_list.track[located].tolist())
+        else:
+            report_rows = ((aircraft.mode_s_hex, aircraft.time, aircraft.lon, aircraft.lat, aircraft.track)
+                           for aircraft in reports_list if not getattr(aircraft, 'is_ground', False))
+
+        pattern_alerts = []
+        num_reports = 0
+        with self.lock:
+            try:
+                for mode_s_hex, epoch, lon, lat, track in report_rows:
+                    num_reports += 1
+                    pattern_alert = self.observe(mode_s_hex, epoch, lon, lat, track)
+                    if pattern_alert is not None:
+                        pattern_alerts.append(pattern_alert)
+                self.evict_stale(time.time())
+            except:
+                # Alerts are best effort, they must never hold up writing the reports
+                logger.exception('Issue checking {} reports for holding patterns'.format(len(reports_list)))
+            self.reports_observed += num_reports
+            self.alerts_raised += len(pattern_alerts)
+
+        for pattern_alert in pattern_alerts:
+            try:
+                self.on_alert(pattern_alert)
+            except:
+                logger.exception('Issue handling {}'.format(pattern_alert))
+
+        return pattern_alerts
+
+    def evict_stale(self, now):
+        """
+        Every evict_interval_sec, forget the aircraft that haven't been reported for ttl_sec. Call with the lock held.
+        """
+        if now - self.last_evict_time < self.evict_interval_sec:
+            return
+        self.last_evict_time = now
+
+        stale_mode_s_hexes = [mode_s_hex for mode_s_hex, turn_window in self.turn_windows.items()
+                              if now - turn_window.last_seen > self.ttl_sec]
+        for mode_s_hex in stale_mode_s_hexes:
+            del self.turn_windows[mode_s_hex]
+
+
+def log_alert(pattern_alert):
+    logger.info('Holding pattern: {} completed a loop around {:.5f}, {:.5f} at {} ({:.0f} degrees in {:.0f} '
+                'sec)'.format(pattern_alert.mode_s_hex, pattern_alert.centroid[1], pattern_alert.centroid[0],
+                              time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(pattern_alert.epoch)),
+                              pattern_alert.turn_deg, pattern_alert.loop_sec))
+
+
+def get_pattern_alert_monitor(pattern_alerts_config):
+    """
+    Build the monitor described by the patternalerts section of config.yml
+
+    :param pattern_alerts_config: dict of the patternalerts settings
+    :return: PatternAlertMonitor
+    """
+    return PatternAlertMonitor(
+        window_sec=pattern_alerts_config.get('windowsec', default_window_sec),
+        max_window_points=pattern_alerts_config.get('windowpoints', default_max_window_points),
+        loop_turn_deg=pattern_alerts_config.get('loopturndeg', default_loop_turn_deg),
+        max_gap_sec=pattern_alerts_config.get('maxgapsec', default_max_gap_sec))
@@ -0,0 +1,107 @@
+"""
+Adaptive poll interval for one receiver. Polls faster when aircraft are appearing and moving, slower when the sky
+is quiet or the receiver is slow to respond, and backs off exponentially (with jitter) while polls are failing.
+"""
+
+import logging
+import random
+
+logger = logging.getLogger(__name__)
+
+# Multiplicative step applied to the interval after a busy / quiet poll
+default_speedup_factor = 0.8
+default_slowdown_factor = 1.25
+
+# Churn (new aircraft + changed positions) per poll above which the interval shrinks, and below which it grows
+default_high_churn_per_poll = 20
+default_low_churn_per_poll = 2
+
+# The interval is kept at least this many times the (smoothed) fetch latency, so a struggling receiver isn't
+# polled again before it has recovered
+default_latency_multiple = 2.0
+
+# Exponential backoff after failed polls: base * 2^(failures - 1), capped, with up to half of it randomised
+default_backoff_base_sec = 5
+default_backoff_max_sec = 120
+
+# Weight of the newest sample in the smoothed fetch latency
+latency_smoothing = 0.3
+
+
+class AdaptivePollScheduler(object):
+    """
+    Tracks one receiver's poll interval between min_interval_sec and max_interval_sec. With equal bounds the
+    interval is fixed, as with the old global waittimesec.
+    """
+
+    def __init__(self, min_interval_sec, max_interval_sec, initial_interval_sec=None,
+                 high_churn_per_poll=default_high_churn_per_poll, low_churn_per_poll=default_low_churn_per_poll,
+                 speedup_factor=default_speedup_factor, slowdown_factor=default_slowdown_factor,
+                 latency_multiple=default_latency_multiple,
+                 backoff_base_sec=default_backoff_base_sec, backoff_max_sec=default_backoff_max_sec):
+        if min_interval_sec > max_interval_sec:
+            raise ValueError('Min poll interval {} is greater than max poll interval {}'.format(min_interval_sec,
+                                                                                            max_interval_sec))
+        self.min_interval_sec = min_interval_sec
+        self.max_interval_sec = max_interval_sec
+        self.high_churn_per_poll = high_churn_per_poll
+        self.low_churn_per_poll = low_churn_per_poll
+        self.speedup_factor = speedup_factor
+        self.slowdown_factor = slowdown_factor
+        self.latency_multiple = latency_multiple
+        self.backoff_base_sec = backoff_base_sec
+        self.backoff_max_sec = backoff_max_sec
+
+        self.interval_sec = self.clamp_interval(initial_interval_sec if initial_interval_sec is not None
+                                                else min_interval_sec)
+        self.latency_sec = None
+        self.failure_num = 0
+
+    def clamp_interval(self, interval_sec):
+        return min(self.max_interval_sec, max(self.min_interval_sec, interval_sec))
+
+    def record_latency(self, fetch_latency_sec):
+        """
+        :param fetch_latency_sec: seconds the receiver took to answer the last poll
+        """
+        if self.latency_sec is None:
+            self.latency_sec = fetch_latency_sec
+        else:
+            self.latency_sec += latency_smoothing * (fetch_latency_sec - self.latency_sec)
+
+    def record_churn(self, num_new_aircraft, num_changed_positions):
+        """
+        Adjust the interval to how much the last poll brought in
+
+        :param num_new_aircraft: aircraft that weren't in the previous polls
+        :param num_changed_positions: aircraft whose position changed since the previous poll (including new ones)
+        """
+        # New aircraft count twice, so short-lived tracks pull the interval down sooner
+        churn = num_new_aircraft + num_changed_positions
+        if churn >= self.high_churn_per_poll:
+            self.interval_sec = self.clamp_interval(self.interval_sec * self.speedup_factor)
+        elif churn <= self.low_churn_per_poll:
+            self.interval_sec = self.clamp_interval(self.interval_sec * self.slowdown_factor)
+
+    def record_unchanged(self):
+        """The snapshot hadn't changed since the last poll, so we're polling faster than the receiver updates"""
+        self.record_churn(0, 0)
+
+    def record_success(self):
+        self.failure_num = 0
+
+    def record_failure(self):
+        """
+        :return: seconds to wait before the next attempt
+        """
+        self.failure_num += 1
+        backoff_sec = min(self.backoff_max_sec, self.backoff_base_sec * 2 ** (self.failure_num - 1))
+        return backoff_sec / 2.0 + random.uniform(0, backoff_sec / 2.0)
+
+    def next_interval_sec(self):
+        """
+        :return: seconds from the start of the last poll to the start of the next one
+        """
+        if self.latency_sec is None:
+            return self.interval_sec
+        return min(self.max_interval_sec, max(self.interval_sec, self.latency_sec * self.latency_multiple))
@@ -0,0 +1,240 @@
+"""
+Polls the aircraft.json of one or more receivers, each on its own schedule in its own thread, so that one slow or
+hung receiver doesn't hold up the polling of the others
+"""
+
+import logging
+import threading
+import time
+
+from model import aircraft_report
+from model import aircraft_state_cache
+from model import poll_scheduler
+from model import snapshot_client
+
+logger = logging.getLogger(__name__)
+
+# Max seconds to wait on a receiver's HTTP response before counting the poll as failed
+default_request_timeout_sec = 10
+
+# Max seconds to back off after failed polls before trying that receiver again
+default_failure_wait_sec = poll_scheduler.default_backoff_max_sec
+
+# Consecutive failed polls after which we give up on a receiver
+default_max_failures = 10
+
+# Min seconds between attempts to reopen a poller's DB connection after it's lost
+default_reconnect_wait_sec = 30
+
+
+class ReceiverPoller(object):
+    """
+    Polls a single RadioReceiver's data_access_url and loads each snapshot into the DB on this poller's own DB
+    connection. Aircraft whose position hasn't changed since the last poll are skipped. The poll interval adapts
+    between min_poll_interval_sec and max_poll_interval_sec (both default to poll_interval_sec) to the receiver's
+    traffic, see poll_scheduler.AdaptivePollScheduler.
+
+    With a report_spool, snapshots that can't be loaded because the DB is down are spooled to disk instead, so a DB
+    outage doesn't count as a receiver failure, and the connection is reopened with db_connect once the DB is back.
+
+    With a report_producer, snapshots are published to the report bus instead, for a separate DB writer to load.
+
+    With an itinerary_tracker, each report is stamped with its itinerary ID as it's loaded.
+
+    With a pattern_monitor, each report is checked for an aircraft completing a holding pattern loop.
+    """
+
+    def __init__(self, radio_receiver, dbconn, poll_interval_sec, max_samples,
+                 request_timeout_sec=default_request_timeout_sec,
+                 failure_wait_sec=default_failure_wait_sec,
+                 max_failures=default_max_failures,
+                 state_ttl_sec=aircraft_state_cache.default_state_ttl_sec,
+                 report_spool=None, db_connect=None, reconnect_wait_sec=default_reconnect_wait_sec,
+                 report_producer=None, min_poll_interval_sec=None, max_poll_interval_sec=None,
+                 itinerary_tracker=None, pattern_monitor=None):
+        self.radio_receiver = radio_receiver
+        self.dbconn = dbconn
+        self.report_spool = report_spool
+        self.report_producer = report_producer
+        self.itinerary_tracker = itinerary_tracker
+        self.pattern_monitor = pattern_monitor
+        self.db_connect = db_connect
+        self.reconnect_wait_sec = reconnect_wait_sec
+        self.last_reconnect_time = None
+        self.poll_interval_sec = poll_interval_sec
+        self.max_samples = max_samples
+        self.request_timeout_sec = request_timeout_sec
+        self.failure_wait_sec = failure_wait_sec
+        self.max_failures = max_failures
+        self.state_cache = aircraft_state_cache.AircraftStateCache(ttl_sec=state_ttl_sec)
+        self.snapshot_client = self.build_snapshot_client()
+        self.poll_scheduler = poll_scheduler.AdaptivePollScheduler(
+            min_interval_sec=min_poll_interval_sec if min_poll_interval_sec is not None else poll_interval_sec,
+            max_interval_sec=max_poll_interval_sec if max_poll_interval_sec is not None else poll_interval_sec,
+            initial_interval_sec=poll_interval_sec,
+            backoff_max_sec=failure_wait_sec)
+
+        self.samples_count = 0
+        self.failure_num = 0
+        self.gave_up = False
+
+    def build_snapshot_client(self):
+        """
+        :return: SnapshotClient for the receiver's aircraft.json, or None for pollers that read it some other way
+        """
+        return snapshot_client.SnapshotClient(self.radio_receiver.data_access_url, timeout=self.request_timeout_sec)
+
+    def poll_once(self):
+        """
+        Pull one snapshot from the receiver and load it into the DB
+
+        :return: number of aircraft reports in the snapshot (0 if the snapshot hasn't changed since the last poll)
+        """
+        start_time = time.time()
+
+        current_reports_list = self.snapshot_client.get_aircraft_data()
+        self.poll_scheduler.record_latency(self.snapshot_client.last_fetch_latency_sec)
+        if current_reports_list is None:
+            logger.debug('Snapshot from {} unchanged since the last poll'.format(self.radio_receiver.name))
+            self.poll_scheduler.record_unchanged()
+            return 0
+
+        changed_reports_list = self.state_cache.get_changed_reports(current_reports_list, now=start_time)
+        self.poll_scheduler.record_churn(self.state_cache.last_new_aircraft_count, len(changed_reports_list))
+        if len(changed_reports_list) > 0:
+            self.write_reports(changed_reports_list)
+            self.state_cache.mark_persisted(changed_reports_list)
+        self.state_cache.evict_stale(now=start_time)
+
+        logger.debug('{} seconds for data pull from {}'.format((time.time() - start_time), self.radio_receiver.name))
+
+        return len(current_reports_list)
+
+    def write_reports(self, reports_list):
+        """
+        Publish the reports to the report bus, or load them into the DB (spooling them if the DB is down)
+
+        :param reports_list: list of AircraftReport objects, or a ReportBatch
+        """
+        if self.pattern_monitor is not None:
+            self.pattern_monitor.observe_reports(reports_list)
+        if self.report_producer is not None:
+            self.report_producer.append_reports(reports_list, self.radio_receiver)
+        elif self.report_spool is None:
+            aircraft_report.load_aircraft_reports_list_into_db(aircraft_reports_list=reports_list,
+                                                               radio_receiver=self.radio_receiver,
+                                                               dbconn=self.dbconn,
+                                                               itinerary_tracker=self.itinerary_tracker)
+        else:
+            self.load_or_spool_reports(reports_list)
+
+    def load_or_spool_reports(self, reports_list):
+        """
+        Load the reports into the DB, or spool them if the DB connection is down or the load fails
+        """
+        dbconn = self.get_dbconn()
+        if dbconn:
+            try:
+                aircraft_report.load_aircraft_reports_list_into_db(aircraft_reports_list=reports_list,
+                                                                   radio_receiver=self.radio_receiver,
+                                                                   dbconn=dbconn,
+                                                                   itinerary_tracker=self.itinerary_tracker)
+                return
+            except:
+                logger.exception('Issue loading reports from receiver {} into DB, spooling them'.format(
+                    self.radio_receiver.name))
+                try:
+                    dbconn.rollback()
+                except:
+                    logger.exception('Issue rolling back, DB connection lost')
+
+        self.report_spool.append_reports(reports_list, self.radio_receiver)
+
+    def get_dbconn(self):
+        """
+        :return: the poller's DB connection, reopened with db_connect if it has been lost, or None if it's down
+        """
+        if self.dbconn and not self.dbconn.closed:
+            return self.dbconn
+
+        if self.db_connect is None:
+            return None
+        if self.last_reconnect_time is not None and \
+                time.time() - self.last_reconnect_time < self.reconnect_wait_sec:
+            return None
+
+        self.last_reconnect_time = time.time()
+        logger.info('Reopening DB connection for receiver {}'.format(self.radio_receiver.name))
+        self.dbconn = self.db_connect()
+        return self.dbconn
+
+    def run(self, stop_event):
+        """
+        Poll until max_samples is reached, stop_event is set, or max_failures polls in a row have failed. The next
+        poll is scheduled from the start of the previous one, so time spent fetching and loading doesn't stretch the
+        interval. Failed polls are retried after an exponential backoff with jitter.
+
+        :param stop_event: threading.Event used to stop all of the pollers
+        """
+        logger.info('Aircraft ingest beginning for receiver {}.'.format(self.radio_receiver.name))
+        next_poll_time = time.time()
+
+        while self.samples_count < self.max_samples and not stop_event.is_set():
+            try:
+                self.poll_once()
+                self.samples_count += 1
+                self.failure_num = 0
+                self.poll_scheduler.record_success()
+            except:
+                # Workaround for failing connection when pi gets busy
+                logger.exception('Issue getting data from receiver {}'.format(self.radio_receiver.name))
+                self.failure_num += 1
+                backoff_sec = self.poll_scheduler.record_failure()
+                if self.failure_num > self.max_failures:
+                    logger.error('Giving up on receiver {} after {} failures in a row'.format(self.radio_receiver.name,
+                                                                                          self.failure_num))
+                    self.gave_up = True
+                    return
+                if self.dbconn and not self.dbconn.closed:
+                    self.dbconn.rollback()
+                logger.info('Retrying receiver {} in {:.1f} sec'.format(self.radio_receiver.name, backoff_sec))
+                stop_event.wait(backoff_sec)
+                next_poll_time = time.time()
+                continue
+
+            next_poll_time += self.poll_scheduler.next_interval_sec()
+            stop_event.wait(max(0.0, next_poll_time - time.time()))
+
+
+def poll_receivers_concurrently(receiver_pollers, stop_event=None):
+    """
+    Run each ReceiverPoller in its own thread and block until all of them have finished
+
+    :param receiver_pollers: list of ReceiverPoller objects
+    :param stop_event: optional threading.Event that stops all pollers when set
+    :return: list of the pollers that gave up after too many failures
+    """
+    if stop_event is None:
+        stop_event = threading.Event()
+
+    poller_threads = []
+    for receiver_poller in receiver_pollers:
+        poller_thread = threading.Thread(target=receiver_poller.run,
+                                         args=(stop_event,),
+                                         name='poller-{}'.format(receiver_poller.radio_receiver.name))
+        poller_thread.daemon = True
+        poller_thread.start()
+        poller_threads.append(poller_thread)
+
+    try:
+        for poller_thread in poller_threads:
+            # join with a timeout in a loop so that KeyboardInterrupt is still delivered to the main thread
+            while poller_thread.is_alive():
+                poller_thread.join(1.0)
+    except KeyboardInterrupt:
+        logger.info('Stopping all receiver pollers.')
+        stop_event.set()
+        for poller_thread in poller_threads:
+            poller_thread.join()
+
+    return [receiver_poller for receiver_poller in receiver_pollers if receiver_poller.gave_up]
@@ -0,0 +1,401 @@
+"""
+Columnar batch of aircraft reports, holding a whole poll or archive file as NumPy arrays so that unit conversion,
+ground detection and validity filtering run as vectorised operations instead of once per AircraftReport
+"""
+
+import logging
+
+import numpy as np
+
+from model import aircraft_report
+from utils import mathutils
+
+logger = logging.getLogger(__name__)
+
+# name -> dtype of every per-report column in a ReportBatch
+batch_column_dtypes = {'mode_s_hex': object,
+                       'squawk': object,
+                       'flight': object,
+                       'lat': np.float64,
+                       'lon': np.float64,
+                       'altitude': np.float64,
+                       'speed': np.float64,
+                       'track': np.float64,
+                       'vert_rate': np.float64,
+                       'epoch': np.float64,
+                       'messages': np.int64,
+                       'rssi': np.float64,
+                       'nucp': np.int64,
+                       'is_ground': np.bool_,
+                       'is_mlat': np.bool_,
+                       'is_anon': np.bool_}
+
+
+class ReportBatch(object):
+    """
+    A set of aircraft reports stored as one NumPy array per field. Missing rssi values are NaN.
+    is_metric and reporter apply to the whole batch.
+    """
+
+    def __init__(self, columns, is_metric=False, reporter=None):
+        """
+        :param columns: dict of column name -> sequence, with every key of batch_column_dtypes, all the same length
+        :param is_metric: whether altitude/speed/vert_rate are already metres/kmh/metres per minute
+        :param reporter: name of the receiver the reports came from
+        """
+        for column_name, column_dtype in batch_column_dtypes.items():
+            setattr(self, column_name, np.asarray(columns[column_name], dtype=column_dtype))
+        self.is_metric = is_metric
+        self.reporter = reporter
+
+    def __len__(self):
+        return len(self.epoch)
+
+    @classmethod
+    def empty(cls):
+        return cls({column_name: [] for column_name in batch_column_dtypes})
+
+    @classmethod
+    def from_dump1090(cls, dumpfmt_aircraft_report_list, snapshot_epoch=None):
+        """
+        Build a batch from the 'aircraft' list of dump1090's aircraft.json. Aircraft missing any of the
+        dump1090_minimum_keynames are skipped, and altitude 'ground' is stored as 0 with is_ground set.
+
+        :param dumpfmt_aircraft_report_list: list of aircraft dicts
+        :param snapshot_epoch: the 'now' value of the snapshot, used to work out each position's epoch
+        :return: ReportBatch in US units
+        """
+        columns = {column_name: [] for column_name in batch_column_dtypes}
+
+        for dumpfmt_aircraft_report in dumpfmt_aircraft_report_list:
+            if any(key_name not in dumpfmt_aircraft_report for key_name in aircraft_report.dump1090_minimum_keynames):
+                continue
+            get_value = dumpfmt_aircraft_report.get
+
+            altitude = dumpfmt_aircraft_report['altitude']
+            is_ground = altitude == 'ground'
+
+            report_time = get_value('time')
+            if report_time is None:
+                if snapshot_epoch is not None:
+                    report_time = snapshot_epoch - get_value('seen_pos', get_value('seen', 0))
+                else:
+                    report_time = 0
+
+            rssi = get_value('rssi')
+            nucp = get_value('nucp')
+
+            columns['mode_s_hex'].append(dumpfmt_aircraft_report['hex'])
+            columns['squawk'].append(get_value('squawk'))
+            columns['flight'].append(get_value('flight'))
+            columns['lat'].append(dumpfmt_aircraft_report['lat'])
+            columns['lon'].append(dumpfmt_aircraft_report['lon'])
+            columns['altitude'].append(0 if is_ground else altitude)
+            columns['speed'].append(dumpfmt_aircraft_report['speed'])
+            columns['track'].append(dumpfmt_aircraft_report['track'])
+            columns['vert_rate'].append(get_value('vert_rate', 0.0))
+            columns['epoch'].append(report_time)
+            columns['messages'].append(get_value('messages', 0))
+            columns['rssi'].append(np.nan if rssi is None else rssi)
+            columns['nucp'].append(-1 if nucp is None else nucp)
+            columns['is_ground'].append(is_ground)
+            # mutability dump1090 has mlat set to list of attributes mlat'ed, we want a boolean
+            columns['is_mlat'].append('mlat' in dumpfmt_aircraft_report)
+            columns['is_anon'].append(False)
+
+        report_batch = cls(columns)
+        report_batch.detect_anon()
+        return report_batch
+
+    @classmethod
+    def from_vrs(cls, vrs_aircraft_report_list, missing_flight=' '):
+        """
+        Build a batch from a VRS (adsbexchange) acList. Records missing any of the adsb_vrs_keynames are skipped.
+
+        :param vrs_aircraft_report_list: list of acList record dicts
+        :param missing_flight: flight value to use when a record has no Call
+        :return: ReportBatch in US units
+        """
+        columns = {column_name: [] for column_name in batch_column_dtypes}
+
+        for vrs_aircraft_report in vrs_aircraft_report_list:
+            if any(key_name not in vrs_aircraft_report for key_name in aircraft_report.adsb_vrs_keynames):
+                continue
+
+            if 'Call' in vrs_aircraft_report:
+                flight = aircraft_report.flight_format.format(vrs_aircraft_report['Call'])
+            else:
+                flight = missing_flight
+
+            columns['mode_s_hex'].append(vrs_aircraft_report['Icao'].upper())
+            columns['squawk'].append(vrs_aircraft_report['Sqk'])
+            columns['flight'].append(flight)
+            columns['lat'].append(vrs_aircraft_report['Lat'])
+            columns['lon'].append(vrs_aircraft_report['Long'])
+            columns['altitude'].append(vrs_aircraft_report['Alt'])
+            columns['speed'].append(vrs_aircraft_report['Spd'])
+            columns['track'].append(vrs_aircraft_report['Trak'])
+            columns['vert_rate'].append(vrs_aircraft_report.get('Vsi', 0.0))
+            columns['epoch'].append(vrs_aircraft_report['PosTime'] / 1000)
+            columns['messages'].append(vrs_aircraft_report['CMsgs'])
+            columns['rssi'].append(np.nan)
+            columns['nucp'].append(-1)
+            columns['is_ground'].append(vrs_aircraft_report['Gnd'])
+            columns['is_mlat'].append(vrs_aircraft_report['Mlat'])
+            columns['is_anon'].append(False)
+
+        report_batch = cls(columns, reporter='')
+        report_batch.detect_anon()
+        return report_batch
+
+    @classmethod
+    def from_vrs_trails(cls, vrs_aircraft_report_list, minlat83=-90.0, maxlat83=90.0, minlong83=-180.0,
+                        maxlong83=180.0, missing_flight=''):
+        """
+        Expand the short trail ('Cos') of every record in a VRS archive acList into one report per trail point.
+        The trails of all records are stacked into one (N, 4) array of lat, long, epoch ms and altitude/speed, and
+        the TT column handling and bounding box filter are applied as masks over it.
+
+        Records missing any of the vrs_adsb_file_keynames, or with a TT other than 'a' (4th value is altitude) or
+        's' (4th value is speed), are skipped. Trail points whose 4th value is missing or 0 are skipped.
+
+        :param vrs_aircraft_report_list: list of acList record dicts
+        :param missing_flight: flight value to use when a record has no Call
+        :return: ReportBatch in US units, one report per kept trail point
+        """
+        trail_values = []
+        trail_lengths = []
+        trail_records = []
+        num_skipped_tt = 0
+
+        required_keynames = set(aircraft_report.vrs_adsb_file_keynames)
+
+        for vrs_aircraft_report in vrs_aircraft_report_list:
+            if not required_keynames.issubset(vrs_aircraft_report):
+                continue
+            if vrs_aircraft_report['TT'] != 'a' and vrs_aircraft_report['TT'] != 's':
+                num_skipped_tt += 1
+                continue
+
+            past_track = vrs_aircraft_report['Cos']
+            num_positions_in_track = len(past_track) // 4
+            if num_positions_in_track == 0:
+                continue
+
+            trail_values.extend(past_track[:num_positions_in_track * 4])
+            trail_lengths.append(num_positions_in_track)
+            trail_records.append(vrs_aircraft_report)
+
+        if num_skipped_tt:
+            logger.info('Skipped {} acList records with TT not a or s'.format(num_skipped_tt))
+
+        if not trail_records:
+            return cls.empty()
+
+        # None values in the trails become NaN
+        trail = np.array(trail_values, dtype=np.float64).reshape(-1, 4)
+        record_index = np.repeat(np.arange(len(trail_records)), trail_lengths)
+
+        lat = trail[:, 0]
+        lon = trail[:, 1]
+        fourth_value = trail[:, 3]
+        with np.errstate(invalid='ignore'):
+            keep_mask = ((fourth_value != 0) & ~np.isnan(fourth_value) &
+                         (lat >= minlat83) & (lat <= maxlat83) & (lon >= minlong83) & (lon <= maxlong83))
+
+        # Only the kept points are expanded out to full columns
+        trail = trail[keep_mask]
+        record_index = record_index[keep_mask]
+        fourth_value = trail[:, 3]
+
+        def record_column(key_name, dtype=np.float64):
+            return np.array([vrs_aircraft_report[key_name] for vrs_aircraft_report in trail_records],
+                            dtype=dtype)[record_index]
+
+        # Each point's 4th value is either its altitude or its speed, depending on the record's TT
+        is_altitude_trail = record_column('TT', dtype=object) == 'a'
+
+        flights = [aircraft_report.flight_format.format(vrs_aircraft_report['Call'])
+                   if 'Call' in vrs_aircraft_report else missing_flight
+                   for vrs_aircraft_report in trail_records]
+
+        columns = {'mode_s_hex': np.array([vrs_aircraft_report['Icao'].upper()
+                                           for vrs_aircraft_report in trail_records], dtype=object)[record_index],
+                   'squawk': record_column('Sqk', dtype=object),
+                   'flight': np.array(flights, dtype=object)[record_index],
+                   'lat': trail[:, 0],
+                   'lon': trail[:, 1],
+                   'altitude': np.where(is_altitude_trail, fourth_value, record_column('Alt')),
+                   'speed': np.where(is_altitude_trail, record_column('Spd'), fourth_value),
+                   'track': record_column('Trak'),
+                   'vert_rate': np.array([vrs_aircraft_report.get('Vsi', 0.0)
+                                          for vrs_aircraft_report in trail_records], dtype=np.float64)[record_index],
+                   'epoch': trail[:, 2] / 1000,
+                   'messages': record_column('CMsgs', dtype=np.int64),
+                   'rssi': np.full(len(trail), np.nan),
+                   'nucp': np.full(len(trail), -1, dtype=np.int64),
+                   'is_ground': record_column('Gnd', dtype=np.bool_),
+                   'is_mlat': record_column('Mlat', dtype=np.bool_),
+                   'is_anon': np.array([vrs_aircraft_report['Icao'][:1] == '~'
+                                        for vrs_aircraft_report in trail_records], dtype=np.bool_)[record_index]}
+
+        return cls(columns, reporter='')
+
+    @classmethod
+    def from_reports(cls, aircraft_reports_list):
+        """
+        Build a batch from a list of AircraftReport or CompactAircraftReport objects
+
+        :param aircraft_reports_list: list of reports, which must all be metric or all be US units
+        :return: ReportBatch
+        """
+        if not aircraft_reports_list:
+            return cls.empty()
+
+        columns = {'mode_s_hex': [aircraft.mode_s_hex for aircraft in aircraft_reports_list],
+                   'squawk': [aircraft.squawk for aircraft in aircraft_reports_list],
+                   'flight': [aircraft.flight for aircraft in aircraft_reports_list],
+                   'lat': [aircraft.lat for aircraft in aircraft_reports_list],
+                   'lon': [aircraft.lon for aircraft in aircraft_reports_list],
+                   'altitude': [aircraft.altitude for aircraft in aircraft_reports_list],
+                   'speed': [aircraft.speed for aircraft in aircraft_reports_list],
+                   'track': [aircraft.track for aircraft in aircraft_reports_list],
+                   'vert_rate': [aircraft.vert_rate for aircraft in aircraft_reports_list],
+                   'epoch': [aircraft.time for aircraft in aircraft_reports_list],
+                   'messages': [aircraft.messages for aircraft in aircraft_reports_list],
+                   'rssi': [np.nan if aircraft.rssi is None else aircraft.rssi for aircraft in aircraft_reports_list],
+                   'nucp': [aircraft.nucp for aircraft in aircraft_reports_list],
+                   'is_ground': [bool(aircraft.is_ground) for aircraft in aircraft_reports_list],
+                   'is_mlat': [bool(aircraft.mlat) for aircraft in aircraft_reports_list],
+                   'is_anon': [bool(aircraft.is_anon) for aircraft in aircraft_reports_list]}
+
+        return cls(columns,
+                   is_metric=aircraft_reports_list[0].is_metric,
+                   reporter=aircraft_reports_list[0].reporter)
+
+    @classmethod
+    def concatenate(cls, report_batches):
+        """
+        Join several batches into one. The batches must all be metric or all be US units.
+
+        :param report_batches: list of ReportBatch objects
+        :return: ReportBatch
+        """
+        if not report_batches:
+            return cls.empty()
+
+        columns = {column_name: np.concatenate([getattr(report_batch, column_name) for report_batch in report_batches])
+                   for column_name in batch_column_dtypes}
+
+        return cls(columns, is_metric=report_batches[0].is_metric, reporter=report_batches[0].reporter)
+
+    def convert_to_metric(self):
+        """Converts the whole batch to metric units, truncating altitude and speed like AircraftReport does"""
+        if self.is_metric:
+            return
+        self.vert_rate = self.vert_rate * aircraft_report.ft_to_meters
+        self.altitude = np.trunc(self.altitude * aircraft_report.ft_to_meters)
+        self.speed = np.trunc(self.speed * aircraft_report.knots_to_kmh)
+        self.is_metric = True
+
+    def convert_from_metric_to_us(self):
+        """Converts the whole batch to Freedom units"""
+        if not self.is_metric:
+            return
+        self.vert_rate = self.vert_rate / aircraft_report.ft_to_meters
+        self.altitude = np.trunc(self.altitude / aircraft_report.ft_to_meters)
+        self.speed = np.trunc(self.speed / aircraft_report.knots_to_kmh)
+        self.is_metric = False
+
+    def detect_ground(self):
+        """Flag every report with an altitude of 0 as on the ground, on top of any ground flags from the source"""
+        self.is_ground = self.is_ground | (self.altitude == 0)
+
+    def detect_anon(self):
+        """
+        FA anonymizes the mode-s hex for certain aircraft, and denotes it with a ~ as
+        the first character in the fake mode-s hex code they send back on the MLAT results
+        """
+        self.is_anon = np.array([mode_s_hex[:1] == '~' for mode_s_hex in self.mode_s_hex], dtype=np.bool_)
+        if self.is_anon.any():
+            logger.warning('{} Anon Mode S Hex detected: {}'.format(int(self.is_anon.sum()),
+                                                                      self.mode_s_hex[self.is_anon].tolist()))
+
+    def valid_position_mask(self, minlat83=-90.0, maxlat83=90.0, minlong83=-180.0, maxlong83=180.0):
+        """
+        :return: bool array that is True for reports with a finite position inside the bounding box
+        """
+        with np.errstate(invalid='ignore'):
+            return (np.isfinite(self.lat) & np.isfinite(self.lon) &
+                    (self.lat >= minlat83) & (self.lat <= maxlat83) &
+                    (self.lon >= minlong83) & (self.lon <= maxlong83))
+
+    def get_distances_meters(self, lon, lat):
+        """
+        :return: array of each report's great circle distance in meters from a point, e.g. its receiver. NaN for
+                 reports without a position.
+        """
+        return mathutils.distance_meters(lon, lat, self.lon, self.lat)
+
+    def filter(self, mask):
+        """
+        :param mask: bool array (or index array) selecting the reports to keep
+        :return: new ReportBatch with only the selected reports
+        """
+        columns = {column_name: getattr(self, column_name)[mask] for column_name in batch_column_dtypes}
+        return ReportBatch(columns, is_metric=self.is_metric, reporter=self.reporter)
+
+    def sort_by_aircraft_and_epoch(self):
+        """
+        :return: new ReportBatch ordered by mode_s_hex and then epoch
+        """
+        return self.filter(np.lexsort((self.epoch, self.mode_s_hex.astype(str))))
+
+    def group_by_aircraft(self):
+        """
+        :return: dict of mode_s_hex -> index array of that aircraft's reports, in epoch order
+        """
+        order = np.lexsort((self.epoch, self.mode_s_hex.astype(str)))
+        sorted_hexes = self.mode_s_hex[order]
+        group_starts = np.flatnonzero(np.r_[True, sorted_hexes[1:] != sorted_hexes[:-1]]) if len(order) else []
+        group_ends = list(group_starts[1:]) + [len(order)]
+
+        return {sorted_hexes[group_start]: order[group_start:group_end]
+                for group_start, group_end in zip(group_starts, group_ends)}
+
+    def to_db_rows(self):
+        """
+        :return: list of row tuples in aircraft_report.staging_column_names order, for the bulk COPY loader
+        """
+        num_reports = len(self)
+        rssi_list = [None if rssi != rssi else rssi for rssi in self.rssi.tolist()]
+
+        return list(zip(self.mode_s_hex.tolist(), self.squawk.tolist(), self.flight.tolist(),
+                        [self.is_metric] * num_reports, self.is_mlat.tolist(),
+                        self.altitude.tolist(), self.speed.tolist(), self.vert_rate.tolist(),
+                        self.track.tolist(), self.lon.tolist(), self.lat.tolist(),
+                        self.messages.tolist(), self.epoch.tolist(), [self.reporter] * num_reports,
+                        rssi_list, self.nucp.tolist(), self.is_ground.tolist(), self.is_anon.tolist()))
+
+    def to_reports(self):
+        """
+        :return: list of CompactAircraftReport objects, one per report in the batch
+        """
+        rssi_list = [None if rssi != rssi else rssi for rssi in self.rssi.tolist()]
+        reports_list = []
+        for report_values in zip(self.mode_s_hex.tolist(), self.lat.tolist(), self.lon.tolist(), self.epoch.tolist(),
+                                 self.altitude.tolist(), self.speed.tolist(), self.vert_rate.tolist(),
+                                 self.track.tolist(), self.squawk.tolist(), self.flight.tolist(),
+                                 self.messages.tolist(), self.is_mlat.tolist(), rssi_list, self.nucp.tolist(),
+                                 self.is_ground.tolist()):
+            (mode_s_hex, lat, lon, epoch, altitude, speed, vert_rate, track, squawk, flight,
+             messages, is_mlat, rssi, nucp, is_ground) = report_values
+            reports_list.append(aircraft_report.CompactAircraftReport(mode_s_hex=mode_s_hex, lat=lat, lon=lon,
+                                                                      time=epoch, altitude=altitude, speed=speed,
+                                                                      vert_rate=vert_rate, track=track,
+                                                                      squawk=squawk, flight=flight,
+                                                                      messages=messages, mlat=is_mlat, rssi=rssi,
+                                                                      nucp=nucp, is_ground=is_ground,
+                                                                      reporter=self.reporter,
+                                                                      is_metric=self.is_metric))
+        return reports_list
@@ -0,0 +1,273 @@
+"""
+Message bus between the receiver pollers and the DB writer, so that fetchers and DB writers can run as separate
+processes (or hosts) and be scaled independently.
+
+ReportBus is the transport abstraction: producers publish report rows (see AircraftReport.to_db_row) to a
+partition, and consumers in a consumer group read them back and commit their offsets once the rows are safely in
+the DB. FileReportBus is the local stand-in for Kafka - a directory with one append-only ReportSpool per partition,
+which can be shared between hosts on a network filesystem.
+
+Offsets are committed after the DB commit, in batches, so a DB writer that restarts carries on from the last
+committed batch. Rows of an uncommitted batch are read again, and the (mode_s_hex, report_epoch) unique constraint
+keeps them from being written twice.
+"""
+
+import abc
+import logging
+import os
+import socket
+
+from model import aircraft_report
+from model import report_spool
+
+logger = logging.getLogger(__name__)
+
+bus_backends = ('file',)
+
+default_consumer_group = 'dbwriter'
+default_consumer_batch_size = 10000
+default_consumer_poll_interval_sec = 1.0
+
+offsets_file_format = 'offsets-{}.json'
+
+
+class ReportBus(abc.ABC):
+    """
+    Transport between the pollers and the DB writer, implemented by each backend
+    """
+
+    @abc.abstractmethod
+    def get_producer(self, partition_name):
+        """
+        :return: producer of one partition, with append_reports(reports_list, radio_receiver) and close()
+        """
+
+    @abc.abstractmethod
+    def get_consumer(self, group):
+        """
+        :return: consumer of every partition for a consumer group, with poll(max_rows), commit(), rewind() and
+                 close()
+        """
+
+
+class FileReportBus(ReportBus):
+    """
+    Report bus backed by a directory of partitions, each an append-only segmented ReportSpool. Every producing
+    process must write to its own partition(s) - get_default_partition_name gives one per host and receiver.
+    """
+
+    def __init__(self, bus_dir, segment_max_bytes=report_spool.default_segment_max_bytes, fsync=True):
+        self.bus_dir = bus_dir
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync = fsync
+        os.makedirs(bus_dir, exist_ok=True)
+
+    def get_partition_names(self):
+        return sorted([partition_name for partition_name in os.listdir(self.bus_dir)
+                       if os.path.isdir(os.path.join(self.bus_dir, partition_name))])
+
+    def get_partition(self, partition_name):
+        return report_spool.ReportSpool(os.path.join(self.bus_dir, partition_name),
+                                        segment_max_bytes=self.segment_max_bytes,
+                                        fsync=self.fsync)
+
+    def get_producer(self, partition_name):
+        return self.get_partition(partition_name)
+
+    def get_consumer(self, group=default_consumer_group):
+        return FileBusConsumer(self, group)
+
+    def delete_consumed_segments(self, groups):
+        """
+        Delete the segments that every one of the consumer groups has finished with
+
+        :param groups: list of the consumer group names reading this bus
+        :return: number of segments deleted
+        """
+        num_deleted = 0
+        for partition_name in self.get_partition_names():
+            partition = self.get_partition(partition_name)
+            min_segment_num = min([partition.read_checkpoint(offsets_file_format.format(group))[0]
+                                   for group in groups])
+            for segment_num in partition.get_segment_nums():
+                if segment_num < min_segment_num:
+                    os.remove(partition.get_segment_path(segment_num))
+                    num_deleted += 1
+        return num_deleted
+
+
+class FileBusConsumer(object):
+    """
+    Reads rows from every partition of a FileReportBus, keeping track of how far it has read. Positions are only
+    made durable by commit(), and rewind() goes back to the last committed positions.
+    """
+
+    def __init__(self, report_bus, group):
+        self.report_bus = report_bus
+        self.group = group
+        self.offsets_filename = offsets_file_format.format(group)
+        self.partitions = {}
+        self.positions = {}
+
+    def get_position(self, partition_name):
+        if partition_name not in self.partitions:
+            self.partitions[partition_name] = self.report_bus.get_partition(partition_name)
+        if partition_name not in self.positions:
+            self.positions[partition_name] = \
+                self.partitions[partition_name].read_checkpoint(self.offsets_filename)
+        return self.partitions[partition_name], self.positions[partition_name]
+
+    def poll(self, max_rows):
+        """
+        :param max_rows: max number of rows to return
+        :return: list of up to max_rows rows that haven't been read yet, from across all of the partitions
+        """
+        db_rows = []
+
+        for partition_name in self.report_bus.get_partition_names():
+            partition, (segment_num, offset) = self.get_position(partition_name)
+
+            for partition_segment_num in partition.get_segment_nums():
+                if partition_segment_num < segment_num:
+                    continue
+                if partition_segment_num > segment_num:
+                    segment_num, offset = partition_segment_num, 0
+
+                # Check before reading, so rows appended after the read are never mistaken for a finished segment
+                segment_finished = partition.has_later_segment(segment_num)
+                segment_rows, offset, end_of_segment = partition.read_rows(segment_num, offset,
+                                                                           max_rows - len(db_rows))
+                db_rows.extend(segment_rows)
+
+                if not (end_of_segment and segment_finished):
+                    break
+                # Anything after the last complete row of a finished segment is a crash leftover
+                segment_num, offset = segment_num + 1, 0
+
+            self.positions[partition_name] = (segment_num, offset)
+            if len(db_rows) >= max_rows:
+                break
+
+        return db_rows
+
+    def commit(self):
+        """Durably record how far every partition has been read"""
+        for partition_name, (segment_num, offset) in self.positions.items():
+            self.partitions[partition_name].write_checkpoint(segment_num, offset, self.offsets_filename)
+
+    def rewind(self):
+        """Forget the uncommitted positions, so the next poll re-reads from the last commit"""
+        self.positions = {}
+
+    def close(self):
+        self.partitions = {}
+        self.positions = {}
+
+
+class BusWriter(object):
+    """
+    DB writer that consumes report rows from a bus and merges them into aircraftreports in bulk, committing the
+    consumer's offsets after every DB commit
+    """
+
+    def __init__(self, consumer, db_connect, batch_size=default_consumer_batch_size,
+                 poll_interval_sec=default_consumer_poll_interval_sec, itinerary_tracker=None):
+        """
+        :param consumer: bus consumer to read from
+        :param db_connect: callable returning a new DB connection (or None if the DB can't be reached)
+        :param batch_size: rows per COPY + merge transaction, and so per offset commit
+        :param poll_interval_sec: seconds to wait when the bus is empty or the DB is down
+        :param itinerary_tracker: optional ItineraryTracker that stamps each row's itinerary_id. The bus writer
+                                  sees every receiver's reports, which makes it the best place to stamp them.
+        """
+        self.consumer = consumer
+        self.itinerary_tracker = itinerary_tracker
+        self.db_connect = db_connect
+        self.batch_size = batch_size
+        self.poll_interval_sec = poll_interval_sec
+        self.dbconn = None
+
+        self.rows_written = 0
+        self.rows_inserted = 0
+
+    def get_dbconn(self):
+        if self.dbconn is None or self.dbconn.closed:
+            self.dbconn = self.db_connect()
+        return self.dbconn
+
+    def write_available(self):
+        """
+        Write everything that's on the bus right now
+
+        :return: number of rows written
+        """
+        num_written = 0
+        while True:
+            dbconn = self.get_dbconn()
+            if not dbconn:
+                logger.error('No DB Connection. Leaving reports on the bus')
+                return num_written
+
+            db_rows = self.consumer.poll(self.batch_size)
+            if not db_rows:
+                return num_written
+
+            try:
+                num_inserted, _ = aircraft_report.merge_db_rows_into_aircraftreports(
+                    dbconn, db_rows, itinerary_tracker=self.itinerary_tracker)
+                dbconn.commit()
+            except:
+                logger.exception('Issue writing {} reports from the bus into DB, will retry'.format(len(db_rows)))
+                try:
+                    dbconn.rollback()
+                except:
+                    self.dbconn = None
+                self.consumer.rewind()
+                return num_written
+
+            self.consumer.commit()
+            num_written += len(db_rows)
+            self.rows_written += len(db_rows)
+            self.rows_inserted += num_inserted
+            logger.info('Wrote {} reports from the bus into DB ({} total, {} inserted)'.format(
+                len(db_rows), self.rows_written, self.rows_inserted))
+
+    def run(self, stop_event, after_write=None):
+        """
+        Consume until stop_event is set
+
+        :param stop_event: threading.Event that stops the writer
+        :param after_write: optional callable run after each pass that wrote something, e.g. to clean up segments
+        """
+        while not stop_event.is_set():
+            try:
+                num_written = self.write_available()
+            except:
+                logger.exception('Issue consuming reports from the bus')
+                self.consumer.rewind()
+                num_written = 0
+
+            if num_written and after_write is not None:
+                after_write()
+            if not num_written:
+                stop_event.wait(self.poll_interval_sec)
+
+
+def get_default_partition_name(radio_receiver):
+    """One partition per host and receiver, so that producers never share a partition"""
+    return '{}-{}'.format(socket.gethostname(), radio_receiver.name)
+
+
+def get_report_bus(bus_config):
+    """
+    Build the report bus described by the bus section of config.yml
+
+    :param bus_config: dict with backend and the backend's settings
+    :return: ReportBus
+    """
+    backend = bus_config.get('backend', 'file')
+    if backend == 'file':
+        return FileReportBus(bus_config['dir'],
+                             segment_max_bytes=bus_config.get('segmentmaxbytes',
+                                                              report_spool.default_segment_max_bytes))
+    raise ValueError('Unknown report bus backend {}, expected one of {}'.format(backend, bus_backends))
@@ -0,0 +1,406 @@
+"""
+Maintenance of the time partitions of aircraftreports, which is range partitioned on report_epoch (see
+sql/postgres_setup.sql). Partitions are daily or weekly, in UTC, named after the day they start on, e.g.
+aircraftreports_p20171025. Future partitions are created ahead of time so reports never land in the default
+partition, and partitions older than the retention period are detached (and optionally dropped). Backfills of old
+reports (e.g. archive ingest) create the partitions they need before loading, with create_partitions_for_epochs,
+and any reports that still land in the default partition are moved out into their own partitions by maintain.
+
+Queries that bound report_epoch only read the partitions covering that range, and the
+UNIQUE (mode_s_hex, report_epoch) constraint holds across partitions since it includes the partition key.
+"""
+
+import calendar
+import logging
+import re
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+report_table_name = 'aircraftreports'
+default_partition_suffix = '_default'
+partition_name_format = '{}_p{}'
+partition_date_format = '%Y%m%d'
+
+seconds_per_day = 24 * 60 * 60
+
+# Interval name -> (seconds per partition, epoch of a partition boundary). Weeks start on Mondays.
+partition_intervals = {'daily': (seconds_per_day, 0),
+                       'weekly': (7 * seconds_per_day, calendar.timegm((1970, 1, 5, 0, 0, 0)))}
+
+default_partition_interval = 'daily'
+
+# Number of partitions kept ready after the current one
+default_premake_partitions = 7
+
+# 0 keeps partitions forever
+default_retention_days = 0
+
+default_maintenance_interval_sec = 3600
+
+# pg_get_expr of a range partition's bound, e.g. FOR VALUES FROM (1508889600) TO (1508976000)
+partition_bound_regex = re.compile(r"FOR VALUES FROM \('?([^')]+)'?\) TO \('?([^')]+)'?\)")
+
+
+def get_partition_range(epoch, interval=default_partition_interval):
+    """
+    :param epoch: any epoch timestamp
+    :param interval: name of the partition interval, see partition_intervals
+    :return: tuple of (start, end) epochs of the partition that holds epoch, start inclusive and end exclusive
+    """
+    interval_sec, boundary_epoch = partition_intervals[interval]
+    start_epoch = epoch - (epoch - boundary_epoch) % interval_sec
+    return start_epoch, start_epoch + interval_sec
+
+
+def get_partition_starts(epochs, interval=default_partition_interval):
+    """
+    :param epochs: array (or list) of epoch timestamps
+    :param interval: name of the partition interval, see partition_intervals
+    :return: sorted array of the distinct start epochs of the partitions that hold the epochs
+    """
+    interval_sec, boundary_epoch = partition_intervals[interval]
+    # Rounded the way report_epoch is stored
+    epochs = np.rint(np.asarray(epochs, dtype=np.float64)).astype(np.int64)
+    return np.unique(epochs - (epochs - boundary_epoch) % interval_sec)
+
+
+def get_partition_name(start_epoch, table_name=report_table_name):
+    return partition_name_format.format(table_name, time.strftime(partition_date_format, time.gmtime(start_epoch)))
+
+
+def parse_partition_bound(partition_bound):
+    """
+    :param partition_bound: partition bound expression, as returned by pg_get_expr(relpartbound, oid)
+    :return: tuple of (start, end) epochs, None for MINVALUE / MAXVALUE, or None if it's the default partition
+    """
+    bound_match = partition_bound_regex.search(partition_bound)
+    if bound_match is None:
+        return None
+
+    def parse_bound_value(bound_value):
+        if bound_value.upper() in ('MINVALUE', 'MAXVALUE'):
+            return None
+        return int(bound_value)
+
+    return parse_bound_value(bound_match.group(1)), parse_bound_value(bound_match.group(2))
+
+
+class ReportPartitionManager(object):
+    """
+    Creates and retires the report_epoch partitions of aircraftreports. Does nothing (apart from warning once) if
+    the table isn't partitioned, so it's safe to enable against a database that hasn't been migrated yet.
+    """
+
+    def __init__(self, db_connect, interval=default_partition_interval, premake_partitions=default_premake_partitions,
+                 retention_days=default_retention_days, drop_detached=False,
+                 maintenance_interval_sec=default_maintenance_interval_sec, table_name=report_table_name):
+        """
+        :param db_connect: callable returning a DB connection (or None if the DB can't be reached)
+        :param interval: 'daily' or 'weekly'
+        :param premake_partitions: number of partitions to keep ready after the current one
+        :param retention_days: partitions that end more than this many days ago are detached, 0 keeps them all
+        :param drop_detached: drop partitions past retention instead of only detaching them
+        :param maintenance_interval_sec: seconds between maintenance passes of the background thread
+        :param table_name: partitioned table
+        """
+        if interval not in partition_intervals:
+            raise ValueError('Unknown partition interval {}, expected one of {}'.format(
+                interval, sorted(partition_intervals.keys())))
+        self.db_connect = db_connect
+        self.interval = interval
+        self.premake_partitions = premake_partitions
+        self.retention_days = retention_days
+        self.drop_detached = drop_detached
+        self.maintenance_interval_sec = maintenance_interval_sec
+        self.table_name = table_name
+        self.dbconn = None
+
+        self.stop_event = threading.Event()
+        self.maintenance_thread = None
+        self.warned_not_partitioned = False
+
+        self.partitions_created = 0
+        self.partitions_detached = 0
+
+    def get_dbconn(self):
+        if self.dbconn is None or self.dbconn.closed:
+            self.dbconn = self.db_connect()
+        return self.dbconn
+
+    def is_partitioned(self, db_cursor):
+        db_cursor.execute('SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)', (self.table_name,))
+        relkind_row = db_cursor.fetchone()
+        return relkind_row is not None and relkind_row[0] == 'p'
+
+    def get_partitions(self, db_cursor):
+        """
+        :return: list of (partition name, start epoch, end epoch) of the table's range partitions, ordered by start.
+                 start / end are None for MINVALUE / MAXVALUE.
+        """
+        db_cursor.execute('''SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+                               FROM pg_inherits
+                                 JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                               WHERE pg_inherits.inhparent = to_regclass(%s)''', (self.table_name,))
+
+        partitions = []
+        for partition_name, partition_bound in db_cursor.fetchall():
+            partition_range = parse_partition_bound(partition_bound)
+            if partition_range is not None:
+                partitions.append((partition_name, partition_range[0], partition_range[1]))
+
+        return sorted(partitions, key=lambda partition: float('-inf') if partition[1] is None else partition[1])
+
+    def get_missing_ranges(self, partitions, now):
+        """
+        :param partitions: existing partitions, see get_partitions
+        :param now: current epoch
+        :return: list of (start, end) ranges to create, from the current partition to premake_partitions ahead. Any
+                 part of a range already covered by an existing partition (e.g. made with another interval) is left
+                 out.
+        """
+        interval_sec = partition_intervals[self.interval][0]
+        current_start_epoch = get_partition_range(now, self.interval)[0]
+        return self.get_uncovered_ranges(partitions, [current_start_epoch + partition_num * interval_sec
+                                                      for partition_num in range(self.premake_partitions + 1)])
+
+    def get_uncovered_ranges(self, partitions, epochs):
+        """
+        :param partitions: existing partitions, see get_partitions
+        :param epochs: epochs that need a partition, e.g. see get_partition_starts
+        :return: sorted list of (start, end) ranges of the partitions that would hold the epochs, less any part
+                 already covered by an existing partition
+        """
+        missing_ranges = []
+        for range_start, range_end in sorted(set(get_partition_range(int(epoch), self.interval) for epoch in epochs)):
+            for _, partition_start, partition_end in partitions:
+                partition_start = float('-inf') if partition_start is None else partition_start
+                partition_end = float('inf') if partition_end is None else partition_end
+                if partition_start <= range_start < partition_end:
+                    range_start = partition_end
+                elif range_start < partition_start < range_end:
+                    range_end = partition_start
+
+            if range_start < range_end:
+                missing_ranges.append((int(range_start), int(range_end)))
+
+        return missing_ranges
+
+    def get_default_partition_name(self, db_cursor):
+        """
+        :return: name of the table's default partition, or None if it hasn't got one
+        """
+        default_partition_name = self.table_name + default_partition_suffix
+        db_cursor.execute('SELECT to_regclass(%s) IS NOT NULL', (default_partition_name,))
+        return default_partition_name if db_cursor.fetchone()[0] else None
+
+    def get_default_partition_starts(self, db_cursor):
+        """
+        :return: list of the start epochs of the partitions that the reports in the default partition belong in
+        """
+        default_partition_name = self.get_default_partition_name(db_cursor)
+        if default_partition_name is None:
+            return []
+        interval_sec, boundary_epoch = partition_intervals[self.interval]
+        # Postgres % keeps the sign of the dividend, so it's made positive for epochs before the boundary
+        db_cursor.execute('''SELECT DISTINCT report_epoch - ((report_epoch - %(boundary)s) %% %(interval)s
+                                                             + %(interval)s) %% %(interval)s
+                               FROM {}
+                               WHERE report_epoch IS NOT NULL'''.format(default_partition_name),
+                          {'boundary': boundary_epoch, 'interval': interval_sec})
+        return [start_epoch for start_epoch, in db_cursor.fetchall()]
+
+    def create_partition(self, db_cursor, start_epoch, end_epoch):
+        """
+        Create the partition for a range. Reports in the range that are in the default partition are moved into
+        the new partition, since Postgres won't create a partition that overlaps rows of the default partition.
+
+        :return: number of reports moved out of the default partition
+        """
+        start_epoch, end_epoch = int(start_epoch), int(end_epoch)
+        partition_name = get_partition_name(start_epoch, self.table_name)
+
+        default_partition_name = self.get_default_partition_name(db_cursor)
+        if default_partition_name is not None:
+            db_cursor.execute('SELECT EXISTS (SELECT 1 FROM {} WHERE report_epoch >= %s AND report_epoch < %s)'.format(
+                default_partition_name), (start_epoch, end_epoch))
+            if not db_cursor.fetchone()[0]:
+                default_partition_name = None
+
+        if default_partition_name is None:
+            logger.info('Creating partition {} for report_epoch {} to {}'.format(partition_name, start_epoch,
+                                                                                end_epoch))
+            db_cursor.execute('CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM ({}) TO ({})'.format(
+                partition_name, self.table_name, start_epoch, end_epoch))
+            return 0
+
+        # Build the partition on its own, move the reports into it and attach it, all in the caller's transaction.
+        # Attaching adds the table's indexes and unique constraint to it.
+        logger.info('Creating partition {} for report_epoch {} to {} from the reports in {}'.format(
+            partition_name, start_epoch, end_epoch, default_partition_name))
+        db_cursor.execute('CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'.format(
+            partition_name, self.table_name))
+        db_cursor.execute('''WITH moved_reports AS (
+                                 DELETE FROM {}
+                                   WHERE report_epoch >= %s AND report_epoch < %s
+                                   RETURNING *)
+                             INSERT INTO {} SELECT * FROM moved_reports'''.format(default_partition_name,
+                                                                                  partition_name),
+                          (start_epoch, end_epoch))
+        num_moved = db_cursor.rowcount
+        db_cursor.execute('ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM ({}) TO ({})'.format(
+            self.table_name, partition_name, start_epoch, end_epoch))
+        logger.info('Moved {} reports from {} into {}'.format(num_moved, default_partition_name, partition_name))
+        return num_moved
+
+    def create_partitions(self, dbconn, db_cursor, partition_ranges):
+        """
+        Create a partition for each range, each committed on its own so one that fails doesn't hold up the others
+
+        :return: number of partitions created
+        """
+        num_created = 0
+        for start_epoch, end_epoch in partition_ranges:
+            try:
+                self.create_partition(db_cursor, start_epoch, end_epoch)
+                dbconn.commit()
+                num_created += 1
+            except:
+                logger.exception('Issue creating partition for report_epoch {} to {}'.format(start_epoch, end_epoch))
+                dbconn.rollback()
+        return num_created
+
+    def create_partitions_for_epochs(self, epochs):
+        """
+        Create the missing partitions that reports with these epochs go in, so that a backfill of old reports (e.g.
+        archive ingest) is loaded into them rather than into the default partition. Call before loading the reports.
+        Does nothing if the table isn't partitioned.
+
+        :param epochs: array (or list) of the reports' epochs
+        :return: number of partitions created
+        """
+        if not len(epochs):
+            return 0
+
+        dbconn = self.get_dbconn()
+        if not dbconn:
+            logger.error('No DB Connection. Partitions for {} reports not created'.format(len(epochs)))
+            return 0
+
+        db_cursor = dbconn.cursor()
+        try:
+            if not self.is_partitioned(db_cursor):
+                dbconn.rollback()
+                return 0
+            missing_ranges = self.get_uncovered_ranges(self.get_partitions(db_cursor),
+                                                       get_partition_starts(epochs, self.interval))
+            dbconn.rollback()
+            num_created = self.create_partitions(dbconn, db_cursor, missing_ranges)
+        finally:
+            db_cursor.close()
+
+        self.partitions_created += num_created
+        return num_created
+
+    def retire_partition(self, db_cursor, partition_name):
+        logger.info('Detaching partition {} past retention of {} days'.format(partition_name, self.retention_days))
+        db_cursor.execute('ALTER TABLE {} DETACH PARTITION {}'.format(self.table_name, partition_name))
+        if self.drop_detached:
+            logger.info('Dropping detached partition {}'.format(partition_name))
+            db_cursor.execute('DROP TABLE {}'.format(partition_name))
+
+    def maintain(self, now=None):
+        """
+        Create the partitions that are missing from now to premake_partitions ahead, move any reports in the default
+        partition out into partitions of their own, and detach (or drop) the partitions past retention. Each change
+        is committed on its own, so one that fails doesn't hold up the others.
+
+        :param now: current epoch, defaults to time.time()
+        :return: tuple of (partitions created, partitions detached)
+        """
+        if now is None:
+            now = time.time()
+        now = int(now)
+
+        dbconn = self.get_dbconn()
+        if not dbconn:
+            logger.error('No DB Connection. Skipping partition maintenance')
+            return 0, 0
+
+        db_cursor = dbconn.cursor()
+        try:
+            if not self.is_partitioned(db_cursor):
+                dbconn.rollback()
+                if not self.warned_not_partitioned:
+                    logger.warning('{} isn\'t partitioned, skipping partition maintenance'.format(self.table_name))
+                    self.warned_not_partitioned = True
+                return 0, 0
+
+            partitions = self.get_partitions(db_cursor)
+            missing_ranges = set(self.get_missing_ranges(partitions, now))
+            missing_ranges.update(self.get_uncovered_ranges(partitions, self.get_default_partition_starts(db_cursor)))
+            dbconn.rollback()
+
+            num_created = self.create_partitions(dbconn, db_cursor, sorted(missing_ranges))
+
+            num_detached = 0
+            if self.retention_days > 0:
+                retention_epoch = now - self.retention_days * seconds_per_day
+                for partition_name, _, end_epoch in partitions:
+                    if end_epoch is None or end_epoch > retention_epoch:
+                        continue
+                    try:
+                        self.retire_partition(db_cursor, partition_name)
+                        dbconn.commit()
+                        num_detached += 1
+                    except:
+                        logger.exception('Issue detaching partition {}'.format(partition_name))
+                        dbconn.rollback()
+        finally:
+            db_cursor.close()
+
+        self.partitions_created += num_created
+        self.partitions_detached += num_detached
+        return num_created, num_detached
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.maintain()
+            except:
+                logger.exception('Issue maintaining the partitions of {}'.format(self.table_name))
+                try:
+                    self.dbconn.rollback()
+                except:
+                    self.dbconn = None
+            self.stop_event.wait(self.maintenance_interval_sec)
+
+    def start(self):
+        self.maintenance_thread = threading.Thread(target=self.run, name='partition-manager')
+        self.maintenance_thread.daemon = True
+        self.maintenance_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.maintenance_thread is not None:
+            self.maintenance_thread.join()
+
+
+def get_partition_manager(partitions_config, db_connect):
+    """
+    Build the partition manager described by the partitions section of config.yml
+
+    :param partitions_config: dict of the partitions settings
+    :param db_connect: callable returning a DB connection (or None if the DB can't be reached)
+    :return: ReportPartitionManager
+    """
+    return ReportPartitionManager(
+        db_connect,
+        interval=partitions_config.get('interval', default_partition_interval),
+        premake_partitions=partitions_config.get('premake', default_premake_partitions),
+        retention_days=partitions_config.get('retentiondays', default_retention_days),
+        drop_detached=partitions_config.get('dropdetached', False),
+        maintenance_interval_sec=partitions_config.get('maintenanceintervalsec', default_maintenance_interval_sec))
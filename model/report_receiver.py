@@ -83,7 +83,7 @@ class RadioReceiver(object):
 
     def distance(self, plane):
         """Returns distance in metres from another object with lat/lon"""
-        return haversine(self.lon, self.lat83, plane.lon, plane.lat)
+        return mathutils.haversine_distance_meters(self.long83, self.lat83, plane.lon, plane.lat)
 
 
 def readReporter(dbconn, key="Home1", printQuery=None):
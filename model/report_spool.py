@@ -0,0 +1,309 @@
+"""
+Durable, append-only on-disk spool for aircraft report rows that couldn't be written to Postgres, either because
+the DB is down or because the writer is falling behind, plus a background replayer that drains the spool into
+aircraftreports once the DB is back.
+
+The spool is a directory of numbered segment files, each holding one JSON-encoded row per line (see
+AircraftReport.to_db_row). The replayer records how far it has got in a checkpoint file. Rows are replayed at least
+once - the (mode_s_hex, report_epoch) unique constraint makes replaying a row twice harmless.
+"""
+
+import json
+import logging
+import os
+import threading
+
+from model import aircraft_report
+
+logger = logging.getLogger(__name__)
+
+segment_file_format = 'segment_{:010d}.spool'
+checkpoint_filename = 'checkpoint.json'
+
+# A segment is closed and a new one started once it reaches this size
+default_segment_max_bytes = 64 * 1024 * 1024
+
+default_replay_batch_size = 10000
+default_replay_interval_sec = 10
+
+
+def fsync_directory(directory):
+    """Make a file create/rename/delete in the directory durable (a no-op on platforms that can't open dirs)"""
+    try:
+        directory_fd = os.open(directory, os.O_RDONLY)
+    except (OSError, AttributeError):
+        return
+    try:
+        os.fsync(directory_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(directory_fd)
+
+
+class ReportSpool(object):
+    """
+    Append-only segmented spool of report rows. Appends are flushed and fsynced before returning, so a row that
+    has been spooled survives a crash. A crash part way through an append leaves at most one partial line at the
+    end of a segment, which the reader skips.
+    """
+
+    def __init__(self, spool_dir, segment_max_bytes=default_segment_max_bytes, fsync=True):
+        self.spool_dir = spool_dir
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync = fsync
+        self.append_lock = threading.Lock()
+
+        os.makedirs(spool_dir, exist_ok=True)
+
+        # Always start a fresh segment, so nothing is ever appended after a partial line left by a crash
+        existing_segment_nums = self.get_segment_nums()
+        self.active_segment_num = (existing_segment_nums[-1] + 1) if existing_segment_nums else 1
+        self.active_segment_file = None
+
+        self.rows_spooled = 0
+
+    def get_segment_path(self, segment_num):
+        return os.path.join(self.spool_dir, segment_file_format.format(segment_num))
+
+    def get_segment_nums(self):
+        """
+        :return: sorted list of the numbers of the segment files in the spool dir
+        """
+        segment_nums = []
+        for filename in os.listdir(self.spool_dir):
+            if filename.startswith('segment_') and filename.endswith('.spool'):
+                segment_nums.append(int(filename[len('segment_'):-len('.spool')]))
+        return sorted(segment_nums)
+
+    def append_rows(self, db_rows):
+        """
+        Durably append rows to the active segment, rotating to a new segment once it's full
+
+        :param db_rows: list of row tuples in aircraft_report.staging_column_names order
+        """
+        if not db_rows:
+            return
+
+        spool_lines = ''.join([json.dumps(db_row, separators=(',', ':')) + '\n' for db_row in db_rows])
+
+        with self.append_lock:
+            if self.active_segment_file is None:
+                self.active_segment_file = open(self.get_segment_path(self.active_segment_num), 'ab')
+                fsync_directory(self.spool_dir)
+
+            self.active_segment_file.write(spool_lines.encode('utf-8'))
+            self.active_segment_file.flush()
+            if self.fsync:
+                os.fsync(self.active_segment_file.fileno())
+            self.rows_spooled += len(db_rows)
+
+            if self.active_segment_file.tell() >= self.segment_max_bytes:
+                self.rotate_segment()
+
+        logger.info('Spooled {} reports to {}'.format(len(db_rows), self.spool_dir))
+
+    def append_reports(self, aircraft_reports_list, radio_receiver):
+        """
+        Spool a list of reports (or a ReportBatch) from one receiver
+        """
+        self.append_rows(aircraft_report.get_db_rows_for_reports(aircraft_reports_list, radio_receiver))
+
+    def rotate_segment(self):
+        """Close the active segment so the replayer can finish it off and delete it. Call with append_lock held."""
+        if self.active_segment_file is not None:
+            self.active_segment_file.close()
+            self.active_segment_file = None
+        self.active_segment_num += 1
+
+    def close(self):
+        with self.append_lock:
+            if self.active_segment_file is not None:
+                self.active_segment_file.close()
+                self.active_segment_file = None
+
+    def is_active_segment(self, segment_num):
+        with self.append_lock:
+            return segment_num >= self.active_segment_num
+
+    def has_later_segment(self, segment_num):
+        """
+        Whether a later segment exists, which means nothing more will be appended to this one. Unlike
+        is_active_segment this also works when the spool is being appended to by another process.
+        """
+        return any(spool_segment_num > segment_num for spool_segment_num in self.get_segment_nums())
+
+    def read_checkpoint(self, checkpoint_name=checkpoint_filename):
+        """
+        :param checkpoint_name: checkpoint file name, so that several readers can each keep their own position
+        :return: tuple of (segment number, byte offset) of the next row to replay
+        """
+        checkpoint_path = os.path.join(self.spool_dir, checkpoint_name)
+        if not os.path.exists(checkpoint_path):
+            return 0, 0
+        with open(checkpoint_path, 'r') as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        return checkpoint['segment'], checkpoint['offset']
+
+    def write_checkpoint(self, segment_num, offset, checkpoint_name=checkpoint_filename):
+        """Atomically replace the checkpoint file"""
+        checkpoint_path = os.path.join(self.spool_dir, checkpoint_name)
+        temp_checkpoint_path = checkpoint_path + '.tmp'
+        with open(temp_checkpoint_path, 'w') as checkpoint_file:
+            json.dump({'segment': segment_num, 'offset': offset}, checkpoint_file)
+            checkpoint_file.flush()
+            if self.fsync:
+                os.fsync(checkpoint_file.fileno())
+        os.replace(temp_checkpoint_path, checkpoint_path)
+        if self.fsync:
+            fsync_directory(self.spool_dir)
+
+    def read_rows(self, segment_num, offset, max_rows):
+        """
+        Read up to max_rows complete rows from a segment, starting at a byte offset
+
+        :return: tuple of (list of rows, byte offset after the last complete row read, bool whether the end of the
+                 segment's complete rows was reached)
+        """
+        db_rows = []
+        with open(self.get_segment_path(segment_num), 'rb') as segment_file:
+            segment_file.seek(offset)
+            while len(db_rows) < max_rows:
+                spool_line = segment_file.readline()
+                if not spool_line.endswith(b'\n'):
+                    # Either the end of the segment, or a partial line still being written (or left by a crash)
+                    return db_rows, offset, True
+                offset += len(spool_line)
+                try:
+                    db_rows.append(json.loads(spool_line.decode('utf-8')))
+                except ValueError:
+                    logger.error('Skipping corrupt spool line in segment {} at offset {}'.format(segment_num,
+                                                                                               offset))
+        return db_rows, offset, False
+
+    def get_backlog_bytes(self):
+        """
+        :return: approximate number of spooled bytes that haven't been replayed yet
+        """
+        checkpoint_segment_num, checkpoint_offset = self.read_checkpoint()
+        backlog_bytes = 0
+        for segment_num in self.get_segment_nums():
+            if segment_num >= checkpoint_segment_num:
+                backlog_bytes += os.path.getsize(self.get_segment_path(segment_num))
+                if segment_num == checkpoint_segment_num:
+                    backlog_bytes -= checkpoint_offset
+        return backlog_bytes
+
+
+class SpoolReplayer(object):
+    """
+    Background thread that drains a ReportSpool into aircraftreports in bulk, checkpointing after every committed
+    batch and deleting segments once they are fully replayed
+    """
+
+    def __init__(self, report_spool, db_connect, batch_size=default_replay_batch_size,
+                 replay_interval_sec=default_replay_interval_sec, itinerary_tracker=None):
+        """
+        :param report_spool: ReportSpool to drain
+        :param db_connect: callable returning a new DB connection (or None if the DB can't be reached)
+        :param batch_size: rows per COPY + merge transaction
+        :param replay_interval_sec: seconds to wait between replay attempts while the spool is empty or the DB down
+        :param itinerary_tracker: optional ItineraryTracker that stamps each replayed row's itinerary_id
+        """
+        self.report_spool = report_spool
+        self.itinerary_tracker = itinerary_tracker
+        self.db_connect = db_connect
+        self.batch_size = batch_size
+        self.replay_interval_sec = replay_interval_sec
+        self.dbconn = None
+        self.stop_event = threading.Event()
+        self.replay_thread = None
+
+        self.rows_replayed = 0
+        self.rows_inserted = 0
+
+    def get_dbconn(self):
+        if self.dbconn is None or self.dbconn.closed:
+            self.dbconn = self.db_connect()
+        return self.dbconn
+
+    def replay_available(self):
+        """
+        Replay everything that's in the spool right now
+
+        :return: number of rows replayed
+        """
+        num_replayed = 0
+        segment_num, offset = self.report_spool.read_checkpoint()
+
+        for spool_segment_num in self.report_spool.get_segment_nums():
+            if spool_segment_num < segment_num:
+                continue
+            if spool_segment_num > segment_num:
+                segment_num, offset = spool_segment_num, 0
+
+            while not self.stop_event.is_set():
+                # Check before reading, so rows appended after the read are never mistaken for a finished segment
+                segment_is_active = self.report_spool.is_active_segment(segment_num)
+                db_rows, next_offset, end_of_segment = self.report_spool.read_rows(segment_num, offset,
+                                                                                   self.batch_size)
+                if db_rows:
+                    dbconn = self.get_dbconn()
+                    if not dbconn:
+                        return num_replayed
+                    try:
+                        num_inserted, _ = aircraft_report.merge_db_rows_into_aircraftreports(
+                            dbconn, db_rows, itinerary_tracker=self.itinerary_tracker)
+                        dbconn.commit()
+                    except:
+                        logger.exception('Issue replaying spooled reports into DB, will retry')
+                        try:
+                            dbconn.rollback()
+                        except:
+                            self.dbconn = None
+                        return num_replayed
+
+                    offset = next_offset
+                    self.report_spool.write_checkpoint(segment_num, offset)
+                    num_replayed += len(db_rows)
+                    self.rows_replayed += len(db_rows)
+                    self.rows_inserted += num_inserted
+
+                if not end_of_segment:
+                    continue
+
+                if segment_is_active:
+                    # Caught up with the writer
+                    return num_replayed
+
+                # Finished with this segment for good - anything after the last complete row is a crash leftover
+                os.remove(self.report_spool.get_segment_path(segment_num))
+                self.report_spool.write_checkpoint(segment_num + 1, 0)
+                segment_num, offset = segment_num + 1, 0
+                break
+
+        if num_replayed:
+            logger.info('Replayed {} spooled reports into DB ({} total, {} inserted)'.format(
+                num_replayed, self.rows_replayed, self.rows_inserted))
+
+        return num_replayed
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                num_replayed = self.replay_available()
+            except:
+                logger.exception('Issue replaying report spool')
+                num_replayed = 0
+            if not num_replayed:
+                self.stop_event.wait(self.replay_interval_sec)
+
+    def start(self):
+        self.replay_thread = threading.Thread(target=self.run, name='spool-replayer')
+        self.replay_thread.daemon = True
+        self.replay_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.replay_thread is not None:
+            self.replay_thread.join()
@@ -0,0 +1,246 @@
+"""
+Streaming ingest from dump1090's SBS-1 (BaseStation) output, port 30003 by default. Instead of polling
+aircraft.json snapshots, every message is decoded as it arrives and merged into per-aircraft state, so each
+position dump1090 decodes becomes a report, with the latest ident, altitude and velocity merged in.
+
+SBS-1 messages are CSV lines like:
+MSG,3,1,1,4CA2D6,1,2017/06/01,12:00:00.000,2017/06/01,12:00:00.000,,37000,,,51.4500,-0.9700,,,0,0,0,0
+"""
+
+import logging
+import socket
+import time
+from urllib.parse import urlsplit
+
+from model import aircraft_report
+from model import aircraft_state_cache
+from model import receiver_poller
+
+logger = logging.getLogger(__name__)
+
+default_sbs_port = 30003
+
+# Seconds of stream collected into each write
+default_flush_interval_sec = 1.0
+
+recv_size = 65536
+
+# A line longer than this means we're not reading an SBS stream, so the buffer is thrown away
+max_line_bytes = 4096
+
+# Field index -> (state key, parser) of the CSV fields merged into the aircraft state. Empty fields are skipped,
+# so each message type only updates the fields it carries.
+sbs_hex_ident_index = 4
+sbs_field_parsers = {10: ('flight', lambda value: aircraft_report.flight_format.format(value)),
+                     11: ('altitude', float),
+                     12: ('speed', float),
+                     13: ('track', float),
+                     14: ('lat', float),
+                     15: ('lon', float),
+                     16: ('vert_rate', float),
+                     17: ('squawk', str),
+                     # dump1090 sends -1 for true
+                     21: ('is_ground', lambda value: value != '0')}
+sbs_num_fields = 22
+
+
+def parse_sbs_line(sbs_line):
+    """
+    :param sbs_line: one SBS-1 message, as text without the line ending
+    :return: tuple of (lowercase hex ident, dict of the fields the message carries), or None if it isn't an
+             aircraft MSG line
+    """
+    fields = sbs_line.split(',')
+    if len(fields) < sbs_num_fields or fields[0] != 'MSG' or not fields[sbs_hex_ident_index]:
+        return None
+
+    # dump1090's aircraft.json uses lowercase hex, keep the two sources consistent
+    mode_s_hex = fields[sbs_hex_ident_index].strip().lower()
+
+    message_values = {}
+    for field_index, (state_key, parser) in sbs_field_parsers.items():
+        field_value = fields[field_index].strip()
+        if field_value:
+            try:
+                message_values[state_key] = parser(field_value)
+            except ValueError:
+                logger.debug('Unparseable SBS field {} in: {}'.format(field_index, sbs_line))
+
+    return mode_s_hex, message_values
+
+
+class SbsAircraftTracker(object):
+    """
+    Merges the partial SBS messages (ident, position, velocity, squawk...) of each aircraft into one state, and
+    turns every new position into a report
+    """
+
+    def __init__(self, ttl_sec=aircraft_state_cache.default_state_ttl_sec):
+        self.ttl_sec = ttl_sec
+        # mode_s_hex -> dict of the latest value of each field, plus messages and last_seen
+        self.aircraft_states = {}
+
+        self.positions_dropped = 0
+
+    def __len__(self):
+        return len(self.aircraft_states)
+
+    def update(self, mode_s_hex, message_values, now):
+        """
+        :param mode_s_hex: the aircraft's hex ident
+        :param message_values: dict of the fields one message carries, see parse_sbs_line
+        :param now: epoch the message was received
+        :return: CompactAircraftReport if the message carried a position, otherwise None
+        """
+        aircraft_state = self.aircraft_states.get(mode_s_hex)
+        if aircraft_state is None:
+            aircraft_state = self.aircraft_states[mode_s_hex] = {'messages': 0}
+
+        aircraft_state.update(message_values)
+        aircraft_state['messages'] += 1
+        aircraft_state['last_seen'] = now
+
+        if 'lat' not in message_values or 'lon' not in message_values:
+            return None
+
+        # Same as aircraft.json, aircraft are only reported once their velocity is known
+        if 'speed' not in aircraft_state or 'track' not in aircraft_state:
+            self.positions_dropped += 1
+            return None
+
+        return aircraft_report.CompactAircraftReport.from_sbs(mode_s_hex, aircraft_state, report_time=now)
+
+    def evict_stale(self, now):
+        stale_hexes = [mode_s_hex for mode_s_hex, aircraft_state in self.aircraft_states.items()
+                       if now - aircraft_state['last_seen'] > self.ttl_sec]
+        for mode_s_hex in stale_hexes:
+            del self.aircraft_states[mode_s_hex]
+
+
+class SbsStreamReceiver(receiver_poller.ReceiverPoller):
+    """
+    ReceiverPoller that keeps a TCP connection open to a receiver's SBS-1 port instead of polling aircraft.json.
+    Each poll reads flush_interval_sec of the stream and writes the positions it carried. A dropped connection
+    counts as a failed poll, so it's reopened after the usual backoff.
+    """
+
+    def __init__(self, radio_receiver, dbconn, max_samples, host, port=default_sbs_port,
+                 flush_interval_sec=default_flush_interval_sec, as_batch=False, **kwargs):
+        """
+        :param host: receiver hostname
+        :param port: receiver SBS-1 port
+        :param flush_interval_sec: seconds of stream collected into each write
+        :param as_batch: write each flush as one columnar ReportBatch instead of a list of reports
+        Other args are the same as ReceiverPoller
+        """
+        super(SbsStreamReceiver, self).__init__(radio_receiver=radio_receiver,
+                                                dbconn=dbconn,
+                                                poll_interval_sec=0,
+                                                max_samples=max_samples,
+                                                **kwargs)
+        self.host = host
+        self.port = port
+        self.flush_interval_sec = flush_interval_sec
+        self.as_batch = as_batch
+        self.aircraft_tracker = SbsAircraftTracker(ttl_sec=self.state_cache.ttl_sec)
+
+        self.sbs_socket = None
+        self.line_buffer = b''
+
+        self.messages_decoded = 0
+
+    def build_snapshot_client(self):
+        # The tcp:// URL is read with connect, not fetched over HTTP
+        return None
+
+    def connect(self):
+        logger.info('Connecting to SBS stream of receiver {} at {}:{}'.format(self.radio_receiver.name, self.host,
+                                                                             self.port))
+        self.sbs_socket = socket.create_connection((self.host, self.port), timeout=self.request_timeout_sec)
+        self.line_buffer = b''
+
+    def close(self):
+        if self.sbs_socket is not None:
+            try:
+                self.sbs_socket.close()
+            except OSError:
+                pass
+            self.sbs_socket = None
+
+    def read_reports(self, duration_sec):
+        """
+        Decode the stream for duration_sec
+
+        :return: list of CompactAircraftReports, one per position received
+        :raises ConnectionError: if the receiver closes the connection
+        """
+        reports_list = []
+        deadline = time.time() + duration_sec
+
+        while True:
+            remaining_sec = deadline - time.time()
+            if remaining_sec <= 0:
+                return reports_list
+
+            self.sbs_socket.settimeout(remaining_sec)
+            try:
+                stream_bytes = self.sbs_socket.recv(recv_size)
+            except socket.timeout:
+                return reports_list
+            if not stream_bytes:
+                raise ConnectionError('Receiver {} closed the SBS stream'.format(self.radio_receiver.name))
+
+            received_time = time.time()
+            stream_lines = (self.line_buffer + stream_bytes).split(b'\n')
+            # The last element is the start of a line that hasn't fully arrived yet
+            self.line_buffer = stream_lines.pop()
+            if len(self.line_buffer) > max_line_bytes:
+                logger.warning('Discarding {} bytes of unterminated SBS stream'.format(len(self.line_buffer)))
+                self.line_buffer = b''
+
+            for stream_line in stream_lines:
+                sbs_message = parse_sbs_line(stream_line.decode('ascii', 'replace').rstrip('\r'))
+                if sbs_message is None:
+                    continue
+                self.messages_decoded += 1
+                aircraft = self.aircraft_tracker.update(sbs_message[0], sbs_message[1], received_time)
+                if aircraft is not None:
+                    reports_list.append(aircraft)
+
+    def poll_once(self):
+        """
+        Read flush_interval_sec of the stream, connecting first if needed, and write the positions it carried
+
+        :return: number of aircraft reports written
+        """
+        if self.sbs_socket is None:
+            self.connect()
+
+        try:
+            reports_list = self.read_reports(self.flush_interval_sec)
+        except:
+            self.close()
+            raise
+
+        self.aircraft_tracker.evict_stale(now=time.time())
+
+        if reports_list:
+            if self.as_batch:
+                # Imported here since report_batch imports aircraft_report
+                from model import report_batch
+                self.write_reports(report_batch.ReportBatch.from_reports(reports_list))
+            else:
+                self.write_reports(reports_list)
+
+        return len(reports_list)
+
+
+def parse_sbs_url(url_string):
+    """
+    :param url_string: receiver URL like tcp://raspi1:30003
+    :return: tuple of (host, port), or None if it isn't a tcp:// URL
+    """
+    split_url = urlsplit(url_string)
+    if split_url.scheme != 'tcp':
+        return None
+    return split_url.hostname, split_url.port or default_sbs_port
@@ -0,0 +1,108 @@
+"""
+HTTP client for one receiver's aircraft.json, which keeps its connection alive between polls and avoids
+downloading or parsing a snapshot that hasn't changed since the last poll
+"""
+
+import logging
+import re
+import time
+
+import requests
+
+from model import aircraft_report
+
+logger = logging.getLogger(__name__)
+
+# Snapshot timestamp - "now" at the top of a dump1090 aircraft.json, "stm" (msec) at the end of a VRS acList
+snapshot_epoch_regex = re.compile(br'"(?:now|stm)"\s*:\s*(-?[0-9.eE+]+)')
+
+
+def get_snapshot_epoch(json_bytes):
+    """
+    Find the snapshot timestamp without parsing the whole document
+
+    :param json_bytes: raw aircraft JSON
+    :return: the timestamp as it appears in the document, or None if there isn't one
+    """
+    snapshot_epoch_match = snapshot_epoch_regex.search(json_bytes)
+    if snapshot_epoch_match is None:
+        return None
+    return snapshot_epoch_match.group(1)
+
+
+class SnapshotClient(object):
+    """
+    Fetches one receiver's aircraft.json over a keep-alive requests.Session. Sends If-None-Match /
+    If-Modified-Since when the server gave an ETag / Last-Modified, and treats a snapshot whose timestamp hasn't
+    moved on as unchanged, so that it's never parsed twice.
+    """
+
+    def __init__(self, url, timeout=None, url_params=None):
+        """
+        :param url: string containing the receiver's URL (e.g. http://piaware1/dump1090-fa/data/aircraft.json)
+        :param timeout: seconds to wait for the receiver to respond before raising (None waits forever)
+        :param url_params: optional query string params
+        """
+        self.url = url
+        self.timeout = timeout
+        self.url_params = url_params
+        self.session = requests.Session()
+
+        self.etag = None
+        self.last_modified = None
+        self.last_snapshot_epoch = None
+
+        # Seconds the receiver took to answer the last request
+        self.last_fetch_latency_sec = None
+
+        self.snapshots_fetched = 0
+        self.snapshots_not_modified = 0
+        self.snapshots_unchanged = 0
+
+    def fetch_snapshot(self):
+        """
+        :return: tuple of (raw JSON bytes, epoch when it was pulled), or None if the snapshot hasn't changed
+        :raises requests.RequestException: if the request fails or the receiver responds with an error
+        """
+        request_headers = {}
+        if self.etag:
+            request_headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            request_headers['If-Modified-Since'] = self.last_modified
+
+        report_pulled_time = time.time()
+        response = self.session.get(self.url, params=self.url_params, headers=request_headers,
+                                    timeout=self.timeout)
+        self.last_fetch_latency_sec = time.time() - report_pulled_time
+
+        if response.status_code == requests.codes.not_modified:
+            self.snapshots_not_modified += 1
+            return None
+        response.raise_for_status()
+
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+
+        json_bytes = response.content
+        snapshot_epoch = get_snapshot_epoch(json_bytes)
+        if snapshot_epoch is not None and snapshot_epoch == self.last_snapshot_epoch:
+            self.snapshots_unchanged += 1
+            return None
+        self.last_snapshot_epoch = snapshot_epoch
+
+        self.snapshots_fetched += 1
+        return json_bytes, report_pulled_time
+
+    def get_aircraft_data(self, as_batch=False):
+        """
+        :param as_batch: return the snapshot as one columnar ReportBatch instead of a list
+        :return: list of AircraftReport objects (or a ReportBatch), or None if the snapshot hasn't changed
+        """
+        snapshot = self.fetch_snapshot()
+        if snapshot is None:
+            return None
+        json_bytes, report_pulled_time = snapshot
+        return aircraft_report.parse_aircraft_json(json_bytes, report_pulled_time, as_batch=as_batch)
+
+    def close(self):
+        self.session.close()
@@ -2,9 +2,12 @@ SELECT *
 FROM find_pattern_num('2017_10_25_19_59_26_ADAFB5');
 -- A8D33A, ADAFB5
 
+-- aircraftreports is partitioned on report_epoch, so bounding report_epoch (here the 2017-10-25 UTC day) means only
+-- the partitions covering that range are read. Drop the bounds to search every partition.
 SELECT *
 FROM aircraftreports
 WHERE mode_s_hex = 'ADAFB5'
+      AND report_epoch >= 1508889600 AND report_epoch < 1508976000
 ORDER BY report_epoch, 2;
 
 SELECT COUNT(*)
@@ -12,11 +15,13 @@ FROM aircraftreports;
 
 SELECT COUNT(*)
 FROM aircraftreports
-WHERE altitude < 1000;
+WHERE altitude < 1000
+      AND report_epoch >= 1508889600 AND report_epoch < 1508976000;
 
 SELECT COUNT(*)
 FROM aircraftreports
-WHERE altitude > 40000;
+WHERE altitude > 40000
+      AND report_epoch >= 1508889600 AND report_epoch < 1508976000;
 
 SELECT COUNT(*)
 FROM aircraftreports
@@ -28,7 +33,8 @@ WHERE aircraftreports.report_location
       &&
       ST_MakeEnvelope(
           40, -40,
-          80, 40);
+          80, 40)
+      AND report_epoch >= 1508889600 AND report_epoch < 1508976000;
 
 
 SELECT
@@ -39,5 +45,14 @@ SELECT
     ORDER BY report_epoch )   AS rownum
 FROM adsb.public.aircraftreports
 WHERE mode_s_hex = 'ADAFB5'
+      AND report_epoch >= 1508889600 AND report_epoch < 1508976000
 ORDER BY report_epoch;
 
+-- Reports per partition
+SELECT
+  tableoid :: REGCLASS AS partition_name,
+  COUNT(*)
+FROM aircraftreports
+GROUP BY 1
+ORDER BY 1;
+
@@ -0,0 +1,55 @@
+--
+-- Converts an existing, unpartitioned aircraftreports into the report_epoch range partitioned table of
+-- postgres_setup.sql (Postgres 11+). The old table is kept as the partition holding every report before the
+-- cutover epoch, so no rows are copied. Pick a cutover at a UTC midnight (a Monday for weekly partitions) after the
+-- newest report, then run with ingest stopped:
+--
+--   psql -d adsb -v cutover=1509062400 -f partition_aircraftreports.sql
+--
+-- and create the partitions from the cutover onwards with `python main.py partitions` before restarting ingest.
+--
+
+BEGIN;
+
+ALTER TABLE aircraftreports
+  RENAME TO aircraftreports_legacy;
+ALTER INDEX mode_s_hex_idx
+  RENAME TO aircraftreports_legacy_mode_s_hex_idx;
+ALTER INDEX pr_epoch
+  RENAME TO aircraftreports_legacy_pr_epoch;
+ALTER INDEX rep_loc
+  RENAME TO aircraftreports_legacy_rep_loc;
+
+CREATE TABLE aircraftreports (
+  LIKE aircraftreports_legacy INCLUDING DEFAULTS,
+  UNIQUE (mode_s_hex, report_epoch)
+) PARTITION BY RANGE (report_epoch);
+
+ALTER TABLE aircraftreports
+  OWNER TO postgres;
+
+COMMENT ON TABLE aircraftreports IS 'Reports of a plane''s position.';
+
+CREATE TABLE aircraftreports_default PARTITION OF aircraftreports DEFAULT;
+
+CREATE INDEX mode_s_hex_idx
+  ON aircraftreports USING BTREE (mode_s_hex);
+
+CREATE INDEX pr_epoch
+  ON aircraftreports USING BTREE (report_epoch);
+
+CREATE INDEX rep_loc
+  ON aircraftreports USING GIST (report_location);
+
+CREATE INDEX rep_no_itin
+  ON aircraftreports USING BTREE (mode_s_hex, report_epoch)
+  WHERE itinerary_id IS NULL;
+
+-- Scans the old table to check every row is before the cutover. Rows without a report_epoch don't fit any range
+-- partition, and have to be deleted (or moved to aircraftreports_default) first.
+ALTER TABLE aircraftreports
+  ATTACH PARTITION aircraftreports_legacy FOR VALUES FROM (MINVALUE) TO (:cutover);
+
+GRANT ALL ON TABLE aircraftreports TO postgres;
+
+COMMIT;
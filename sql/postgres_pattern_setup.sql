@@ -13,12 +13,15 @@ ALTER TABLE aircraftpatterns
   OWNER TO postgres;
 
 
-CREATE INDEX mode_s_hex_idx
+CREATE INDEX pat_mode_s_hex_idx
   ON aircraftpatterns USING BTREE (mode_s_hex);
 
-CREATE INDEX pr_epoch
+CREATE INDEX pat_epoch
   ON aircraftpatterns USING BTREE (report_epoch);
 
+CREATE INDEX pat_itinerary_idx
+  ON aircraftpatterns USING BTREE (itinerary_id);
+
 CREATE INDEX pat_cent_loc
   ON aircraftpatterns USING GIST (pattern_centroid);
 
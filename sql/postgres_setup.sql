@@ -32,7 +32,16 @@ CREATE TABLE aircraftreports (
   is_anon         BOOLEAN,
   itinerary_id    TEXT,
   UNIQUE          (mode_s_hex, report_epoch)
-);
+) PARTITION BY RANGE (report_epoch);
+
+--
+-- Daily (or weekly) partitions of aircraftreports, e.g. aircraftreports_p20171025, are created ahead of time by
+-- model/report_partitions.py (in the background while partitions.enabled, the default, or `python main.py partitions`).
+-- Archive ingest creates the partitions of the days it loads. Anything outside of every partition lands in the
+-- default partition, and is moved out into partitions of its own by the next maintenance pass.
+--
+
+CREATE TABLE aircraftreports_default PARTITION OF aircraftreports DEFAULT;
 
 
 ALTER TABLE aircraftreports
@@ -140,5 +149,30 @@ CREATE INDEX pr_epoch
 CREATE INDEX rep_loc
   ON aircraftreports USING GIST (report_location);
 
+--
+-- Name: rep_no_itin; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX rep_no_itin
+  ON aircraftreports USING BTREE (mode_s_hex, report_epoch)
+  WHERE itinerary_id IS NULL;
+
 GRANT ALL ON TABLE aircraftreports TO postgres;
 -- GRANT SELECT, INSERT, DELETE, UPDATE ON TABLE aircraftreports TO postgres;
+
+--
+-- Name: batchwatermarks; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE batchwatermarks (
+  job_name        TEXT PRIMARY KEY,
+  watermark_epoch INTEGER NOT NULL,
+  updated_epoch   INTEGER NOT NULL
+);
+
+ALTER TABLE batchwatermarks
+  OWNER TO postgres;
+
+COMMENT ON TABLE batchwatermarks IS 'Epoch each incremental batch job (e.g. itinerary assignment) has processed up to.';
+
+GRANT ALL ON TABLE batchwatermarks TO postgres;
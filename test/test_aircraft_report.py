@@ -0,0 +1,42 @@
+"""
+Tests for the report epoch of live dump1090 reports in model.aircraft_report and model.report_batch
+
+Run from the repo root:
+    python -m unittest test.test_aircraft_report
+"""
+
+import unittest
+
+from model import aircraft_report
+from model import report_batch
+
+# One aircraft of an aircraft.json snapshot taken at snapshot_epoch, its last position 2.5 sec before that
+snapshot_epoch = 1496318400.0
+dump1090_aircraft = {'hex': '4ca2d6', 'lat': 51.45, 'lon': -0.97, 'altitude': 37000, 'speed': 420, 'track': 90,
+                     'flight': 'RYR1234 ', 'seen': 0.4, 'seen_pos': 2.5, 'messages': 120}
+
+
+class Dump1090ReportEpochTest(unittest.TestCase):
+
+    def test_epoch_of_last_position(self):
+        aircraft = aircraft_report.CompactAircraftReport.from_dump1090(dump1090_aircraft,
+                                                                       snapshot_epoch=snapshot_epoch)
+        self.assertEqual(aircraft.time, snapshot_epoch - 2.5)
+
+    def test_seen_without_seen_pos(self):
+        aircraft_dict = dict(dump1090_aircraft)
+        del aircraft_dict['seen_pos']
+        aircraft = aircraft_report.CompactAircraftReport.from_dump1090(aircraft_dict, snapshot_epoch=snapshot_epoch)
+        self.assertEqual(aircraft.time, snapshot_epoch - 0.4)
+
+    def test_no_snapshot_epoch(self):
+        aircraft = aircraft_report.CompactAircraftReport.from_dump1090(dump1090_aircraft)
+        self.assertEqual(aircraft.time, 0)
+
+    def test_report_batch_matches(self):
+        batch = report_batch.ReportBatch.from_dump1090([dump1090_aircraft], snapshot_epoch=snapshot_epoch)
+        self.assertEqual(batch.epoch.tolist(), [snapshot_epoch - 2.5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+"""
+Tests for model.sbs_stream, replaying captured dump1090 SBS-1 output from a local fake receiver.
+
+Run from the repo root:
+    python -m unittest test.test_sbs_stream
+"""
+
+import socketserver
+import threading
+import time
+import unittest
+
+from model import report_receiver
+from model import sbs_stream
+
+# Captured from dump1090 --net port 30003: ident, velocity, then position messages of one aircraft, with other
+# message types mixed in
+ident_line = 'MSG,1,1,1,4CA2D6,1,2017/06/01,12:00:00.000,2017/06/01,12:00:00.000,RYR1234 ,,,,,,,,,,,0'
+velocity_line = 'MSG,4,1,1,4CA2D6,1,2017/06/01,12:00:00.100,2017/06/01,12:00:00.100,,,420,90,,,-64,,,,,0'
+position_line = 'MSG,3,1,1,4CA2D6,1,2017/06/01,12:00:00.200,2017/06/01,12:00:00.200,,37000,,,51.4500,-0.9700,,,0,0,0,0'
+second_position_line = ('MSG,3,1,1,4CA2D6,1,2017/06/01,12:00:00.700,2017/06/01,12:00:00.700,,37025,,,51.4510,-0.9680,'
+                        ',,0,0,0,0')
+squawk_line = 'MSG,6,1,1,4CA2D6,1,2017/06/01,12:00:00.300,2017/06/01,12:00:00.300,,,,,,,,7000,0,0,0,0'
+other_position_line = ('MSG,3,1,1,40621D,1,2017/06/01,12:00:00.400,2017/06/01,12:00:00.400,,12000,,,51.2000,'
+                       '-0.5000,,,0,0,0,0')
+status_line = 'STA,,5,179,400AE7,10103,2017/06/01,12:00:00.500,2017/06/01,12:00:00.500,RM'
+
+captured_stream = '\r\n'.join([ident_line, status_line, velocity_line, position_line, squawk_line,
+                               other_position_line, second_position_line]) + '\r\n'
+
+
+def split_mid_line(stream_text, chunk_size):
+    """
+    :return: list of the stream's bytes in chunk_size pieces, so most messages arrive in two reads
+    """
+    stream_bytes = stream_text.encode('ascii')
+    return [stream_bytes[chunk_start:chunk_start + chunk_size]
+            for chunk_start in range(0, len(stream_bytes), chunk_size)]
+
+
+class FakeSbsServer(socketserver.ThreadingTCPServer):
+    """
+    Local stand-in for a receiver's SBS port. Each connection is sent the chunks of the next session, with a pause
+    between them, and is then held open until close_event is set. A number in a session is an extra pause, in
+    seconds.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, sessions, chunk_pause_sec=0.005):
+        """
+        :param sessions: list of lists of byte chunks (or pauses), one list per connection
+        """
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), FakeSbsHandler)
+        self.sessions = list(sessions)
+        self.chunk_pause_sec = chunk_pause_sec
+        self.close_event = threading.Event()
+        self.connections = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class FakeSbsHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        self.server.connections += 1
+        session_chunks = self.server.sessions.pop(0) if self.server.sessions else []
+        for stream_chunk in session_chunks:
+            if isinstance(stream_chunk, float):
+                time.sleep(stream_chunk)
+                continue
+            self.request.sendall(stream_chunk)
+            time.sleep(self.server.chunk_pause_sec)
+        self.server.close_event.wait(5)
+        self.server.close_event.clear()
+
+
+class ParseSbsLineTest(unittest.TestCase):
+
+    def test_ident(self):
+        mode_s_hex, message_values = sbs_stream.parse_sbs_line(ident_line)
+        self.assertEqual(mode_s_hex, '4ca2d6')
+        self.assertEqual(message_values, {'flight': 'RYR1234 ', 'is_ground': False})
+
+    def test_velocity(self):
+        mode_s_hex, message_values = sbs_stream.parse_sbs_line(velocity_line)
+        self.assertEqual(message_values, {'speed': 420.0, 'track': 90.0, 'vert_rate': -64.0, 'is_ground': False})
+
+    def test_position(self):
+        mode_s_hex, message_values = sbs_stream.parse_sbs_line(position_line)
+        self.assertEqual(message_values, {'altitude': 37000.0, 'lat': 51.45, 'lon': -0.97, 'is_ground': False})
+
+    def test_ground_flag(self):
+        on_ground_line = position_line[:-1] + '-1'
+        self.assertTrue(sbs_stream.parse_sbs_line(on_ground_line)[1]['is_ground'])
+
+    def test_not_an_aircraft_message(self):
+        self.assertIsNone(sbs_stream.parse_sbs_line(status_line))
+        self.assertIsNone(sbs_stream.parse_sbs_line(''))
+        self.assertIsNone(sbs_stream.parse_sbs_line(position_line[:40]))
+        self.assertIsNone(sbs_stream.parse_sbs_line(position_line.replace('4CA2D6', '')))
+
+    def test_unparseable_field_skipped(self):
+        mode_s_hex, message_values = sbs_stream.parse_sbs_line(position_line.replace('37000', 'x'))
+        self.assertNotIn('altitude', message_values)
+        self.assertEqual(message_values['lat'], 51.45)
+
+
+class SbsAircraftTrackerTest(unittest.TestCase):
+
+    def update(self, aircraft_tracker, sbs_line, now):
+        return aircraft_tracker.update(*sbs_stream.parse_sbs_line(sbs_line), now=now)
+
+    def test_position_before_velocity_dropped(self):
+        aircraft_tracker = sbs_stream.SbsAircraftTracker()
+        self.assertIsNone(self.update(aircraft_tracker, position_line, 100.0))
+        self.assertEqual(aircraft_tracker.positions_dropped, 1)
+
+    def test_merges_ident_velocity_and_position(self):
+        aircraft_tracker = sbs_stream.SbsAircraftTracker()
+        self.assertIsNone(self.update(aircraft_tracker, ident_line, 100.0))
+        self.assertIsNone(self.update(aircraft_tracker, velocity_line, 100.1))
+        aircraft = self.update(aircraft_tracker, position_line, 100.2)
+
+        self.assertEqual(aircraft.mode_s_hex, '4ca2d6')
+        self.assertEqual(aircraft.flight, 'RYR1234 ')
+        self.assertEqual(aircraft.time, 100.2)
+        self.assertEqual((aircraft.lat, aircraft.lon), (51.45, -0.97))
+        self.assertEqual(aircraft.track, 90.0)
+        self.assertEqual(aircraft.messages, 3)
+
+    def test_later_messages_update_state(self):
+        aircraft_tracker = sbs_stream.SbsAircraftTracker()
+        for sbs_line, now in [(velocity_line, 100.0), (position_line, 100.2), (squawk_line, 100.3)]:
+            self.update(aircraft_tracker, sbs_line, now)
+        aircraft = self.update(aircraft_tracker, second_position_line, 100.7)
+
+        self.assertEqual(aircraft.squawk, '7000')
+        self.assertEqual((aircraft.lat, aircraft.lon), (51.451, -0.968))
+        self.assertEqual(len(aircraft_tracker), 1)
+
+    def test_evict_stale(self):
+        aircraft_tracker = sbs_stream.SbsAircraftTracker(ttl_sec=10)
+        self.update(aircraft_tracker, velocity_line, 100.0)
+        self.update(aircraft_tracker, other_position_line, 105.0)
+        aircraft_tracker.evict_stale(now=112.0)
+        self.assertEqual(list(aircraft_tracker.aircraft_states), ['40621d'])
+
+
+class FakeReportProducer(object):
+
+    def __init__(self):
+        self.reports_lists = []
+
+    def append_reports(self, reports_list, radio_receiver):
+        self.reports_lists.append(reports_list)
+
+
+class SbsStreamReceiverTest(unittest.TestCase):
+
+    def setUp(self):
+        # The stream in 23 byte pieces, so every line is split across reads, then the same positions again
+        # after a reconnect
+        self.fake_server = FakeSbsServer([split_mid_line(captured_stream, 23),
+                                          split_mid_line(velocity_line + '\n' + second_position_line + '\n', 50)])
+        threading.Thread(target=self.fake_server.serve_forever, daemon=True).start()
+
+        radio_receiver = report_receiver.RadioReceiver(name='sbstest', type='dump1090', lat83=51.0, long83=-0.9,
+                                                       data_access_url='tcp://127.0.0.1:{}'.format(
+                                                           self.fake_server.port),
+                                                       location='')
+        self.report_producer = FakeReportProducer()
+        self.sbs_receiver = sbs_stream.SbsStreamReceiver(radio_receiver, dbconn=None, max_samples=0,
+                                                         host='127.0.0.1', port=self.fake_server.port,
+                                                         flush_interval_sec=0.5, request_timeout_sec=2,
+                                                         report_producer=self.report_producer)
+
+    def tearDown(self):
+        self.sbs_receiver.close()
+        self.fake_server.close_event.set()
+        self.fake_server.shutdown()
+        self.fake_server.server_close()
+
+    def test_no_snapshot_client(self):
+        # The tcp:// URL is never fetched over HTTP
+        self.assertIsNone(self.sbs_receiver.snapshot_client)
+
+    def test_lines_split_across_reads(self):
+        self.assertEqual(self.sbs_receiver.poll_once(), 2)
+
+        reports_list = self.report_producer.reports_lists[0]
+        self.assertEqual([(aircraft.mode_s_hex, aircraft.lat) for aircraft in reports_list],
+                         [('4ca2d6', 51.45), ('4ca2d6', 51.451)])
+        self.assertEqual(reports_list[1].squawk, '7000')
+        # 6 MSG lines, the STA line isn't an aircraft message
+        self.assertEqual(self.sbs_receiver.messages_decoded, 6)
+        # The other aircraft's position arrived before its velocity
+        self.assertEqual(self.sbs_receiver.aircraft_tracker.positions_dropped, 1)
+        self.assertEqual(self.sbs_receiver.line_buffer, b'')
+
+    def test_partial_line_buffered(self):
+        stream_bytes = captured_stream.encode('ascii')
+        split_at = len(stream_bytes) - 20
+        # The last line's start arrives in this flush, the rest of it in the next one
+        self.fake_server.sessions = [[stream_bytes[:split_at], 0.8, stream_bytes[split_at:]]]
+
+        self.assertEqual(self.sbs_receiver.poll_once(), 1)
+        self.assertEqual(self.sbs_receiver.line_buffer, second_position_line.encode('ascii')[:-18])
+
+        self.assertEqual(self.sbs_receiver.poll_once(), 1)
+        self.assertEqual(self.report_producer.reports_lists[-1][0].lat, 51.451)
+        self.assertEqual(self.sbs_receiver.line_buffer, b'')
+
+    def test_reconnect_after_server_closes(self):
+        self.assertEqual(self.sbs_receiver.poll_once(), 2)
+
+        self.fake_server.close_event.set()
+        with self.assertRaises(ConnectionError):
+            self.sbs_receiver.poll_once()
+        self.assertIsNone(self.sbs_receiver.sbs_socket)
+
+        # The next poll opens a new connection, and the aircraft's state carried over
+        self.assertEqual(self.sbs_receiver.poll_once(), 1)
+        self.assertEqual(self.fake_server.connections, 2)
+        self.assertEqual(self.report_producer.reports_lists[-1][0].lat, 51.451)
+
+
+if __name__ == '__main__':
+    unittest.main()
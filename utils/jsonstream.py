@@ -0,0 +1,95 @@
+"""
+Incremental JSON parsing utilities, for pulling the items out of a large array inside a JSON document one at a time
+without loading the whole document into memory
+"""
+
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Characters read from the file per refill of the parse buffer
+default_read_size = 1024 * 1024
+
+# A single array item bigger than this is treated as malformed JSON instead of reading the rest of the file trying
+# to complete it
+default_max_item_chars = 16 * 1024 * 1024
+
+json_whitespace_and_commas = ' \t\n\r,'
+
+
+class JsonStreamError(ValueError):
+    """Raised when the streamed document doesn't contain the array, or an item in it can't be parsed"""
+    pass
+
+
+def iter_json_array_items(text_file, array_key, read_size=default_read_size, max_item_chars=default_max_item_chars):
+    """
+    Yield the items of the array stored under array_key in a JSON document, one at a time. Only the current item
+    (plus up to read_size characters of look-ahead) is held in memory.
+
+    Stray commas before, between or after items, and missing commas between items, are tolerated, since those are
+    the common malformations in the adsbexchange archive files.
+
+    :param text_file: file object opened in text mode
+    :param array_key: name of the key holding the array, e.g. 'acList'
+    :param read_size: number of characters to read from the file at a time
+    :param max_item_chars: largest single item, in characters, before giving up on the document
+    :return: generator of the parsed items
+    """
+    decoder = json.JSONDecoder()
+    key_token = '"{}"'.format(array_key)
+    buffer = ''
+    position = 0
+    at_eof = False
+
+    def read_more(current_buffer, current_position):
+        more_text = text_file.read(read_size)
+        # Drop the part of the buffer that has already been parsed, so it doesn't grow with the file
+        return current_buffer[current_position:] + more_text, 0, not more_text
+
+    # Find the start of the array
+    while True:
+        key_index = buffer.find(key_token, position)
+        if key_index >= 0:
+            bracket_index = buffer.find('[', key_index + len(key_token))
+            if bracket_index >= 0:
+                position = bracket_index + 1
+                break
+        if at_eof:
+            raise JsonStreamError('No "{}" array found in the JSON document'.format(array_key))
+        # Keep enough of the tail to match a key that is split across two reads
+        keep_from = max(0, len(buffer) - len(key_token) - 64) if key_index < 0 else key_index
+        buffer, position, at_eof = read_more(buffer, keep_from)
+
+    while True:
+        # Skip to the start of the next item
+        while position < len(buffer) and buffer[position] in json_whitespace_and_commas:
+            position += 1
+        if position >= len(buffer):
+            if at_eof:
+                raise JsonStreamError('JSON document ended inside the "{}" array'.format(array_key))
+            buffer, position, at_eof = read_more(buffer, position)
+            continue
+
+        if buffer[position] == ']':
+            return
+
+        try:
+            item, item_end = decoder.raw_decode(buffer, position)
+        except ValueError as err:
+            # Most likely the item runs past the end of the buffer, so read more and try again
+            if at_eof or len(buffer) - position > max_item_chars:
+                raise JsonStreamError('Could not parse item in the "{}" array: {}'.format(array_key, err))
+            buffer, position, at_eof = read_more(buffer, position)
+            continue
+
+        # A number at the end of the buffer might be cut off part way (e.g. "1." of "1.5e3"), so unless the item
+        # is an object or array, make sure the buffer has a delimiter after it before trusting it
+        if not isinstance(item, (dict, list)) and not at_eof and \
+                (item_end >= len(buffer) or buffer[item_end] not in json_whitespace_and_commas + ']'):
+            buffer, position, at_eof = read_more(buffer, position)
+            continue
+
+        position = item_end
+        yield item
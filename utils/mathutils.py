@@ -1,5 +1,10 @@
 from math import radians, cos, sin, asin, sqrt
 
+import numpy as np
+
+# Mean radius of the earth in meters, for the spherical earth model used throughout
+earth_radius_meters = 6371000
+
 
 def haversine_distance_meters(lon1, lat1, lon2, lat2):
     """
@@ -18,6 +23,120 @@ def haversine_distance_meters(lon1, lat1, lon2, lat2):
     calc = sin(diff_lat / 2.0) ** 2 + cos(lat1) * cos(lat2) * sin(diff_lon / 2.0) ** 2
     straight = 2 * asin(sqrt(calc))
     # Radius of earth in meters
-    radius_meters = 6371000
+    radius_meters = earth_radius_meters
 
     return straight * radius_meters
+
+
+# The functions below take NumPy arrays (or scalars) of decimal degrees and broadcast against each other, so one
+# point can be compared with many (scalar and array) or many with many (arrays of the same shape, or see
+# distance_matrix_meters). They are much faster than calling haversine_distance_meters in a loop for large
+# inputs, and agree with it to floating point precision.
+
+
+def distance_meters(lons1, lats1, lons2, lats2):
+    """
+    Great circle (haversine) distance between points
+
+    Args:
+        lons1: Longitudes of the first points
+        lats1: Latitudes of the first points
+        lons2: Longitudes of the second points
+        lats2: Latitudes of the second points
+
+    Returns:
+        Array of distances in meters, with the broadcast shape of the inputs
+
+    """
+    lons1, lats1, lons2, lats2 = np.radians(lons1), np.radians(lats1), np.radians(lons2), np.radians(lats2)
+
+    calc = np.sin((lats2 - lats1) / 2.0) ** 2 + np.cos(lats1) * np.cos(lats2) * np.sin((lons2 - lons1) / 2.0) ** 2
+    # Rounding can take calc a hair past 1 for antipodal points
+    return 2 * earth_radius_meters * np.arcsin(np.sqrt(np.minimum(calc, 1.0)))
+
+
+def distance_matrix_meters(lons1, lats1, lons2, lats2):
+    """
+    Great circle distance from every one of the first points to every one of the second points
+
+    Args:
+        lons1: 1-d array of longitudes of the first points
+        lats1: 1-d array of latitudes of the first points
+        lons2: 1-d array of longitudes of the second points
+        lats2: 1-d array of latitudes of the second points
+
+    Returns:
+        Array of shape (number of first points, number of second points) of distances in meters
+
+    """
+    return distance_meters(np.asarray(lons1)[:, np.newaxis], np.asarray(lats1)[:, np.newaxis], lons2, lats2)
+
+
+def initial_bearing_degrees(lons1, lats1, lons2, lats2):
+    """
+    Initial bearing (forward azimuth) of the great circle from the first points to the second points
+
+    Args:
+        lons1: Longitudes of the first points
+        lats1: Latitudes of the first points
+        lons2: Longitudes of the second points
+        lats2: Latitudes of the second points
+
+    Returns:
+        Array of bearings in degrees clockwise from north, from 0 up to 360
+
+    """
+    lons1, lats1, lons2, lats2 = np.radians(lons1), np.radians(lats1), np.radians(lons2), np.radians(lats2)
+
+    diff_lons = lons2 - lons1
+    east = np.sin(diff_lons) * np.cos(lats2)
+    north = np.cos(lats1) * np.sin(lats2) - np.sin(lats1) * np.cos(lats2) * np.cos(diff_lons)
+    return np.degrees(np.arctan2(east, north)) % 360.0
+
+
+def destination_point(lons, lats, bearings_deg, distances_meters):
+    """
+    Point reached by travelling along a great circle from a start point
+
+    Args:
+        lons: Longitudes of the start points
+        lats: Latitudes of the start points
+        bearings_deg: Initial bearings in degrees clockwise from north
+        distances_meters: Distances travelled in meters
+
+    Returns:
+        Tuple of (longitudes, latitudes) arrays of the destinations, longitudes from -180 up to 180
+
+    """
+    lons, lats, bearings = np.radians(lons), np.radians(lats), np.radians(bearings_deg)
+    angular_distances = np.asarray(distances_meters, dtype=np.float64) / earth_radius_meters
+
+    dest_lats = np.arcsin(np.sin(lats) * np.cos(angular_distances) +
+                          np.cos(lats) * np.sin(angular_distances) * np.cos(bearings))
+    dest_lons = lons + np.arctan2(np.sin(bearings) * np.sin(angular_distances) * np.cos(lats),
+                                  np.cos(angular_distances) - np.sin(lats) * np.sin(dest_lats))
+    return (np.degrees(dest_lons) + 540.0) % 360.0 - 180.0, np.degrees(dest_lats)
+
+
+def cross_track_distance_meters(lons, lats, path_start_lons, path_start_lats, path_end_lons, path_end_lats):
+    """
+    Distance of points from the great circle through a path's start and end points, e.g. how far aircraft are off
+    a route
+
+    Args:
+        lons: Longitudes of the points
+        lats: Latitudes of the points
+        path_start_lons: Longitudes of the path start points
+        path_start_lats: Latitudes of the path start points
+        path_end_lons: Longitudes of the path end points
+        path_end_lats: Latitudes of the path end points
+
+    Returns:
+        Array of distances in meters, positive to the right of the path and negative to the left
+
+    """
+    angular_distances = distance_meters(path_start_lons, path_start_lats, lons, lats) / earth_radius_meters
+    bearings_to_points = np.radians(initial_bearing_degrees(path_start_lons, path_start_lats, lons, lats))
+    path_bearings = np.radians(initial_bearing_degrees(path_start_lons, path_start_lats,
+                                                       path_end_lons, path_end_lats))
+    return earth_radius_meters * np.arcsin(np.sin(angular_distances) * np.sin(bearings_to_points - path_bearings))
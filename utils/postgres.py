@@ -2,10 +2,35 @@
 Postgres DB Utilities
 """
 
+import contextlib
+import io
+import os
+import threading
+import time
+
 import psycopg2
+import psycopg2.extensions
 import logging
 logger = logging.getLogger(__name__)
 
+# COPY text format needs these characters escaped inside each column value
+copy_text_escapes = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'}
+
+default_max_connections = 20
+
+# SQLSTATE of "prepared statement does not exist"
+invalid_statement_name_pgcode = '26000'
+
+# Idle connections are checked with a round trip before being handed out again after this many seconds
+default_health_check_sec = 30
+
+# Table holding how far each incremental batch job has got, see read_watermark
+watermarks_table_name = 'batchwatermarks'
+
+# Named pools of this process, see get_connection_pool
+connection_pools = {}
+connection_pools_lock = threading.Lock()
+
 
 def database_connection(dbname=None, dbuser=None, dbhost=None, dbpasswd=None, dbport=5432):
     """
@@ -27,9 +52,501 @@ def database_connection(dbname=None, dbuser=None, dbhost=None, dbpasswd=None, db
     connect_str = "dbname=" + dbname + " user=" + dbuser + " host=" + \
                   dbhost + " password=" + dbpasswd + " port=" + str(dbport)
     try:
-        connection = psycopg2.connect(connect_str)
+        connection = psycopg2.connect(connect_str, connection_factory=PreparingConnection)
+        logger.info('Connected to postgres')
     except:
         logger.exception("Can't connect to aircraft report database with " + connect_str)
-    logger.info('Connected to postgres')
     return connection
 
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """psycopg2 connection that remembers which server-side prepared statements it holds"""
+
+    def __init__(self, *args, **kwargs):
+        super(PreparingConnection, self).__init__(*args, **kwargs)
+        self.prepared_statement_names = set()
+
+
+class PreparedStatement(object):
+    """
+    A statement that is PREPAREd once per connection (on first use) and then run with EXECUTE, so the server
+    parses and plans it once instead of on every call. Prepared statements last for the life of the connection,
+    and aren't undone by a rollback.
+    """
+
+    def __init__(self, name, sql, param_types):
+        """
+        Args:
+            name: Statement name, unique per connection
+            sql: Statement text with $1, $2... placeholders
+            param_types: List of the Postgres types of the placeholders, in order
+
+        """
+        self.name = name
+        self.sql = sql
+        self.param_types = param_types
+        self.prepare_sql = 'PREPARE {} ({}) AS {}'.format(name, ', '.join(param_types), sql)
+        # Casting each argument keeps arrays of all NULLs (which psycopg2 sends untyped) valid
+        self.execute_sql = 'EXECUTE {} ({})'.format(name, ', '.join(['%s::' + param_type
+                                                                  for param_type in param_types]))
+
+    def is_prepared(self, db_cursor):
+        prepared_statement_names = getattr(db_cursor.connection, 'prepared_statement_names', None)
+        if prepared_statement_names is not None:
+            return self.name in prepared_statement_names
+
+        # Connection that wasn't made by database_connection, so ask the server
+        db_cursor.execute('SELECT 1 FROM pg_prepared_statements WHERE name = %s', (self.name,))
+        return db_cursor.fetchone() is not None
+
+    def prepare(self, db_cursor):
+        """PREPARE the statement on the cursor's connection, if it isn't already"""
+        if self.is_prepared(db_cursor):
+            return
+        db_cursor.execute(self.prepare_sql)
+        prepared_statement_names = getattr(db_cursor.connection, 'prepared_statement_names', None)
+        if prepared_statement_names is not None:
+            prepared_statement_names.add(self.name)
+
+    def execute(self, db_cursor, params):
+        """
+        Args:
+            db_cursor: Open psycopg2 cursor
+            params: Sequence of values for the placeholders
+
+        Returns:
+            Number of rows affected
+
+        """
+        self.prepare(db_cursor)
+        # mogrify builds the full statement text, so only pay for it when it'll actually be logged
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(db_cursor.mogrify(self.execute_sql, params))
+        try:
+            db_cursor.execute(self.execute_sql, params)
+        except psycopg2.Error as db_error:
+            self.forget_if_missing(db_cursor, db_error)
+            raise
+        return db_cursor.rowcount
+
+    def forget_if_missing(self, db_cursor, db_error):
+        """If the server no longer has the statement, make sure it's prepared again on the next call"""
+        if db_error.pgcode == invalid_statement_name_pgcode:
+            getattr(db_cursor.connection, 'prepared_statement_names', set()).discard(self.name)
+
+
+def format_copy_value(value):
+    """
+    Formats a single python value as a column in the Postgres COPY text format
+
+    Args:
+        value: None, bool, number or string
+
+    Returns:
+        String that is safe to place between the tab delimiters of a COPY row
+
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    value_str = str(value)
+    for find_str, replace_str in copy_text_escapes.items():
+        if find_str in value_str:
+            value_str = value_str.replace(find_str, replace_str)
+    return value_str
+
+
+def copy_rows_into_table(db_cursor, table_name, column_names, rows):
+    """
+    Streams an iterable of row tuples into a table with COPY FROM STDIN, which is much faster than
+    one INSERT per row for large batches
+
+    Args:
+        db_cursor: Open psycopg2 cursor
+        table_name: Name of the table (or temp table) to copy into
+        column_names: List of column names, in the same order as the values in each row
+        rows: Iterable of tuples/lists of python values
+
+    Returns:
+        Number of rows that were sent to the DB
+
+    """
+    copy_buffer = io.StringIO()
+    num_rows = 0
+    for row in rows:
+        copy_buffer.write('\t'.join([format_copy_value(value) for value in row]))
+        copy_buffer.write('\n')
+        num_rows += 1
+    copy_buffer.seek(0)
+
+    sql = 'COPY {} ({}) FROM STDIN'.format(table_name, ', '.join(column_names))
+    db_cursor.copy_expert(sql, copy_buffer)
+
+    return num_rows
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of connections to one database, all with the same session settings (e.g. one pool per role:
+    synchronous_commit=off for ingest, a bigger work_mem for analytics).
+
+    getconn hands out a healthy connection - closed connections are dropped, and ones that have been idle for
+    health_check_sec are pinged first - and opens a new one when needed, so a connection lost while the DB was down
+    is replaced transparently on the next checkout. A checked out connection that was closed and never returned
+    (e.g. dropped by a caller that reconnects) has its slot reclaimed once the pool runs out.
+
+    getconn returns None, like database_connection, if the DB can't be reached or the pool stays exhausted for
+    checkout_timeout_sec, so it can be passed anywhere a db_connect callable is expected.
+
+    Pools can't be shared between processes - each worker process should make its own, see get_connection_pool.
+    """
+
+    def __init__(self, dbname=None, dbuser=None, dbhost=None, dbpasswd=None, dbport=5432,
+                 max_connections=default_max_connections, session_settings=None,
+                 health_check_sec=default_health_check_sec, checkout_timeout_sec=None, name='postgres'):
+        """
+        Args:
+            dbname, dbuser, dbhost, dbpasswd, dbport: Same as database_connection
+            max_connections: Max number of connections open at once, checked out or idle
+            session_settings: Dict of run-time parameter name -> value set on every new connection
+            health_check_sec: Seconds a connection can be idle before it's pinged on checkout
+            checkout_timeout_sec: Max seconds getconn waits for a connection when the pool is exhausted
+                (None waits forever)
+            name: Name used in the pool's log messages
+
+        """
+        self.connect_params = {'dbname': dbname, 'dbuser': dbuser, 'dbhost': dbhost, 'dbpasswd': dbpasswd,
+                               'dbport': dbport}
+        self.max_connections = max_connections
+        self.session_settings = session_settings or {}
+        self.health_check_sec = health_check_sec
+        self.checkout_timeout_sec = checkout_timeout_sec
+        self.name = name
+
+        self.pool_condition = threading.Condition()
+        # List of (connection, time it was returned) of the idle connections, most recently used last
+        self.idle_connections = []
+        self.checked_out_connections = set()
+        self.num_open = 0
+        self.is_closed = False
+        self.thread_connections = threading.local()
+
+        self.checkouts = 0
+        self.checkout_wait_sec_total = 0.0
+        self.checkout_wait_sec_max = 0.0
+        self.checkout_timeouts = 0
+        self.connections_opened = 0
+        self.connections_discarded = 0
+
+    def open_connection(self):
+        """
+        Returns:
+            New psycopg2 connection with the session settings applied, or None if the DB can't be reached
+
+        """
+        connection = database_connection(**self.connect_params)
+        if connection is None:
+            return None
+
+        if self.session_settings:
+            try:
+                cur = connection.cursor()
+                for setting_name, setting_value in self.session_settings.items():
+                    cur.execute('SELECT set_config(%s, %s, false)', (setting_name, str(setting_value)))
+                cur.close()
+                connection.commit()
+            except:
+                logger.exception('Could not apply session settings {} on {} connection'.format(
+                    self.session_settings, self.name))
+                connection.close()
+                return None
+
+        self.connections_opened += 1
+        return connection
+
+    def is_healthy(self, connection):
+        """Ping a connection that has been idle for a while. Call without pool_condition held."""
+        try:
+            cur = connection.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            connection.rollback()
+            return True
+        except:
+            logger.warning('Dropping broken {} connection from the pool'.format(self.name))
+            return False
+
+    def discard(self, connection):
+        """Close a connection and free its slot. Call with pool_condition held."""
+        try:
+            connection.close()
+        except:
+            pass
+        self.num_open -= 1
+        self.connections_discarded += 1
+        self.pool_condition.notify()
+
+    def getconn(self):
+        """
+        Check out a connection. Give it back with putconn, or use the connection() context manager.
+
+        Returns:
+            Healthy psycopg2 connection, or None if the DB can't be reached, the pool stayed exhausted or it has
+            been closed
+
+        """
+        wait_start_time = time.time()
+        with self.pool_condition:
+            while True:
+                if self.is_closed:
+                    logger.error('The {} connection pool has been closed'.format(self.name))
+                    return None
+
+                stale_connection = None
+                while self.idle_connections:
+                    connection, idle_since = self.idle_connections.pop()
+                    if connection.closed:
+                        self.discard(connection)
+                    elif time.time() - idle_since < self.health_check_sec:
+                        self.record_checkout(wait_start_time, connection)
+                        return connection
+                    else:
+                        stale_connection = connection
+                        break
+
+                if stale_connection is not None:
+                    # Ping it without holding the lock, so other threads aren't held up by a slow or dead server.
+                    # Its slot stays counted in num_open meanwhile.
+                    self.pool_condition.release()
+                    try:
+                        is_healthy = self.is_healthy(stale_connection)
+                    finally:
+                        self.pool_condition.acquire()
+                    if is_healthy:
+                        self.record_checkout(wait_start_time, stale_connection)
+                        return stale_connection
+                    self.discard(stale_connection)
+                    continue
+
+                if self.num_open >= self.max_connections:
+                    self.reclaim_closed_connections()
+                if self.num_open < self.max_connections:
+                    # Reserve the slot, then connect without holding the lock
+                    self.num_open += 1
+                    break
+
+                remaining_sec = None
+                if self.checkout_timeout_sec is not None:
+                    remaining_sec = self.checkout_timeout_sec - (time.time() - wait_start_time)
+                    if remaining_sec <= 0:
+                        self.checkout_timeouts += 1
+                        logger.error('Timed out after {} sec waiting for a {} connection, all {} in use'.format(
+                            self.checkout_timeout_sec, self.name, self.max_connections))
+                        return None
+                self.pool_condition.wait(remaining_sec)
+
+        connection = self.open_connection()
+        with self.pool_condition:
+            if connection is None:
+                self.num_open -= 1
+                self.pool_condition.notify()
+                return None
+            self.record_checkout(wait_start_time, connection)
+        return connection
+
+    def reclaim_closed_connections(self):
+        """Free the slots of checked out connections that have since been closed. Call with pool_condition held."""
+        for connection in [connection for connection in self.checked_out_connections if connection.closed]:
+            self.checked_out_connections.discard(connection)
+            self.discard(connection)
+
+    def record_checkout(self, wait_start_time, connection):
+        self.checked_out_connections.add(connection)
+        wait_sec = time.time() - wait_start_time
+        self.checkouts += 1
+        self.checkout_wait_sec_total += wait_sec
+        self.checkout_wait_sec_max = max(self.checkout_wait_sec_max, wait_sec)
+
+    def putconn(self, connection):
+        """
+        Return a checked out connection. An open transaction is rolled back, and a closed connection just frees
+        its slot. Once the pool has been closed, returned connections are closed too.
+        """
+        if connection is None:
+            return
+        with self.pool_condition:
+            if connection not in self.checked_out_connections:
+                return
+            # No longer checked out, so a second putconn of it is ignored while it's being reset
+            self.checked_out_connections.discard(connection)
+
+        # Roll back without holding the lock, as for the health check ping. Its slot stays counted in num_open.
+        is_reusable = not self.is_closed and self.reset_connection(connection)
+
+        with self.pool_condition:
+            if self.is_closed or not is_reusable:
+                self.discard(connection)
+                return
+            self.idle_connections.append((connection, time.time()))
+            self.pool_condition.notify()
+
+    def reset_connection(self, connection):
+        """
+        Roll back a returned connection's open transaction, closing it if that fails. Call without pool_condition
+        held.
+
+        Returns:
+            True if the connection can go back in the pool
+
+        """
+        if connection.closed or \
+                connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        try:
+            if connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+            return True
+        except:
+            logger.warning('Closing {} connection that could not be rolled back'.format(self.name))
+            try:
+                connection.close()
+            except:
+                pass
+            return False
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Context manager that checks out a connection and returns it to the pool afterwards. Commit inside the
+        block - anything left uncommitted is rolled back.
+        """
+        connection = self.getconn()
+        try:
+            yield connection
+        finally:
+            self.putconn(connection)
+
+    def get_thread_connection(self):
+        """
+        Returns:
+            Connection checked out to the calling thread, which gets the same one back on every call until it's
+            closed or released - for long-running writer and worker threads
+
+        """
+        connection = getattr(self.thread_connections, 'connection', None)
+        if connection is not None and not connection.closed:
+            return connection
+        if connection is not None:
+            self.putconn(connection)
+        self.thread_connections.connection = self.getconn()
+        return self.thread_connections.connection
+
+    def release_thread_connection(self):
+        """Return the calling thread's connection to the pool"""
+        connection = getattr(self.thread_connections, 'connection', None)
+        self.thread_connections.connection = None
+        self.putconn(connection)
+
+    def get_stats(self):
+        """
+        Returns:
+            Dict of the pool's connection counts and checkout wait time metrics
+
+        """
+        with self.pool_condition:
+            return {'open': self.num_open,
+                    'idle': len(self.idle_connections),
+                    'max': self.max_connections,
+                    'checkouts': self.checkouts,
+                    'checkout_wait_sec_avg': self.checkout_wait_sec_total / self.checkouts if self.checkouts else 0.0,
+                    'checkout_wait_sec_max': self.checkout_wait_sec_max,
+                    'checkout_timeouts': self.checkout_timeouts,
+                    'opened': self.connections_opened,
+                    'discarded': self.connections_discarded}
+
+    def log_stats(self):
+        logger.info('{} connection pool: {}'.format(self.name, self.get_stats()))
+
+    def closeall(self):
+        """
+        Close the idle connections and the pool. Checked out connections are closed when they're returned, and
+        getconn returns None from now on.
+        """
+        with self.pool_condition:
+            self.is_closed = True
+            while self.idle_connections:
+                self.discard(self.idle_connections.pop()[0])
+            # Wake any threads waiting on an exhausted pool, so they see it has been closed
+            self.pool_condition.notify_all()
+
+
+def get_connection_pool(name, **pool_kwargs):
+    """
+    Get this process's pool with the given name, creating it with pool_kwargs the first time. A pool inherited
+    from the parent process by a forked worker is replaced, since connections can't be shared across processes, and
+    so is a pool that has been closed.
+
+    Args:
+        name: Pool name, e.g. the role it's for ('ingest', 'analytics')
+        pool_kwargs: ConnectionPool keyword args
+
+    Returns:
+        ConnectionPool
+
+    """
+    with connection_pools_lock:
+        pool_entry = connection_pools.get(name)
+        if pool_entry is None or pool_entry[0] != os.getpid() or pool_entry[1].is_closed:
+            pool_entry = (os.getpid(), ConnectionPool(name=name, **pool_kwargs))
+            connection_pools[name] = pool_entry
+        return pool_entry[1]
+
+
+def ensure_watermarks_table(db_cursor):
+    """
+    Creates the batch job watermarks table if it doesn't exist yet (it's also in sql/postgres_setup.sql)
+
+    Args:
+        db_cursor: Open psycopg2 cursor
+
+    """
+    db_cursor.execute('''CREATE TABLE IF NOT EXISTS {} (
+                           job_name        TEXT PRIMARY KEY,
+                           watermark_epoch INTEGER NOT NULL,
+                           updated_epoch   INTEGER NOT NULL)'''.format(watermarks_table_name))
+
+
+def read_watermark(db_cursor, job_name):
+    """
+    Args:
+        db_cursor: Open psycopg2 cursor
+        job_name: Name of the incremental batch job
+
+    Returns:
+        Epoch the job has processed up to, or None if it has never run
+
+    """
+    db_cursor.execute('SELECT watermark_epoch FROM {} WHERE job_name = %s'.format(watermarks_table_name),
+                      (job_name,))
+    watermark_row = db_cursor.fetchone()
+    return None if watermark_row is None else watermark_row[0]
+
+
+def write_watermark(db_cursor, job_name, watermark_epoch):
+    """
+    Records how far a batch job has got. Takes effect when the caller commits, so it can be written in the same
+    transaction as the job's last batch of changes.
+
+    Args:
+        db_cursor: Open psycopg2 cursor
+        job_name: Name of the incremental batch job
+        watermark_epoch: Epoch the job has processed up to
+
+    """
+    db_cursor.execute('''INSERT INTO {} (job_name, watermark_epoch, updated_epoch)
+                           VALUES (%s, %s, %s)
+                           ON CONFLICT (job_name) DO UPDATE
+                             SET watermark_epoch = EXCLUDED.watermark_epoch,
+                                 updated_epoch = EXCLUDED.updated_epoch'''.format(watermarks_table_name),
+                      (job_name, int(watermark_epoch), int(time.time())))